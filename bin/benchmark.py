@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+"""Benchmarks of the sparse kernels."""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as scp
+import torch as th
+from torch.autograd import Variable
+
+import matting.modules as modules
+import matting.optim as optim
+import matting.sparse as sp
+import matting.functions.sparse as spfuncs
+import matting.functions.sparse_cpu as spcpu
+
+log = logging.getLogger(__name__)
+
+
+def random_system(h, w, nnz_per_row, seed=0):
+  """Random N x N CSR matrix, N = h*w, with a Laplacian-like density."""
+  rng = np.random.RandomState(seed)
+  N = h*w
+  row = np.repeat(np.arange(N), nnz_per_row // 2)
+  col = rng.randint(0, N, size=row.size)
+  val = rng.uniform(size=row.size).astype(np.float32)
+  M = scp.coo_matrix((val, (row, col)), shape=(N, N)).tocsr()
+  M = (M + M.T + scp.identity(N, dtype=np.float32)).tocsr()
+  M.sort_indices()
+  return sp.Sparse(
+      Variable(th.from_numpy(M.indptr.astype(np.int32))),
+      Variable(th.from_numpy(M.indices.astype(np.int32))),
+      Variable(th.from_numpy(M.data)), th.Size((N, N)))
+
+
+def ifm_sample(h, w, cm_knn=20, iu_knn=5, seed=0):
+  """Synthetic h x w sample with the layout and sparsity of the IFM data.
+
+  Same keys as dataset.MattingDataset: 3x3 windows around the interior
+  pixels (LOC), `cm_knn` color neighbours per pixel (CM) and `iu_knn` per
+  unknown pixel (IU), known / unknown diagonals. Color neighbours are
+  adjacent pixels once sorted by a smooth noisy color, scattered across
+  the image as in real samples. Returns numpy arrays.
+  """
+  rng = np.random.RandomState(seed)
+  N = h*w
+  y, x = np.mgrid[0:h, 0:w]
+  color = np.sin(0.05*x) + np.cos(0.07*y) + 0.5*rng.uniform(size=(h, w))
+  order = np.argsort(color.ravel(), kind="mergesort")
+  rank = np.empty_like(order)
+  rank[order] = np.arange(N)
+
+  def color_neighbors(pixels, k):
+    offsets = np.arange(1, k+1) - (k+1) // 2
+    offsets[offsets >= 0] += 1
+    pos = np.clip(rank[pixels].reshape(-1, 1) + offsets.reshape(1, -1), 0, N-1)
+    return order[pos].astype(np.int32)
+
+  def flows(shape):
+    f = rng.uniform(size=shape).astype(np.float32)
+    return f / f.sum(-1, keepdims=True)
+
+  pixels = np.arange(N)
+  cm_neighbors = color_neighbors(pixels, cm_knn)
+  loc_in = (y[1:-1, 1:-1]*w + x[1:-1, 1:-1]).reshape(-1, 1).astype(np.int32)
+  loc_flows = 0.1*rng.uniform(size=(9, 9, loc_in.shape[0])).astype(np.float32)
+  loc_flows = 0.5*(loc_flows + loc_flows.transpose(1, 0, 2))
+  known = (rng.uniform(size=N) > 0.5).astype(np.float32)
+  iu_in = np.nonzero(known == 0)[0].reshape(-1, 1).astype(np.int32)
+  return {
+      "Wcm_row": np.repeat(pixels, cm_knn).astype(np.int32),
+      "Wcm_col": cm_neighbors.ravel(),
+      "Wcm_data": flows((N, cm_knn)).ravel(),
+      "LOC_inInd": loc_in,
+      "LOC_flows": np.ascontiguousarray(loc_flows),
+      "IU_inInd": iu_in,
+      "IU_neighInd": color_neighbors(iu_in.ravel(), iu_knn),
+      "IU_flows": flows((iu_in.shape[0], iu_knn)),
+      "kToUconf": rng.uniform(size=N).astype(np.float32),
+      "known": known,
+      "kToU": rng.uniform(size=N).astype(np.float32),
+      "image": rng.uniform(size=(3, h, w)).astype(np.float32),
+  }
+
+
+def to_variables(sample, cuda=False):
+  out = {}
+  for k, v in sample.items():
+    t = th.from_numpy(v)
+    if cuda:
+      t = t.cuda()
+    out[k] = Variable(t)
+  return out
+
+
+def matting_system(sample, N):
+  """Assembled system (A, b) of a sample, with unit weights."""
+  weights = [Variable(sample["kToU"].data.new(N).fill_(1.0)) for i in range(4)]
+  lmbda = Variable(sample["kToU"].data.new(1).fill_(100.0))
+  return modules.MattingSystem()(sample, *(weights + [lmbda, N]))
+
+
+def ifm_system(h, w, seed=0, cuda=False):
+  """Assembled matting system A of a synthetic h x w sample."""
+  A, b = matting_system(to_variables(ifm_sample(h, w, seed=seed), cuda), h*w)
+  return A
+
+
+def bandwidth(A):
+  """Largest distance of a nonzero to the diagonal."""
+  row, col = A.host_pattern()
+  rows = spcpu._csr_rows(row, col.size)
+  return int(np.abs(rows - col).max())
+
+
+def timeit(f, repeats):
+  """Median wall time of f() in ms, after one warmup call."""
+  f()
+  times = []
+  for i in range(repeats):
+    start = time.time()
+    f()
+    times.append(time.time() - start)
+  return 1000*np.median(times)
+
+
+def cpu_scaling(A, threads, k, repeats):
+  """SpMV and SpMM-dense (k columns) timings of the scipy and omp engines.
+
+  Returns one (op, engine, threads, ms) tuple per run.
+  """
+  N = A.size[1]
+  v = Variable(th.rand(N))
+  X = Variable(th.rand(N, k))
+  ops = [("spmv", lambda e: sp.spmv(A, v, engine=e)),
+         ("spmm_dense_k{}".format(k), lambda e: sp.spmm_dense(A, X, engine=e))]
+  results = []
+  for name, op in ops:
+    results.append((name, "scipy", 1, timeit(lambda: op("scipy"), repeats)))
+    if spcpu.sparse_omp is None:
+      continue
+    for t in threads:
+      with spcpu.engine("omp", t):
+        results.append((name, "omp", t, timeit(lambda: op(None), repeats)))
+  return results
+
+
+def reordering_gain(A, h, w, tile, repeats):
+  """SpMV timings of A in natural, RCM and tile orderings.
+
+  Returns one (ordering, bandwidth, analysis ms, spmv ms) tuple per
+  ordering, the analysis time is the one of the first, uncached call.
+  """
+  v = Variable(th.rand(A.size[1]))
+  results = [("natural", bandwidth(A), 0.0,
+              timeit(lambda: sp.spmv(A, v), repeats))]
+  builders = [("rcm", lambda: sp.rcm_ordering(A)),
+              ("tiles{}".format(tile),
+               lambda: sp.tile_ordering(h, w, tile, A.val))]
+  for name, build in builders:
+    start = time.time()
+    ordering = build()
+    P = sp.permute(A, ordering)
+    analysis = 1000*(time.time() - start)
+    Pv = ordering.vector(v)
+    results.append((name, bandwidth(P), analysis,
+                    timeit(lambda: sp.spmv(P, Pv), repeats)))
+  return results
+
+
+def backends():
+  """Backends available here: the CPU engines and CUDA."""
+  names = ["scipy"]
+  if spcpu.sparse_omp is not None:
+    names.append("omp")
+  if spfuncs.sparse_cuda is not None and th.cuda.is_available():
+    names.append("cuda")
+  return names
+
+
+def image_size(megapixels):
+  """(height, width) of a 4:3 image of about `megapixels` MP."""
+  w = int(round(np.sqrt(megapixels*1e6*4/3)))
+  return int(round(megapixels*1e6 / w)), w
+
+
+def _leaf(A):
+  """A with its values as a new leaf that requires grad."""
+  val = Variable(A.val.data, requires_grad=True)
+  if isinstance(A, sp.Diagonal):
+    return sp.Diagonal(val, A.size)
+  return sp.Sparse(A.csr_row_idx, A.col_idx, val, A.size,
+                   pattern_key=A.pattern_key)
+
+
+def _loss(out):
+  if isinstance(out, tuple):
+    out = out[0]
+  if isinstance(out, (sp.Sparse, sp.Diagonal)):
+    out = out.val
+  return out.sum()
+
+
+def _sync(cuda):
+  if cuda:
+    th.cuda.synchronize()
+
+
+def time_forward_backward(op, repeats, cuda):
+  """Median forward and backward times of op() in ms, after one warmup."""
+  forward, backward = [], []
+  for i in range(repeats+1):
+    _sync(cuda)
+    start = time.time()
+    out = op()
+    _sync(cuda)
+    mid = time.time()
+    _loss(out).backward()
+    _sync(cuda)
+    end = time.time()
+    if i > 0:
+      forward.append(mid - start)
+      backward.append(end - mid)
+  return 1000*np.median(forward), 1000*np.median(backward)
+
+
+def suite_ops(sample, N, cg_steps):
+  """The benchmarked operations on the terms of the system of `sample`.
+
+  Returns (name, nnz, op) tuples. The inputs of each op are leaves, so
+  that the backward pass only runs through the op itself.
+  """
+  system = modules.MattingSystem()
+  size = th.Size((N, N))
+  like = sample["kToU"].data
+  ones = Variable(like.new(N).fill_(1.0))
+  lmbda = Variable(like.new(1).fill_(100.0))
+
+  # LOC windows, 81 entries each, as in MattingSystem._matting_laplacian
+  neighbors = system._loc_neighbors(sample).data.cpu().numpy()
+  loc_row = Variable(sp._upload(np.repeat(neighbors, 9, 1), like))
+  loc_col = Variable(sp._upload(np.tile(neighbors, (1, 9)), like))
+  loc_val = Variable(sample["LOC_flows"].data.permute(2, 1, 0).contiguous(),
+                     requires_grad=True)
+
+  Wcm = _leaf(sp.from_coo(sample["Wcm_row"], sample["Wcm_col"],
+                          sample["Wcm_data"], size))
+  Lcm = _leaf(sp.sp_laplacian(Wcm))
+  Lcm_t = _leaf(sp.transpose(Lcm))
+  KU = sp.Diagonal(ones.mul(sample["kToUconf"]))
+  known = sp.Diagonal(lmbda.mul(sample["known"]))
+  data_term = _leaf(sp.spadd(KU, known))
+  terms = [_leaf(system._color_mixture(N, sample, ones)),
+           _leaf(system._matting_laplacian(N, sample, ones)),
+           data_term,
+           _leaf(system._intra_unknowns(N, sample, ones))]
+  A = _leaf(sp.spadd_many(terms))
+  v = Variable(like.new(N).uniform_(), requires_grad=True)
+  b = Variable(sp.spmv(data_term, sample["kToU"]).data, requires_grad=True)
+  x0 = Variable(like.new(N).zero_())
+
+  return [
+      ("from_coo", loc_val.numel(),
+       lambda: sp.from_coo(loc_row.view(-1), loc_col.view(-1),
+                           loc_val.view(-1), size)),
+      ("transpose", Wcm.nnz, lambda: sp.transpose(Wcm)),
+      ("spadd", A.nnz, lambda: sp.spadd_many(terms)),
+      ("spmv", A.nnz, lambda: sp.spmv(A, v)),
+      ("spmm", Lcm.nnz, lambda: sp.spmm(Lcm_t, Lcm)),
+      ("sparse_cg{}".format(cg_steps), A.nnz,
+       lambda: optim.sparse_cg(A, b, x0, steps=cg_steps, thresh=0)),
+  ]
+
+
+PRECONDITIONERS = [None, "jacobi", "block_jacobi", "ic0", "multigrid"]
+
+
+def time_preconditioners(A, b, shape, steps, thresh, repeats, cuda):
+  """CG to `thresh` with each preconditioner of PRECONDITIONERS.
+
+  `shape` is the (h, w) of the image of the system. Returns one (name,
+  setup ms, solve ms, steps) tuple per preconditioner, the setup reuses the
+  cached symbolic structures. Preconditioners that cannot run here (IC(0)
+  on a deep level schedule without the omp engine) are skipped.
+  """
+  x0 = Variable(b.data.new(b.size()).zero_())
+  results = []
+  for name in PRECONDITIONERS:
+    kwargs = {"shapes": [shape]} if name == "multigrid" else {}
+    try:
+      optim.preconditioner(name, A, **kwargs)
+    except RuntimeError as e:
+      log.warning("skipping pcg_{}: {}".format(name, e))
+      continue
+    precond = [None]
+    def setup():
+      precond[0] = optim.preconditioner(name, A, **kwargs)
+      _sync(cuda)
+    ran = [0]
+    def solve():
+      x, err, ran[0] = optim.sparse_cg(A, b, x0, steps=steps, thresh=thresh,
+                                       precond=precond[0])
+      _sync(cuda)
+    results.append((name or "none", timeit(setup, repeats),
+                    timeit(solve, repeats), ran[0]))
+  return results
+
+
+def time_solvers(A, b, steps, thresh, repeats, cuda):
+  """Each solver of optim.SOLVERS to `thresh`, Jacobi preconditioned.
+
+  Returns one (name, solve ms, steps, |b - A.x|) tuple per solver.
+  "pipelined_cg_noreplace" runs as many pipelined CG steps without
+  residual replacement: the difference in time is the cost of the
+  replacement, the difference in residual what it buys.
+  """
+  x0 = Variable(b.data.new(b.size()).zero_())
+  precond = optim.preconditioner("jacobi", A)
+  def run(name, **kwargs):
+    out = [None, 0]
+    def solve():
+      x, errs, stop_steps = optim.solve(name, A, b, x0, precond=precond,
+                                        **kwargs)
+      out[:] = [x, max(stop_steps)]
+      _sync(cuda)
+    ms = timeit(solve, repeats)
+    return ms, out[1], float((b - sp.spmv(A, out[0])).data.norm())
+  results = [(name,) + run(name, steps=steps, thresh=thresh)
+             for name in sorted(optim.SOLVERS.keys())]
+  ran = [r[2] for r in results if r[0] == "pipelined_cg"][0]
+  results.append(("pipelined_cg_noreplace",) +
+                 run("pipelined_cg", steps=ran, thresh=0, replace_every=0))
+  return results
+
+
+def run_suite(megapixels, names, cg_steps, repeats, pcg_steps, pcg_thresh):
+  """Times the suite_ops of a synthetic sample per size and backend.
+
+  Returns a list of result dicts, one per op, size, backend and pass. The
+  preconditioned solves ("pcg_<name>") and the solvers ("krylov_<name>")
+  also record their steps.
+  """
+  results = []
+  for mp in megapixels:
+    h, w = image_size(mp)
+    sample = ifm_sample(h, w)
+    for backend in names:
+      cuda = backend == "cuda"
+      with spcpu.engine(None if cuda else backend):
+        for op_name, nnz, op in suite_ops(to_variables(sample, cuda), h*w, cg_steps):
+          forward, backward = time_forward_backward(op, repeats, cuda)
+          log.info("{} {}x{} {}: forward {:.1f}ms, backward {:.1f}ms".format(
+            op_name, h, w, backend, forward, backward))
+          for direction, ms in [("forward", forward), ("backward", backward)]:
+            results.append({
+              "op": op_name, "backend": backend, "megapixels": mp,
+              "height": h, "width": w, "nnz": int(nnz),
+              "pass": direction, "ms": float(ms)})
+
+        A, b = matting_system(to_variables(sample, cuda), h*w)
+        for name, setup, solve, steps in time_preconditioners(
+            A, b, (h, w), pcg_steps, pcg_thresh, repeats, cuda):
+          log.info("pcg_{} {}x{} {}: {} steps, setup {:.1f}ms, solve {:.1f}ms".format(
+            name, h, w, backend, steps, setup, solve))
+          for direction, ms in [("setup", setup), ("solve", solve)]:
+            results.append({
+              "op": "pcg_" + name, "backend": backend, "megapixels": mp,
+              "height": h, "width": w, "nnz": int(A.nnz),
+              "pass": direction, "ms": float(ms), "steps": int(steps)})
+        for name, ms, steps, residual in time_solvers(
+            A, b, pcg_steps, pcg_thresh, repeats, cuda):
+          log.info("krylov_{} {}x{} {}: {} steps, solve {:.1f}ms, "
+                   "residual {:.3g}".format(name, h, w, backend, steps, ms,
+                                            residual))
+          results.append({
+            "op": "krylov_" + name, "backend": backend, "megapixels": mp,
+            "height": h, "width": w, "nnz": int(A.nnz), "pass": "solve",
+            "ms": float(ms), "steps": int(steps), "residual": residual})
+      sp.pattern_cache.clear()
+  return results
+
+
+def _result_key(r):
+  return (r["op"], r["backend"], r["height"], r["width"], r["pass"])
+
+
+def compare(results, baseline, tolerance):
+  """Matches results to a baseline, returns (result, baseline ms, regressed).
+
+  A result regresses when it is more than `tolerance` (relative) slower
+  than its baseline. Results missing from the baseline are skipped.
+  """
+  reference = dict((_result_key(r), r["ms"]) for r in baseline)
+  out = []
+  for r in results:
+    key = _result_key(r)
+    if key not in reference:
+      continue
+    out.append((r, reference[key], r["ms"] > (1 + tolerance)*reference[key]))
+  return out
+
+
+def suite_main(args):
+  names = args.backends or backends()
+  results = run_suite(args.megapixels, names, args.cg_steps, args.repeats,
+                      args.pcg_steps, args.pcg_thresh)
+  report = {
+    "meta": {
+      "host": platform.node(),
+      "torch": th.__version__,
+      "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+      "cg_steps": args.cg_steps,
+      "repeats": args.repeats,
+    },
+    "results": results,
+  }
+  if args.output is not None:
+    with open(args.output, "w") as fid:
+      json.dump(report, fid, indent=2)
+    log.info("Results saved to {}".format(args.output))
+
+  if args.baseline is None:
+    print("{:18s} {:7s} {:>11s} {:>10s} {:8s} {:>10s} {:>6s}".format(
+      "op", "backend", "size", "nnz", "pass", "ms", "steps"))
+    for r in results:
+      print("{:18s} {:7s} {:>11s} {:10d} {:8s} {:10.2f} {:>6s}".format(
+        r["op"], r["backend"], "{}x{}".format(r["height"], r["width"]),
+        r["nnz"], r["pass"], r["ms"], str(r.get("steps", ""))))
+    return 0
+
+  with open(args.baseline) as fid:
+    baseline = json.load(fid)["results"]
+  matched = compare(results, baseline, args.tolerance)
+  print("{:18s} {:7s} {:>11s} {:8s} {:>10s} {:>10s} {:>8s}".format(
+    "op", "backend", "size", "pass", "baseline", "ms", "ratio"))
+  regressions = 0
+  for r, base, regressed in matched:
+    regressions += regressed
+    print("{:18s} {:7s} {:>11s} {:8s} {:10.2f} {:10.2f} {:7.2f}x{}".format(
+      r["op"], r["backend"], "{}x{}".format(r["height"], r["width"]),
+      r["pass"], base, r["ms"], r["ms"]/base, "  REGRESSION" if regressed else ""))
+  if regressions > 0:
+    log.error("{} / {} timings regressed by more than {:.0f}%".format(
+      regressions, len(matched), 100*args.tolerance))
+    return 1
+  return 0
+
+
+def main(args):
+  A = random_system(args.height, args.width, args.nnz_per_row)
+  log.info("Matrix {}x{}, {} nonzeros".format(A.size[0], A.size[1], A.nnz))
+
+  if spcpu.sparse_omp is None:
+    log.warning("_ext.sparse_omp is not built (`make cpu` in matting/), "
+                "timing scipy only")
+    threads = []
+  else:
+    max_threads = spcpu.sparse_omp.omp_max_threads()
+    threads = args.threads
+    if threads is None:
+      threads = [t for t in [1, 2, 4, 8, 16, 32, 64] if t < max_threads]
+      threads.append(max_threads)
+
+  results = cpu_scaling(A, threads, args.k, args.repeats)
+  reference = dict(((op, "scipy"), ms) for op, e, t, ms in results if e == "scipy")
+  print("{:16s} {:6s} {:>7s} {:>10s} {:>9s}".format(
+    "op", "engine", "threads", "ms", "vs scipy"))
+  for op, engine, t, ms in results:
+    print("{:16s} {:6s} {:7d} {:10.3f} {:8.2f}x".format(
+      op, engine, t, ms, reference[(op, "scipy")]/ms))
+
+  A = ifm_system(args.height, args.width)
+  log.info("Matting-like matrix {}x{}, {} nonzeros".format(
+    A.size[0], A.size[1], A.nnz))
+  results = reordering_gain(A, args.height, args.width, args.tile_size,
+                            args.repeats)
+  reference = results[0][3]
+  print("")
+  print("{:16s} {:>10s} {:>12s} {:>10s} {:>10s}".format(
+    "ordering", "bandwidth", "analysis ms", "spmv ms", "vs natural"))
+  for name, bw, analysis, ms in results:
+    print("{:16s} {:10d} {:12.1f} {:10.3f} {:9.2f}x".format(
+      name, bw, analysis, ms, reference/ms))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--height', type=int, default=1024)
+  parser.add_argument('--width', type=int, default=1024)
+  parser.add_argument('--nnz_per_row', type=int, default=25)
+  parser.add_argument('--k', type=int, default=4, help='columns of the dense operand in SpMM')
+  parser.add_argument('--threads', type=int, nargs="*", help='thread counts of the omp engine, defaults to powers of 2')
+  parser.add_argument('--repeats', type=int, default=10)
+  parser.add_argument('--tile_size', type=int, default=32, help='side of the tiles of the tile ordering')
+  parser.add_argument('--suite', dest="suite", action="store_true", help='time the sparse ops on matting-shaped systems instead')
+  parser.add_argument('--megapixels', type=float, nargs="*", default=[0.25, 1.0], help='image sizes of the suite')
+  parser.add_argument('--backends', nargs="*", choices=["scipy", "omp", "cuda"], help='backends of the suite, defaults to all available')
+  parser.add_argument('--cg_steps', type=int, default=20)
+  parser.add_argument('--pcg_steps', type=int, default=2000, help='step budget of the preconditioner comparison')
+  parser.add_argument('--pcg_thresh', type=float, default=1e-3, help='residual the preconditioned solves run to')
+  parser.add_argument('--output', help='json file for the suite results')
+  parser.add_argument('--baseline', help='json results of a previous suite run to compare to')
+  parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown over the baseline reported as a regression')
+  args = parser.parse_args()
+
+  logging.basicConfig(
+      format="[%(process)d] %(levelname)s %(filename)s:%(lineno)s | %(message)s")
+  log.setLevel(logging.INFO)
+
+  if args.suite:
+    sys.exit(suite_main(args))
+  main(args)
@@ -37,11 +37,12 @@ def main(args, params):
     return
 
   dataloader = DataLoader(data, 
-      batch_size=1,
+      batch_size=args.batch_size, collate_fn=dataset.collate_samples,
       shuffle=True, num_workers=4)
 
   val_dataloader = DataLoader(val_data, 
-      batch_size=1, shuffle=True, num_workers=0)
+      batch_size=1, collate_fn=dataset.collate_samples,
+      shuffle=True, num_workers=0)
 
   log.info("Training with {} samples".format(len(data)))
 
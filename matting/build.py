@@ -1,4 +1,5 @@
 import os
+import sys
 from torch.utils.ffi import create_extension
 
 abs_path = os.path.dirname(os.path.realpath(__file__))
@@ -15,5 +16,19 @@ ffi = create_extension(
   with_cuda=True
 )
 
+# CPU-only kernels, they build without CUDA
+ffi_omp = create_extension(
+  name='_ext.sparse_omp',
+  package=False,
+  headers='src/sparse_omp.h',
+  sources=['src/sparse_omp.c'],
+  extra_compile_args=["-std=c99", "-O3", "-fopenmp"],
+  extra_link_args=["-fopenmp"],
+  relative_to=__file__,
+  with_cuda=False
+)
+
 if __name__ == '__main__':
-  ffi.build()
+  ffi_omp.build()
+  if "cpu" not in sys.argv[1:]:
+    ffi.build()
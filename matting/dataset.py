@@ -163,6 +163,7 @@ class MattingDataset(Dataset):
         "matte": matte,
         "vanilla": vanilla,
         "trimap": trimap,
+        "name": fname,
     }
 
     if self.transform is not None:
@@ -203,3 +204,33 @@ class ToTensor(object):
       else:
         xformed[k] = sample[k]
     return xformed
+
+
+def collate_samples(batch):
+  """Collate samples of different sizes into a batch.
+
+  Images (tensors of size c x height x width) are zero-padded to the largest
+  size in the batch and stacked, heights and widths are stacked. The IFM
+  data, whose size varies per sample, is kept as lists with one entry per
+  sample: the linear systems are never padded.
+  """
+  height = max([s["height"] for s in batch])
+  width = max([s["width"] for s in batch])
+  collated = {}
+  for k in batch[0].keys():
+    items = [s[k] for s in batch]
+    if k in ["height", "width"]:
+      collated[k] = th.LongTensor(items)
+    elif all([_is_image(s[k], s) for s in batch]):
+      padded = items[0].new(len(items), items[0].shape[0], height, width).zero_()
+      for i, im in enumerate(items):
+        padded[i, :, :im.shape[1], :im.shape[2]].copy_(im)
+      collated[k] = padded
+    else:
+      collated[k] = items
+  return collated
+
+
+def _is_image(x, sample):
+  return th.is_tensor(x) and x.dim() == 3 and \
+      x.shape[1] == sample["height"] and x.shape[2] == sample["width"]
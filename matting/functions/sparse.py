@@ -1,7 +1,25 @@
+import numpy as np
 import torch
 from torch.autograd import Function
 from torch.autograd import Variable
-from .._ext import sparse
+
+from . import sparse_cpu
+
+try:
+  from .._ext import sparse as sparse_cuda
+except ImportError:  # extension not built, only the CPU backend is available
+  sparse_cuda = None
+
+
+def _backend(tensor):
+  """Kernels matching the device of `tensor`."""
+  if not tensor.is_cuda:
+    return sparse_cpu
+  if sparse_cuda is None:
+    raise RuntimeError(
+        "CUDA tensors need the _ext.sparse extension, run `make` in matting/")
+  return sparse_cuda
+
 
 class Coo2Csr(Function):
   @staticmethod
@@ -11,8 +29,8 @@ class Coo2Csr(Function):
     csr_col_idx = col_idx.new() 
     csr_val = val.new() 
     permutation = csr_row_idx.new()
-    sparse.coo2csr(row_idx, col_idx, val, csr_row_idx, csr_col_idx, csr_val,
-                   permutation, size[0], size[1])
+    _backend(val).coo2csr(row_idx, col_idx, val, csr_row_idx, csr_col_idx,
+                          csr_val, permutation, size[0], size[1])
     ctx.permutation = permutation
     return (csr_row_idx, csr_col_idx, csr_val)
 
@@ -25,7 +43,10 @@ class Coo2Csr(Function):
 
     permutation = ctx.permutation
 
-    grad_val = grad_csr_val[permutation.long()]
+    # csr_val = val[permutation], scatter the gradient back to COO order
+    grad_val = grad_csr_val.data.new(grad_csr_val.numel())
+    grad_val.index_copy_(0, permutation.long(), grad_csr_val.data)
+    grad_val = Variable(grad_val)
 
     return (grad_row_idx, grad_col_idx, grad_val, grad_size)
 
@@ -36,7 +57,7 @@ class Transpose(Function):
     csc_row_idx = row_idx.new()
     csc_col_idx = row_idx.new()
     csc_val = val.new()
-    sparse.csr2csc(row_idx, col_idx, val, csc_row_idx, csc_col_idx, csc_val, size[0], size[1])
+    _backend(val).csr2csc(row_idx, col_idx, val, csc_row_idx, csc_col_idx, csc_val, size[0], size[1])
     # csc_row_idx = Variable(csc_row_idx)
     # csc_col_idx = Variable(csc_col_idx)
     # csc_val = Variable(csc_val)
@@ -53,7 +74,7 @@ class Transpose(Function):
     row_idx = csc_row_idx.data.new()
     col_idx = csc_col_idx.data.new()
     grad_val = grad_csc_val.data.new()
-    sparse.csr2csc(
+    _backend(grad_val).csr2csc(
         csc_col_idx.data, csc_row_idx.data, grad_csc_val.data, col_idx, row_idx, grad_val, size[1], size[0])
     grad_col_idx = None
     grad_row_idx = None
@@ -70,10 +91,10 @@ class SpAdd(Function):
     ctx.alpha = alpha
     ctx.beta = beta
 
-    rowC = torch.IntTensor().cuda()
-    colC = torch.IntTensor().cuda()
-    valC = torch.FloatTensor().cuda()
-    sparse.spadd_forward(
+    rowC = rowA.new()
+    colC = colA.new()
+    valC = valA.new()
+    _backend(valA).spadd_forward(
         rowA, colA, valA, 
         rowB, colB, valB, 
         rowC, colC, valC, 
@@ -101,7 +122,7 @@ class SpAdd(Function):
     # dL/dA_ik should select in dL/dC_ik following A's sparsity pattern
     grad_valA = grad_valC.data.new()
     grad_valB = grad_valC.data.new()
-    sparse.spadd_backward(
+    _backend(grad_valA).spadd_backward(
         rowA.data, colA.data, grad_valA,
         rowB.data, colB.data, grad_valB,
         rowC.data, colC.data, grad_valC.data,
@@ -114,15 +135,51 @@ class SpAdd(Function):
            grad_rowB, grad_colB, grad_valB, grad_size, grad_alpha, grad_beta
 
 
+class SpAddNumeric(Function):
+  """Weighted sum of sparse matrices with a precomputed merged pattern.
+
+  `plan.maps[i]` holds the position in C of each entry of the i-th term, so
+  both passes reduce to value scatters/gathers, one per term.
+  """
+
+  @staticmethod
+  def forward(ctx, plan, scales, *vals):
+    ctx.plan = plan
+    ctx.scales = scales
+    valC = vals[0].new(plan.nnz).zero_()
+    for val, s, idx in zip(vals, scales, plan.maps):
+      if s == 1.0:
+        valC.index_add_(0, idx, val)
+      else:
+        valC.index_add_(0, idx, val.mul(s))
+    return valC
+
+  @staticmethod
+  def backward(ctx, grad_valC):
+    grad_vals = []
+    for s, idx in zip(ctx.scales, ctx.plan.maps):
+      grad_val = grad_valC.data.index_select(0, idx)
+      if s != 1.0:
+        grad_val.mul_(s)
+      grad_vals.append(Variable(grad_val))
+    return (None, None) + tuple(grad_vals)
+
+
 class SpMV(Function):
-  """Sparse matrix-vector product."""
+  """Sparse matrix-vector product.
+
+  `csc`, if given, returns the CSR (row, col, val) tensors of the transpose.
+  The backward pass then runs a plain product with the transpose instead of
+  a transposed product.
+  """
 
   @staticmethod
-  def forward(ctx, row, col, val, vector, size):
+  def forward(ctx, row, col, val, vector, size, csc=None):
     ctx.save_for_backward(row, col, val, vector)
     ctx.matrix_size = size
+    ctx.csc = csc
     output = vector.new() 
-    sparse.spmv(
+    _backend(val).spmv(
         row, col, val, 
         vector, output,
         size[0], size[1], False)
@@ -137,13 +194,20 @@ class SpMV(Function):
     grad_size = None
 
     grad_vector = vector.data.new()
-    sparse.spmv(
-        row.data, col.data, val.data, 
-        grad_output.data, grad_vector,
-        size[0], size[1], True)
+    if ctx.csc is not None:
+      t_row, t_col, t_val = ctx.csc()
+      _backend(grad_vector).spmv(
+          t_row, t_col, t_val,
+          grad_output.data, grad_vector,
+          size[1], size[0], False)
+    else:
+      _backend(grad_vector).spmv(
+          row.data, col.data, val.data, 
+          grad_output.data, grad_vector,
+          size[0], size[1], True)
 
     grad_val = val.data.new()
-    sparse.spmv_backward_matrix(
+    _backend(grad_val).spmv_backward_matrix(
         row.data, col.data, 
         vector.data, grad_output.data, grad_val,
         size[0], size[1])
@@ -151,7 +215,253 @@ class SpMV(Function):
     grad_vector = Variable(grad_vector)
     grad_val = Variable(grad_val)
 
-    return grad_row, grad_col, grad_val, grad_vector, grad_size
+    return grad_row, grad_col, grad_val, grad_vector, grad_size, None
+
+
+class SpMMDense(Function):
+  """Product of a sparse matrix with a dense (cols x k) matrix.
+
+  All k columns are computed in one pass over the matrix. `csc` returns the
+  CSR (row, col, val) tensors of the transpose for the backward pass.
+  """
+
+  @staticmethod
+  def forward(ctx, row, col, val, dense, size, csc):
+    ctx.save_for_backward(row, col, val, dense)
+    ctx.matrix_size = size
+    ctx.csc = csc
+    output = dense.new()
+    _backend(val).spmm_dense(row, col, val, dense, output, size[0], size[1])
+    return output
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    row, col, val, dense = ctx.saved_variables
+    size = ctx.matrix_size
+    grad_output = grad_output.data.contiguous()
+    backend = _backend(grad_output)
+
+    # dL/dX = At.dL/dC
+    t_row, t_col, t_val = ctx.csc()
+    grad_dense = dense.data.new()
+    backend.spmm_dense(t_row, t_col, t_val, grad_output, grad_dense,
+                       size[1], size[0])
+
+    # dL/dA = dL/dC.Xt, on A's pattern
+    grad_val = val.data.new()
+    backend.spmm_dense_backward_matrix(
+        row.data, col.data, dense.data, grad_output, grad_val,
+        size[0], size[1])
+
+    return None, None, Variable(grad_val), Variable(grad_dense), None, None
+
+
+class SpMVDot(Function):
+  """Sparse matrix-vector product fused with the dot product vector.(A.vector).
+
+  The matrix must be square. `csc` returns the CSR (row, col, val) tensors
+  of the transpose for the backward pass.
+  """
+
+  @staticmethod
+  def forward(ctx, row, col, val, vector, size, csc):
+    output = vector.new()
+    dot = vector.new()
+    _backend(val).spmv_dot(row, col, val, vector, output, dot, size[0], size[1])
+    ctx.save_for_backward(row, col, val, vector, output)
+    ctx.matrix_size = size
+    ctx.csc = csc
+    return output, dot
+
+  @staticmethod
+  def backward(ctx, grad_output, grad_dot):
+    row, col, val, vector, output = ctx.saved_variables
+    size = ctx.matrix_size
+    v = vector.data
+    g = grad_output.data.contiguous()
+    gd = grad_dot.data
+    backend = _backend(g)
+
+    # dL/dv = At.g + gd.(A.v + At.v), both transposed products in one pass
+    t_row, t_col, t_val = ctx.csc()
+    At_gv = v.new()
+    backend.spmm_dense(t_row, t_col, t_val, torch.stack([g, v], 1), At_gv,
+                       size[1], size[0])
+    grad_vector = At_gv[:, 0] + gd*(output.data + At_gv[:, 1])
+
+    # dL/dA_ij = g_i.v_j + gd.v_i.v_j, on A's pattern
+    grad_val = val.data.new()
+    backend.spmm_dense_backward_matrix(
+        row.data, col.data, torch.stack([v, v], 1),
+        torch.stack([g, gd*v], 1), grad_val, size[0], size[1])
+
+    return None, None, Variable(grad_val), Variable(grad_vector), None, None
+
+
+class CGUpdate(Function):
+  """CG update of the iterate and residual, fused with the new residual norm.
+
+  With alpha = rr/pAp, returns (x + alpha.p, r - alpha.Ap, |r - alpha.Ap|^2).
+  Only the step vectors are kept for the backward pass.
+  """
+
+  @staticmethod
+  def forward(ctx, x, r, p, Ap, rr, pAp):
+    x_new = x.clone()
+    r_new = r.clone()
+    rr_new = rr.new()
+    _backend(x).cg_update(x_new, r_new, p, Ap, rr, pAp, rr_new)
+    ctx.save_for_backward(p, Ap, rr, pAp, r_new)
+    return x_new, r_new, rr_new
+
+  @staticmethod
+  def backward(ctx, grad_x, grad_r, grad_rr):
+    p, Ap, rr, pAp, r_new = ctx.saved_variables
+    alpha = rr / pAp
+    grad_r = grad_r + 2*grad_rr*r_new
+    grad_alpha = (grad_x*p).sum() - (grad_r*Ap).sum()
+    return (grad_x, grad_r, alpha*grad_x, -alpha*grad_r,
+            grad_alpha / pAp, -grad_alpha*alpha / pAp)
+
+
+class CGDirection(Function):
+  """Next CG search direction r + (rr_new/rr_old).p."""
+
+  @staticmethod
+  def forward(ctx, r, p, rr_new, rr_old):
+    p_new = p.clone()
+    _backend(p).cg_direction(p_new, r, rr_new, rr_old)
+    ctx.save_for_backward(p, rr_new, rr_old)
+    return p_new
+
+  @staticmethod
+  def backward(ctx, grad_p):
+    p, rr_new, rr_old = ctx.saved_variables
+    beta = rr_new / rr_old
+    grad_beta = (grad_p*p).sum()
+    # d(beta)/d(rr_old) as -beta/rr_old, rr_old^2 underflows near convergence
+    return (grad_p, beta*grad_p, grad_beta / rr_old,
+            -grad_beta*beta / rr_old)
+
+
+class BatchInverse(Function):
+  """Inverses of a batch of small dense matrices (batch x n x n).
+
+  The inversion runs on the host, the backward pass is
+  -inv^T.grad.inv^T on the device of the input.
+  """
+
+  @staticmethod
+  def forward(ctx, mats):
+    inv = np.linalg.inv(mats.cpu().numpy())
+    output = mats.new(*inv.shape)
+    output.copy_(torch.from_numpy(inv))
+    ctx.save_for_backward(output)
+    return output
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    inv, = ctx.saved_variables
+    inv_t = inv.transpose(1, 2)
+    return -torch.bmm(torch.bmm(inv_t, grad_output), inv_t)
+
+
+class SymmetricSolve(Function):
+  """M^-1.r for a constant symmetric M, given by `solve` on tensors."""
+
+  @staticmethod
+  def forward(ctx, r, solve):
+    ctx.solve = solve
+    return solve(r)
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    return Variable(ctx.solve(grad_output.data)), None
+
+
+class LinearSolve(Function):
+  """x = A^-1.b for a symmetric A given by its values on (row, col).
+
+  `system.solve(b)` and `system.adjoint(g)` solve the system on tensors,
+  b may have one right-hand side per column. Gradients are implicit: with
+  A.lmbda = dL/dx, dL/db = lmbda and dL/dA_ij = -lmbda_i.x_j on A's pattern,
+  only x is kept for the backward pass.
+  """
+
+  @staticmethod
+  def forward(ctx, row, col, val, b, size, system):
+    x = system.solve(b)
+    ctx.save_for_backward(row, col, val, x)
+    ctx.matrix_size = size
+    ctx.system = system
+    return x
+
+  @staticmethod
+  def backward(ctx, grad_x):
+    row, col, val, x = ctx.saved_variables
+    size = ctx.matrix_size
+    lmbda = ctx.system.adjoint(grad_x.data.contiguous())
+    backend = _backend(lmbda)
+
+    grad_val = val.data.new()
+    if lmbda.dim() == 2:
+      backend.spmm_dense_backward_matrix(
+          row.data, col.data, x.data, lmbda, grad_val, size[0], size[1])
+    else:
+      backend.spmv_backward_matrix(
+          row.data, col.data, x.data, lmbda, grad_val, size[0], size[1])
+    grad_val.mul_(-1)
+
+    return None, None, Variable(grad_val), Variable(lmbda), None, None
+
+
+class Checkpoint(Function):
+  """Output of `run` on the matrix values and a state, without its graph.
+
+  `run.forward(val, state)` computes the output and keeps what it needs to
+  recompute parts of itself, `run.backward(grad)` recomputes them with
+  autograd and returns the gradients of val and of each state tensor.
+  """
+
+  @staticmethod
+  def forward(ctx, val, run, *state):
+    ctx.run = run
+    return run.forward(val, state)
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    grad_val, grad_state = ctx.run.backward(grad_output)
+    return (grad_val, None) + tuple(grad_state)
+
+
+class Tap(Function):
+  """Identity on `val` whose backward hands the gradient to `sink(grad)`
+  instead of passing it on."""
+
+  @staticmethod
+  def forward(ctx, val, sink):
+    ctx.sink = sink
+    return val.view_as(val)
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    ctx.sink(grad_output)
+    return None, None
+
+
+def spmv_dot_(row, col, val, vector, output, dot, size):
+  """In-place, tensor-only SpMVDot: fills output and dot."""
+  _backend(val).spmv_dot(row, col, val, vector, output, dot, size[0], size[1])
+
+
+def cg_update_(x, r, p, Ap, rr, pAp, rr_new):
+  """In-place, tensor-only CGUpdate: updates x and r, fills rr_new."""
+  _backend(x).cg_update(x, r, p, Ap, rr, pAp, rr_new)
+
+
+def cg_direction_(p, r, rr_new, rr_old):
+  """In-place, tensor-only CGDirection: updates p."""
+  _backend(p).cg_direction(p, r, rr_new, rr_old)
 
 
 class SpMM(Function):
@@ -161,10 +471,10 @@ class SpMM(Function):
   def forward(ctx, rowA, colA, valA, sizeA, rowB, colB, valB, sizeB):
     ctx.A_size = sizeA
     ctx.B_size = sizeB
-    rowC = torch.IntTensor().cuda()
-    colC = torch.IntTensor().cuda()
-    valC = torch.FloatTensor().cuda()
-    sparse.spmm_forward(
+    rowC = rowA.new()
+    colC = colA.new()
+    valC = valA.new()
+    _backend(valA).spmm_forward(
         rowA, colA, valA, sizeA[0], sizeA[1],
         rowB, colB, valB, sizeB[0], sizeB[1],
         rowC, colC, valC)
@@ -184,7 +494,7 @@ class SpMM(Function):
     grad_valA = valA.data.new()
     grad_valB = valB.data.new()
 
-    sparse.spmm_backward(
+    _backend(grad_valA).spmm_backward(
         rowA.data, colA.data, valA.data, grad_valA, sizeA[0], sizeA[1],
         rowB.data, colB.data, valB.data, grad_valB, sizeB[0], sizeB[1],
         rowC.data, colC.data, grad_valC.data)
@@ -193,3 +503,85 @@ class SpMM(Function):
     grad_valB = Variable(grad_valB)
 
     return grad_rowA, grad_colA, grad_valA, grad_sizeA, grad_rowB, grad_colB, grad_valB, grad_sizeB
+
+
+class SpMMNumeric(Function):
+  """Product of sparse matrices with a precomputed output pattern.
+
+  `plan.a`, `plan.b` and `plan.c` describe the structures of A, B and C,
+  together with their transposes, so that forward and backward are sampled
+  products that never run a symbolic pass.
+  """
+
+  @staticmethod
+  def forward(ctx, valA, valB, plan):
+    ctx.plan = plan
+    ctx.save_for_backward(valA, valB)
+    a, b, c = plan.a, plan.b, plan.c
+    valC = valA.new()
+    _backend(valA).spmm_sampled(
+        a.csr_row_idx, a.col_idx, valA,
+        b.t_csr_row_idx, b.t_col_idx, valB.index_select(0, b.permutation),
+        c.coo_row_idx, c.col_idx, valC, plan.inner)
+    return valC
+
+  @staticmethod
+  def backward(ctx, grad_valC):
+    valA, valB = ctx.saved_variables
+    plan = ctx.plan
+    a, b, c = plan.a, plan.b, plan.c
+    grad_valC = grad_valC.data.contiguous()
+    backend = _backend(grad_valC)
+
+    # dL/dA = dL/dC.Bt
+    grad_valA = valA.data.new()
+    backend.spmm_sampled(
+        c.csr_row_idx, c.col_idx, grad_valC,
+        b.csr_row_idx, b.col_idx, valB.data,
+        a.coo_row_idx, a.col_idx, grad_valA, plan.outer)
+
+    # dL/dB = At.dL/dC
+    grad_valB = valB.data.new()
+    backend.spmm_sampled(
+        a.t_csr_row_idx, a.t_col_idx, valA.data.index_select(0, a.permutation),
+        c.t_csr_row_idx, c.t_col_idx, grad_valC.index_select(0, c.permutation),
+        b.coo_row_idx, b.col_idx, grad_valB, plan.rows)
+
+    return Variable(grad_valA), Variable(grad_valB), None
+
+
+class SpGram(Function):
+  """Gram matrix At.A of a sparse matrix, with a precomputed output pattern.
+
+  The products run over the cached transposed structure of A (`plan.a`), no
+  transposed matrix is assembled.
+  """
+
+  @staticmethod
+  def forward(ctx, valA, plan):
+    ctx.plan = plan
+    ctx.save_for_backward(valA)
+    a, c = plan.a, plan.c
+    valAt = valA.index_select(0, a.permutation)
+    valC = valA.new()
+    _backend(valA).spmm_sampled(
+        a.t_csr_row_idx, a.t_col_idx, valAt,
+        a.t_csr_row_idx, a.t_col_idx, valAt,
+        c.coo_row_idx, c.col_idx, valC, plan.rows)
+    return valC
+
+  @staticmethod
+  def backward(ctx, grad_valC):
+    valA, = ctx.saved_variables
+    plan = ctx.plan
+    a, c = plan.a, plan.c
+    grad_valC = grad_valC.data.contiguous()
+
+    # dL/dA = A.(dL/dC + dL/dCt), C's pattern is symmetric
+    grad_sym = grad_valC + grad_valC.index_select(0, c.permutation)
+    grad_valA = valA.data.new()
+    _backend(grad_valA).spmm_sampled(
+        a.csr_row_idx, a.col_idx, valA.data,
+        c.csr_row_idx, c.col_idx, grad_sym,
+        a.coo_row_idx, a.col_idx, grad_valA, plan.cols)
+    return Variable(grad_valA), None
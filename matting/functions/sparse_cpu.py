@@ -0,0 +1,563 @@
+"""CPU implementation of the `_ext.sparse` kernels.
+
+Every function mirrors the signature of its cuSPARSE counterpart in
+`src/sparse.c`: inputs are CPU tensors and outputs are resized and filled in
+place. The work is vectorized with numpy/scipy, no per-element python loops.
+
+The products on float32 tensors (spmv, spmv_dot, spmm_dense and the sampled
+products of spmm) can run on the multithreaded kernels of the
+`_ext.sparse_omp` extension instead, see `set_engine`.
+"""
+import contextlib
+
+import numpy as np
+import torch as th
+import scipy.sparse as scp
+
+try:
+  from .._ext import sparse_omp
+except ImportError:  # extension not built, scipy only
+  sparse_omp = None
+
+ENGINES = ["scipy", "omp"]
+_engine = {"name": "scipy" if sparse_omp is None else "omp", "threads": 0}
+
+
+def set_engine(name, threads=0):
+  """Select the implementation of the CPU products.
+
+  "scipy" is single-threaded, "omp" runs the OpenMP kernels of the native
+  extension on `threads` threads (0: all available cores).
+  """
+  if name not in ENGINES:
+    raise ValueError("Unknown CPU engine {}, expected one of {}".format(
+      name, ENGINES))
+  if name == "omp" and sparse_omp is None:
+    raise RuntimeError(
+        "The omp engine needs the _ext.sparse_omp extension, run `make cpu` in matting/")
+  _engine["name"] = name
+  _engine["threads"] = threads
+
+
+def get_engine():
+  """(name, threads) of the current CPU engine."""
+  return _engine["name"], _engine["threads"]
+
+
+@contextlib.contextmanager
+def engine(name=None, threads=0):
+  """Temporarily select a CPU engine, a no-op when `name` is None."""
+  if name is None:
+    yield
+    return
+  previous = get_engine()
+  set_engine(name, threads)
+  try:
+    yield
+  finally:
+    set_engine(*previous)
+
+
+def _native(*tensors):
+  """True if the native kernels should handle these tensors."""
+  return _engine["name"] == "omp" and \
+      all(t.type() == "torch.FloatTensor" for t in tensors)
+
+
+def _np(tensor):
+  return tensor.contiguous().numpy()
+
+
+def _assign(dst, array):
+  """Resize `dst` and copy `array` into it."""
+  array = np.ascontiguousarray(array)
+  dst.resize_(*array.shape)
+  if array.size > 0:
+    dst.copy_(th.from_numpy(array))
+
+
+def _csr_rows(csr_row, nnz):
+  """Expand a CSR row pointer to one row index per nonzero."""
+  counts = np.diff(csr_row.astype(np.int64))
+  return np.repeat(np.arange(counts.size, dtype=np.int64), counts)[:nnz]
+
+
+def _row_ptr(row, rows):
+  ptr = np.zeros(rows+1, dtype=np.int32)
+  np.cumsum(np.bincount(row, minlength=rows), out=ptr[1:])
+  return ptr
+
+
+def _keys(row, col, cols):
+  return row.astype(np.int64)*cols + col.astype(np.int64)
+
+
+def _csr(row, col, val, rows, cols):
+  return scp.csr_matrix((val, col, row), shape=(rows, cols))
+
+
+def _sample(mat, row, col):
+  """Values of the scipy matrix `mat` at coordinates (row, col), 0 if absent."""
+  mat = mat.tocsr()
+  mat.sum_duplicates()
+  cols = mat.shape[1]
+  mat_keys = _keys(_csr_rows(mat.indptr, mat.nnz), mat.indices, cols)
+  keys = _keys(row, col, cols)
+  out = np.zeros(keys.size, dtype=mat.dtype)
+  if mat.nnz == 0 or keys.size == 0:
+    return out
+  pos = np.minimum(np.searchsorted(mat_keys, keys), mat.nnz-1)
+  found = mat_keys[pos] == keys
+  out[found] = mat.data[pos[found]]
+  return out
+
+
+def coo2csr_symbolic(row, col, rows):
+  """CSR pattern of COO indices, numpy in and out.
+
+  Returns (csr_row, csr_col, permutation), with csr_val = val[permutation].
+  """
+  row = row.astype(np.int64)
+  # sort by row, then column, keeping duplicates in input order
+  perm = np.lexsort((col, row))
+  return _row_ptr(row, rows), col[perm].astype(np.int32), perm
+
+
+def coo2csr(row_idx, col_idx, val, csr_row_idx, csr_col_idx, csr_val,
+            permutation, rows, cols):
+  ptr, col, perm = coo2csr_symbolic(_np(row_idx), _np(col_idx), rows)
+  _assign(csr_row_idx, ptr)
+  _assign(csr_col_idx, col)
+  _assign(csr_val, _np(val)[perm])
+  _assign(permutation, perm.astype(np.int32))
+  return 0
+
+
+def csr2csc_symbolic(csr_row, csr_col, cols):
+  """Transposed structure of a CSR pattern, numpy in and out.
+
+  Returns (csc_col_ptr, csc_row, permutation), with csc_val = val[permutation].
+  """
+  row = _csr_rows(csr_row, csr_col.size)
+  perm = np.argsort(csr_col, kind="mergesort")  # stable: rows stay sorted
+  return _row_ptr(csr_col, cols), row[perm].astype(np.int32), perm
+
+
+def csr2csc(row_idx, col_idx, val, csc_row_idx, csc_col_idx, csc_val,
+            rows, cols):
+  ptr, row, perm = csr2csc_symbolic(_np(row_idx), _np(col_idx), cols)
+  _assign(csc_row_idx, row)
+  _assign(csc_col_idx, ptr)
+  _assign(csc_val, _np(val)[perm])
+  return 0
+
+
+def _merge(keys, rows, cols):
+  """CSR pattern of the union of `keys` and the position of each key in it."""
+  # the structural union is kept, even where the sum cancels out
+  keysC, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+  inverse = inverse.ravel()
+  bounds = np.cumsum([0] + [k.size for k in keys])
+  maps = [inverse[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+  return (_row_ptr(keysC // cols, rows), (keysC % cols).astype(np.int32),
+          maps)
+
+
+def spadd_symbolic(patterns, rows, cols):
+  """Merged pattern of a sum of matrices, numpy in and out.
+
+  `patterns` is a list of (csr_row, csr_col). Returns (C_csr_row, C_csr_col,
+  maps) where maps[i] is the position in C of each entry of the i-th term.
+  """
+  keys = [_keys(_csr_rows(row, col.size), col, cols) for row, col in patterns]
+  return _merge(keys, rows, cols)
+
+
+def laplacian_symbolic(csr_row, csr_col, n, symmetrize):
+  """Pattern of the Laplacian of a square matrix W, numpy in and out.
+
+  Returns (L_csr_row, L_csr_col, maps) with the position in L of each entry
+  (i, j) of W, of its transpose (j, i) when symmetrizing, and of the
+  diagonal entries (i, i) and (j, j) that its row sums contribute to.
+  """
+  row = _csr_rows(csr_row, csr_col.size)
+  col = csr_col.astype(np.int64)
+  diag = np.arange(n, dtype=np.int64)
+  keys = [_keys(row, col, n), _keys(diag, diag, n)]
+  if symmetrize:
+    keys.append(_keys(col, row, n))
+  rowL, colL, merged = _merge(keys, n, n)
+  maps = [merged[0], merged[1][row]]
+  if symmetrize:
+    maps += [merged[2], merged[1][col]]
+  return rowL, colL, maps
+
+
+def gram_symbolic(csr_row, csr_col, rows, cols):
+  """Pattern of At.A as numpy (C_csr_row, C_csr_col)."""
+  ones = _csr(csr_row, csr_col, np.ones(csr_col.size, dtype=np.float32),
+              rows, cols)
+  pattern = ones.T.dot(ones).tocsr()
+  pattern.sort_indices()
+  return pattern.indptr.astype(np.int32), pattern.indices.astype(np.int32)
+
+
+def spadd_forward(A_csr_row, A_csr_col, A_val,
+                  B_csr_row, B_csr_col, B_val,
+                  C_csr_row, C_csr_col, C_val,
+                  alpha, beta, rows, cols):
+  valA = _np(A_val)
+  valB = _np(B_val)
+  rowC, colC, maps = spadd_symbolic(
+      [(_np(A_csr_row), _np(A_csr_col)), (_np(B_csr_row), _np(B_csr_col))],
+      rows, cols)
+  valC = np.bincount(np.concatenate(maps),
+                     weights=np.concatenate([alpha*valA, beta*valB]),
+                     minlength=colC.size)
+  _assign(C_csr_row, rowC)
+  _assign(C_csr_col, colC)
+  _assign(C_val, valC.astype(valA.dtype))
+  return 0
+
+
+def spadd_backward(A_csr_row, A_csr_col, gradA,
+                   B_csr_row, B_csr_col, gradB,
+                   C_csr_row, C_csr_col, gradC,
+                   alpha, beta, rows, cols):
+  colA = _np(A_csr_col)
+  colB = _np(B_csr_col)
+  colC = _np(C_csr_col)
+  g = _np(gradC)
+  keysC = _keys(_csr_rows(_np(C_csr_row), colC.size), colC, cols)
+  keysA = _keys(_csr_rows(_np(A_csr_row), colA.size), colA, cols)
+  keysB = _keys(_csr_rows(_np(B_csr_row), colB.size), colB, cols)
+  # every entry of A and B has a matching entry in C
+  _assign(gradA, alpha*g[np.searchsorted(keysC, keysA)])
+  _assign(gradB, beta*g[np.searchsorted(keysC, keysB)])
+  return 0
+
+
+def spmv(csr_row, csr_col, val, vector, output, rows, cols, transpose):
+  if not transpose and _native(val, vector):
+    return sparse_omp.spmv_omp(csr_row, csr_col, val, vector, output,
+                               rows, cols, _engine["threads"])
+  mat = _csr(_np(csr_row), _np(csr_col), _np(val), rows, cols)
+  v = _np(vector)
+  if transpose:
+    if v.size != rows:
+      raise ValueError("rows should match vector size in transpose mode")
+    out = mat.T.dot(v)
+  else:
+    if v.size != cols:
+      raise ValueError("cols should match vector size in non-transpose mode")
+    out = mat.dot(v)
+  _assign(output, out.astype(v.dtype))
+  return 0
+
+
+def spmv_dot(csr_row, csr_col, val, vector, output, dot, rows, cols):
+  if rows != cols:
+    raise ValueError("spmv_dot: the matrix should be square.")
+  if _native(val, vector):
+    return sparse_omp.spmv_dot_omp(csr_row, csr_col, val, vector, output, dot,
+                                   rows, cols, _engine["threads"])
+  v = _np(vector)
+  out = _csr(_np(csr_row), _np(csr_col), _np(val), rows, cols).dot(v)
+  _assign(output, out.astype(v.dtype))
+  _assign(dot, np.array([v.dot(out)], dtype=v.dtype))
+  return 0
+
+
+def _inplace(tensor, name):
+  """numpy view sharing the memory of `tensor`."""
+  if not tensor.is_contiguous():
+    raise ValueError("{} should be contiguous.".format(name))
+  return tensor.numpy()
+
+
+def cg_update(x, r, p, Ap, rr, pAp, rr_new):
+  x_ = _inplace(x, "x")
+  r_ = _inplace(r, "r")
+  alpha = _np(rr)[0] / _np(pAp)[0]
+  x_ += alpha*_np(p)
+  r_ -= alpha*_np(Ap)
+  _assign(rr_new, np.array([r_.dot(r_)], dtype=r_.dtype))
+  return 0
+
+
+def cg_direction(p, r, rr_new, rr_old):
+  p_ = _inplace(p, "p")
+  p_ *= _np(rr_new)[0] / _np(rr_old)[0]
+  p_ += _np(r)
+  return 0
+
+
+def spmv_backward_matrix(csr_row, csr_col, vector, grad_output, grad_matrix,
+                         rows, cols):
+  col = _np(csr_col)
+  row = _csr_rows(_np(csr_row), col.size)
+  _assign(grad_matrix, _np(grad_output)[row]*_np(vector)[col])
+  return 0
+
+
+def spmm_dense(csr_row, csr_col, val, dense, output, rows, cols):
+  if _native(val, dense):
+    return sparse_omp.spmm_dense_omp(csr_row, csr_col, val, dense, output,
+                                     rows, cols, _engine["threads"])
+  d = _np(dense)
+  if d.ndim != 2 or d.shape[0] != cols:
+    raise ValueError("spmm_dense: cols should match the rows of dense.")
+  mat = _csr(_np(csr_row), _np(csr_col), _np(val), rows, cols)
+  _assign(output, mat.dot(d).astype(d.dtype))
+  return 0
+
+
+def spmm_dense_backward_matrix(csr_row, csr_col, dense, grad_output,
+                               grad_matrix, rows, cols):
+  col = _np(csr_col)
+  row = _csr_rows(_np(csr_row), col.size)
+  _assign(grad_matrix, np.einsum(
+    "ij,ij->i", _np(grad_output)[row], _np(dense)[col]))
+  return 0
+
+
+def spmm_symbolic(A_csr_row, A_csr_col, B_csr_row, B_csr_col,
+                  rowsA, colsA, colsB):
+  """Pattern of A.B as numpy (C_csr_row, C_csr_col), cancellations included."""
+  # scipy prunes products that cancel out, so the structure is computed on
+  # all-ones operands.
+  onesA = _csr(A_csr_row, A_csr_col,
+               np.ones(A_csr_col.size, dtype=np.float32), rowsA, colsA)
+  onesB = _csr(B_csr_row, B_csr_col,
+               np.ones(B_csr_col.size, dtype=np.float32), colsA, colsB)
+  pattern = onesA.dot(onesB)
+  pattern.sort_indices()
+  return pattern.indptr.astype(np.int32), pattern.indices.astype(np.int32)
+
+
+def spmm_forward(A_csr_row, A_csr_col, A_val, rowsA, colsA,
+                 B_csr_row, B_csr_col, B_val, rowsB, colsB,
+                 C_csr_row, C_csr_col, C_val):
+  if colsA != rowsB:
+    raise ValueError("spmm: A and B should have compatible inner dimensions.")
+  rowA = _np(A_csr_row)
+  colA = _np(A_csr_col)
+  valA = _np(A_val)
+  rowB = _np(B_csr_row)
+  colB = _np(B_csr_col)
+  valB = _np(B_val)
+
+  rowC, colC = spmm_symbolic(rowA, colA, rowB, colB, rowsA, colsA, colsB)
+  product = _csr(rowA, colA, valA, rowsA, colsA).dot(
+      _csr(rowB, colB, valB, rowsB, colsB))
+  _assign(C_csr_row, rowC)
+  _assign(C_csr_col, colC)
+  _assign(C_val, _sample(
+    product, _csr_rows(rowC, colC.size), colC).astype(valA.dtype))
+  return 0
+
+
+def _int(array):
+  """IntTensor of a numpy array, for the native kernels."""
+  return th.from_numpy(np.ascontiguousarray(array, dtype=np.int32))
+
+
+def spmm_sampled(A_csr_row, A_csr_col, A_val, B_csr_row, B_csr_col, B_val,
+                 C_coo_row, C_col, C_val, inner):
+  """C_ij = sum_k A_ik.B_jk, only for the (i, j) listed in C's pattern.
+
+  The native kernel intersects row i of A with row j of B for each entry,
+  like the CUDA one. scipy has no such product: the full product A.Bt is
+  computed and sampled, which is still faster than numpy intersections.
+  """
+  if _native(A_val, B_val):
+    return sparse_omp.spmm_sampled_omp(
+        _int(_np(A_csr_row)), _int(_np(A_csr_col)), A_val,
+        _int(_np(B_csr_row)), _int(_np(B_csr_col)), B_val,
+        _int(_np(C_coo_row)), _int(_np(C_col)), C_val, _engine["threads"])
+  rowA = _np(A_csr_row)
+  rowB = _np(B_csr_row)
+  A = _csr(rowA, _np(A_csr_col), _np(A_val), rowA.size-1, inner)
+  B = _csr(rowB, _np(B_csr_col), _np(B_val), rowB.size-1, inner)
+  _assign(C_val, _sample(
+    A.dot(B.T), _np(C_coo_row), _np(C_col)).astype(A.dtype))
+  return 0
+
+
+def spmm_backward(A_csr_row, A_csr_col, A_val, A_grad_val, rowsA, colsA,
+                  B_csr_row, B_csr_col, B_val, B_grad_val, rowsB, colsB,
+                  C_csr_row, C_csr_col, C_grad_val):
+  if colsA != rowsB:
+    raise ValueError("spmm: A and B should have compatible inner dimensions.")
+  if _native(A_val, B_val, C_grad_val):
+    return _spmm_backward_native(
+        A_csr_row, A_csr_col, A_val, A_grad_val, colsA,
+        B_csr_row, B_csr_col, B_val, B_grad_val,
+        C_csr_row, C_csr_col, C_grad_val, colsB)
+  rowA = _np(A_csr_row)
+  colA = _np(A_csr_col)
+  valA = _np(A_val)
+  rowB = _np(B_csr_row)
+  colB = _np(B_csr_col)
+  valB = _np(B_val)
+  gradC = _csr(_np(C_csr_row), _np(C_csr_col), _np(C_grad_val), rowsA, colsB)
+  A = _csr(rowA, colA, valA, rowsA, colsA)
+  B = _csr(rowB, colB, valB, rowsB, colsB)
+
+  # dL/dA = dL/dC.Bt, dL/dB = At.dL/dC, restricted to the operands' sparsity
+  _assign(A_grad_val, _sample(
+    gradC.dot(B.T), _csr_rows(rowA, colA.size), colA).astype(valA.dtype))
+  _assign(B_grad_val, _sample(
+    A.T.dot(gradC), _csr_rows(rowB, colB.size), colB).astype(valB.dtype))
+  return 0
+
+
+def _spmm_backward_native(A_csr_row, A_csr_col, A_val, A_grad_val, colsA,
+                          B_csr_row, B_csr_col, B_val, B_grad_val,
+                          C_csr_row, C_csr_col, C_grad_val, colsB):
+  """spmm_backward as two sampled products of the native kernel."""
+  rowA, colA = _np(A_csr_row), _np(A_csr_col)
+  rowB, colB = _np(B_csr_row), _np(B_csr_col)
+  rowC, colC = _np(C_csr_row), _np(C_csr_col)
+  threads = _engine["threads"]
+  # dL/dA = dL/dC.Bt on A's pattern: rows of dL/dC against rows of B
+  sparse_omp.spmm_sampled_omp(
+      _int(rowC), _int(colC), C_grad_val, _int(rowB), _int(colB), B_val,
+      _int(_csr_rows(rowA, colA.size)), _int(colA), A_grad_val, threads)
+  # dL/dB = At.dL/dC on B's pattern: columns of A against columns of dL/dC
+  t_rowA, t_colA, permA = csr2csc_symbolic(rowA, colA, colsA)
+  t_rowC, t_colC, permC = csr2csc_symbolic(rowC, colC, colsB)
+  sparse_omp.spmm_sampled_omp(
+      _int(t_rowA), _int(t_colA), th.from_numpy(_np(A_val)[permA]),
+      _int(t_rowC), _int(t_colC), th.from_numpy(_np(C_grad_val)[permC]),
+      _int(_csr_rows(rowB, colB.size)), _int(colB), B_grad_val, threads)
+  return 0
+
+
+def _ranges(starts, counts):
+  """Positions starts[i], .., starts[i]+counts[i]-1 for all i, with their i."""
+  owner = np.repeat(np.arange(counts.size), counts)
+  offsets = np.cumsum(counts) - counts
+  return owner, np.repeat(starts - offsets, counts) + np.arange(counts.sum())
+
+
+def triangular_levels(csr_row, csr_col, n):
+  """Level schedule of a triangular CSR matrix, numpy in and out.
+
+  Row i is in a later level than every row j of its off-diagonal entries,
+  the rows of a level can be solved in parallel. Returns (level_rows,
+  level_ptr): the rows sorted by level and the start of each level.
+  """
+  row = _csr_rows(csr_row, csr_col.size)
+  col = csr_col.astype(np.int64)
+  off = row != col
+  # dependents of each row, as a CSR over the dependencies
+  dep_ptr, dependents, perm = csr2csc_symbolic(csr_row, col, n)
+  dependents_off = off[perm]
+  pending = np.bincount(row[off], minlength=n)
+  frontier = np.nonzero(pending == 0)[0]
+  levels = []
+  while frontier.size > 0:
+    levels.append(frontier)
+    _, pos = _ranges(dep_ptr[frontier], np.diff(dep_ptr)[frontier])
+    pos = pos[dependents_off[pos]]
+    pending -= np.bincount(dependents[pos], minlength=n)
+    touched = np.unique(dependents[pos])
+    frontier = touched[pending[touched] == 0]
+  level_rows = np.concatenate(levels) if levels else np.zeros(0, np.int64)
+  if level_rows.size != n:
+    raise ValueError("triangular_levels: the matrix is not triangular.")
+  level_ptr = np.cumsum([0] + [lvl.size for lvl in levels])
+  return level_rows.astype(np.int32), level_ptr.astype(np.int32)
+
+
+def ic0_symbolic(csr_row, csr_col, n):
+  """Structure of the IC(0) factor L of a symmetric matrix, numpy in and out.
+
+  L has the pattern of the lower triangle of A, with the diagonal as the
+  last entry of each row. Returns (source, L_csr_row, L_csr_col,
+  Lt_csr_row, Lt_csr_col, Lt_perm): the position in A of each entry of L,
+  and the CSR of L^T with Lt_val = L_val[Lt_perm].
+  """
+  row = _csr_rows(csr_row, csr_col.size)
+  col = csr_col.astype(np.int64)
+  source = np.nonzero(col <= row)[0]
+  l_row = _row_ptr(row[source], n)
+  l_col = col[source]
+  if (np.diff(l_row) == 0).any() or (l_col[l_row[1:]-1] != np.arange(n)).any():
+    raise ValueError("ic0: every diagonal entry should be in the pattern.")
+  t_row, t_col, t_perm = csr2csc_symbolic(l_row, l_col, n)
+  return (source, l_row, l_col.astype(np.int32), t_row, t_col, t_perm)
+
+
+def ic0(csr_row, csr_col, val, level_rows, level_ptr):
+  """In-place IC(0): val holds the lower triangle of A and becomes L.
+
+  Rows are factorized level by level (see triangular_levels), within a
+  level all rows advance one entry at a time. Returns 1 if a pivot was not
+  positive (A is not SPD enough, see optim.IncompleteCholeskyPreconditioner),
+  0 otherwise.
+  """
+  if _native(val):
+    return sparse_omp.ic0_omp(csr_row, csr_col, val, level_rows, level_ptr,
+                              _engine["threads"])
+  ptr = _np(csr_row).astype(np.int64)
+  col = _np(csr_col).astype(np.int64)
+  val_ = _inplace(val, "val")
+  level_rows = _np(level_rows).astype(np.int64)
+  level_ptr = _np(level_ptr)
+  n = ptr.size - 1
+  length = np.diff(ptr)
+  keys = _keys(_csr_rows(ptr, col.size), col, n)
+  breakdown = 0
+  for lvl in range(level_ptr.size - 1):
+    rows = level_rows[level_ptr[lvl]:level_ptr[lvl+1]]
+    for t in range(length[rows].max()):
+      rows = rows[length[rows] > t]
+      pos = ptr[rows] + t
+      j = col[pos]
+      # s = sum_k L_ik.L_jk over the entries k < j of row j found in row i
+      owner, pj = _ranges(ptr[j], length[j] - 1)
+      target = rows[owner]*n + col[pj]
+      q = np.minimum(np.searchsorted(keys, target), keys.size - 1)
+      found = keys[q] == target
+      s = np.bincount(owner[found], weights=val_[q[found]]*val_[pj[found]],
+                      minlength=rows.size)
+      diag = j == rows
+      d = val_[pos[diag]] - s[diag]
+      if (d <= 0).any():
+        breakdown = 1
+        d = np.abs(d) + 1e-12
+      val_[pos[diag]] = np.sqrt(d)
+      off = ~diag
+      val_[pos[off]] = (val_[pos[off]] - s[off]) / val_[ptr[j[off]+1]-1]
+  return breakdown
+
+
+def sptrsv(csr_row, csr_col, val, level_rows, level_ptr, rhs, output,
+           diag_last):
+  """Solves T.output = rhs for T triangular, level by level.
+
+  The diagonal is the last (lower triangular) or first (upper triangular)
+  entry of each row, per `diag_last`.
+  """
+  if _native(val, rhs):
+    return sparse_omp.sptrsv_omp(csr_row, csr_col, val, level_rows, level_ptr,
+                                 rhs, output, int(diag_last),
+                                 _engine["threads"])
+  ptr = _np(csr_row).astype(np.int64)
+  col = _np(csr_col).astype(np.int64)
+  val_ = _np(val)
+  b = _np(rhs)
+  level_rows = _np(level_rows).astype(np.int64)
+  level_ptr = _np(level_ptr)
+  diag = ptr[1:] - 1 if diag_last else ptr[:-1]
+  first = ptr[:-1] if diag_last else ptr[:-1] + 1
+  x = np.zeros_like(b)
+  for lvl in range(level_ptr.size - 1):
+    rows = level_rows[level_ptr[lvl]:level_ptr[lvl+1]]
+    owner, pos = _ranges(first[rows], np.diff(ptr)[rows] - 1)
+    acc = np.bincount(owner, weights=val_[pos]*x[col[pos]], minlength=rows.size)
+    x[rows] = (b[rows] - acc) / val_[diag[rows]]
+  _assign(output, x)
+  return 0
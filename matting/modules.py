@@ -2,6 +2,7 @@ import copy
 import logging
 import sys
 import time
+from collections import OrderedDict
 
 import numpy as np
 import scipy.io
@@ -19,6 +20,7 @@ import torchvision.transforms as transforms
 
 import matting.sparse as sp
 import matting.optim as optim
+import matting.telemetry as telemetry
 
 from torchlib.modules import LinearChain
 from torchlib.modules import SkipAutoencoder
@@ -27,6 +29,13 @@ from torchlib.image import crop_like
 log = logging.getLogger(__name__)
 
 import scipy.sparse as ssp
+def _like(tensor, ref):
+  """Move `tensor` to the device of the Variable `ref`."""
+  if ref.data.is_cuda:
+    return tensor.cuda()
+  return tensor
+
+
 def matlab_dump(sp, M, N):
   sp2 = ssp.csr_matrix(
       (sp.val.cpu().data.numpy(),
@@ -36,15 +45,27 @@ def matlab_dump(sp, M, N):
   return sp2
 
 class MattingCNN(nn.Module):
-  def __init__(self, cg_steps=200):
+  def __init__(self, cg_steps=200, reorder=None, tile_size=32,
+               matrix_free_loc=False, precond=None, block_size=8,
+               smoother="jacobi", init="zeros", cache_mb=256,
+               backward="unrolled", check_every=1, precision="single",
+               krylov="cg", checkpoint=0, sink=None):
     super(MattingCNN, self).__init__()
 
     self.cg_steps = cg_steps
 
     self.net = SkipAutoencoder(4, 4, width=16, depth=5, batchnorm=True, grow_width=False)
     self.weight_normalizer = th.nn.Softmax2d()
-    self.system = MattingSystem()
-    self.solver = MattingSolver(steps=cg_steps)
+    self.system = MattingSystem(reorder=reorder, tile_size=tile_size,
+                                matrix_free_loc=matrix_free_loc)
+    self.solver = MattingSolver(steps=cg_steps, precond=precond,
+                                block_size=block_size, smoother=smoother,
+                                init=init, cache_mb=cache_mb,
+                                backward=backward, check_every=check_every,
+                                precision=precision, krylov=krylov,
+                                checkpoint=checkpoint)
+    # telemetry records of the solves, see MattingSolver
+    self.sink = telemetry.sink(sink)
 
     self.reset_parameters()
 
@@ -58,24 +79,16 @@ class MattingCNN(nn.Module):
     # self.net.prediction.weight.data.normal_(0, 0.001)
 
   def forward(self, sample):
-    assert sample['image'].shape[0] == 1  # NOTE: we do not handle batches at this point
+    bs = sample['image'].shape[0]
     h = sample['image'].shape[2]
     w = sample['image'].shape[3]
-    N = h*w
     # force non-negative weights
     eps = 1e-8
     weights = self.net(th.cat([sample['image'], sample['trimap']], 1))
     weights = self.weight_normalizer(weights)
     self.predicted_weights = weights
-    weights = weights.view(4, h*w)
 
-    CM_weights  = weights[0, :]
-    LOC_weights = weights[1, :]
-    IU_weights  = weights[2, :]
-    KU_weights  = weights[3, :]
-    # lmbda       = weights[4, :]
-
-    lmbda = Variable(th.from_numpy(np.array([100.0], dtype=np.float32)).cuda(),
+    lmbda = Variable(_like(th.from_numpy(np.array([100.0], dtype=np.float32)), weights),
                      requires_grad=False)
     # TODO: this is to set fix weights for debugging
     # cm_mult  = 1.0;
@@ -88,48 +101,527 @@ class MattingCNN(nn.Module):
     # IU_weights  = Variable(iu_mult*th.from_numpy(np.ones((N,), dtype=np.float32)).cuda())
     # KU_weights  = Variable(ku_mult*th.from_numpy(np.ones((N,), dtype=np.float32)).cuda())
 
-    single_sample = {}
-    for k in sample.keys():
-      if "Tensor" not in type(sample[k]).__name__:
-        single_sample[k] = sample[k][0, ...]
-
-    A, b = self.system(
-        single_sample, CM_weights, LOC_weights,
-        IU_weights, KU_weights, lmbda, N)
-    matte = self.solver(A, b)
+    # One system per sample, images may be padded to the largest in the batch
+    systems = []
+    sizes = []
+    orderings = []
+    guesses = []
+    single_samples = []
+    assembly_times = []
+    for i in range(bs):
+      hi, wi = _sample_size(sample, i, h, w)
+      N = hi*wi
+      single_sample = _select_sample(sample, i, hi, wi, weights)
+      sample_weights = weights[i, :, :hi, :wi].contiguous().view(4, N)
+
+      CM_weights  = sample_weights[0, :]
+      LOC_weights = sample_weights[1, :]
+      IU_weights  = sample_weights[2, :]
+      KU_weights  = sample_weights[3, :]
+      # lmbda       = sample_weights[4, :]
+
+      start = time.time()
+      A, b = self.system(
+          single_sample, CM_weights, LOC_weights,
+          IU_weights, KU_weights, lmbda, N)
+      A, b, ordering = self.system.reorder(A, b, hi, wi)
+      assembly_times.append(time.time() - start)
+      x0 = self.solver.initial_guess(single_sample, hi, wi)
+      if x0 is not None:
+        x0 = x0.type_as(b)
+        if ordering is not None:
+          x0 = ordering.vector(x0)
+      systems.append((A, b))
+      sizes.append((hi, wi))
+      orderings.append(ordering)
+      guesses.append(x0)
+      single_samples.append(single_sample)
+
+    if bs == 1:
+      A, b = systems[0]
+      mattes = [self.solver(A, b, sizes, orderings, guesses[0])]
+    else:
+      mattes = self.solver.solve_many(systems, sizes, orderings, guesses)
     residual = self.solver.err
-    matte = matte.view(1, 1, h, w)
+    for record, (hi, wi), t in zip(self.solver.records, sizes,
+                                   assembly_times):
+      record["shape"] = [hi, wi]
+      record["assembly_time"] = t
+      if self.sink is not None:
+        self.sink.write(record)
+
+    for i, (hi, wi) in enumerate(sizes):
+      if orderings[i] is not None:
+        mattes[i] = orderings[i].restore(mattes[i])
+      self.solver.remember(single_samples[i], hi, wi, mattes[i])
+      mattes[i] = mattes[i].contiguous().view(1, 1, hi, wi)
+      if (hi, wi) != (h, w):
+        mattes[i] = F.pad(mattes[i], (0, w-wi, 0, h-hi))
+    matte = th.cat(mattes, 0)
     matte = th.clamp(matte, 0, 1)
-    log.info("CG residual: {:.1f} in {} steps".format(residual, self.solver.stop_step))
-    if residual < 0:
-      import ipdb; ipdb.set_trace()
+    log.info("CG residual: {:.1f} in {} steps, from {:.1f}".format(
+      residual, self.solver.stop_step, max(self.solver.init_errs)))
 
     return matte
 
 
+def _sample_size(sample, i, h, w):
+  """Unpadded (height, width) of the i-th sample of a batch."""
+  if 'height' not in sample or 'width' not in sample:
+    return h, w
+  def _int(x):
+    if isinstance(x, Variable):
+      x = x.data
+    if th.is_tensor(x):
+      return int(x.view(-1)[i])
+    return int(x[i])
+  return _int(sample['height']), _int(sample['width'])
+
+
+def _select_sample(sample, i, h, w, ref):
+  """The i-th sample of a batch, with images cropped to h x w.
+
+  Per-sample data of varying size comes as lists (see
+  dataset.collate_samples), their tensors are wrapped on `ref`'s device.
+  """
+  padded = tuple(sample['image'].shape[2:])
+  single_sample = {}
+  for k in sample.keys():
+    v = sample[k]
+    if isinstance(v, (list, tuple)):
+      v = v[i]
+      if th.is_tensor(v):
+        v = Variable(_like(v, ref))
+      single_sample[k] = v
+    elif isinstance(v, Variable):
+      v = v[i, ...]
+      if v.dim() == 3 and tuple(v.shape[1:]) == padded and padded != (h, w):
+        v = v[:, :h, :w].contiguous()
+      single_sample[k] = v
+  return single_sample
+
+
 class MattingSolver(nn.Module):
-  def __init__(self, steps=30, verbose=False):
+  """Solves the matting systems with (preconditioned) conjugate gradient.
+
+  Args:
+    precond: None, "jacobi", "block_jacobi", "ic0" or "multigrid", see
+      optim.PRECONDITIONERS. Built from A for every solve.
+    block_size: unknowns per block of the "block_jacobi" preconditioner.
+    smoother: "jacobi" or "chebyshev", smoother of the "multigrid"
+      preconditioner, which needs the image sizes of the systems.
+    init: initial guess of CG, "zeros", "kToU" (the known-to-unknown
+      estimate of the sample), "vanilla" (the IFM matte) or "cache" (the
+      last solution of the sample, kToU on a miss), see initial_guess.
+      Gradients flow through the CG steps only: a guess that is already
+      under the threshold gives none to the weights.
+    cache_mb: size of the cache of solutions of the "cache" init.
+    backward: "unrolled" backpropagates through the CG iterations, which
+      keeps every step's vectors. "implicit" solves the adjoint system with
+      a second CG instead (optim.ImplicitCG), in O(nnz) memory, A must then
+      be assembled.
+    check_every: steps between two reads of the residuals on the host to
+      stop CG, 0 runs all the steps without reading them (see
+      optim.sparse_cg). The residuals of each step are read once the solve
+      is done, into `history` (empty with the implicit backward).
+    krylov: the solver, "cg", "chebyshev", "pipelined_cg" or "minres",
+      see optim.SOLVERS. The batches of solve_many run in lock-step with
+      "cg", stacked in a block diagonal system otherwise.
+    precision: "single" runs CG in float32. "mixed" refines float32 CG
+      solves in float64 (optim.refined_cg) until the residual is under
+      `refine_thresh`, in at most `refinements` solves of `steps` steps;
+      it needs the implicit backward. The matte is still rounded to
+      float32 and the reported residual is that of the rounded matte,
+      which cannot go much below 1e-7 relative to |A|.|x|.
+    checkpoint: with k > 0, the unrolled backward only keeps the CG state
+      every k steps and recomputes the steps in between (see
+      optim.sparse_cg), for the same gradients in O(steps/k + k) memory.
+      It needs plain single precision CG and no preconditioner; the
+      systems of solve_many are then solved one at a time.
+    thresh: residual under which CG stops (`refine_thresh` with mixed
+      precision).
+
+  Each solve leaves one telemetry record per system in `records`, a dict
+  of plain values (see _record) with the residual of each step (of each
+  refinement with mixed precision), the solve time and why the solve
+  stopped (telemetry.reason). Stalled, diverged or non-finite solves are
+  logged as warnings.
+  """
+  INITS = ["zeros", "kToU", "vanilla", "cache"]
+  BACKWARDS = ["unrolled", "implicit"]
+  PRECISIONS = ["single", "mixed"]
+
+  def __init__(self, steps=30, verbose=False, precond=None, block_size=8,
+               smoother="jacobi", init="zeros", cache_mb=256,
+               backward="unrolled", check_every=1, precision="single",
+               refinements=10, refine_thresh=1e-6, krylov="cg",
+               checkpoint=0, thresh=1e-4):
     self.steps = steps
+    self.thresh = thresh
+    self.check_every = check_every
     self.verbose = verbose
+    if precond is not None and precond not in optim.PRECONDITIONERS:
+      raise ValueError("Unknown preconditioner {}, should be one of {}".format(
+        precond, sorted(optim.PRECONDITIONERS.keys())))
+    self.precond = precond
+    self.block_size = block_size
+    self.smoother = smoother
+    if init not in MattingSolver.INITS:
+      raise ValueError("Unknown initial guess {}, should be one of {}".format(
+        init, MattingSolver.INITS))
+    self.init = init
+    self.cache = SolutionCache(cache_mb*2**20) if init == "cache" else None
+    if backward not in MattingSolver.BACKWARDS:
+      raise ValueError("Unknown backward {}, should be one of {}".format(
+        backward, MattingSolver.BACKWARDS))
+    self.backward = backward
+    if precision not in MattingSolver.PRECISIONS:
+      raise ValueError("Unknown precision {}, should be one of {}".format(
+        precision, MattingSolver.PRECISIONS))
+    if precision == "mixed" and backward != "implicit":
+      raise ValueError("Mixed precision solves need the implicit backward.")
+    self.precision = precision
+    if krylov not in optim.SOLVERS:
+      raise ValueError("Unknown solver {}, should be one of {}".format(
+        krylov, sorted(optim.SOLVERS.keys())))
+    self.krylov = krylov
+    if checkpoint > 0 and (backward != "unrolled" or krylov != "cg" or
+                           precision != "single" or precond is not None):
+      raise ValueError("Checkpointing needs unrolled single precision CG "
+                       "without a preconditioner.")
+    self.checkpoint = checkpoint
+    self.refinements = refinements
+    self.refine_thresh = refine_thresh
+    self.implicit = None
+    self.records = []
     super(MattingSolver, self).__init__()
 
-  def forward(self, A, b):
+  def initial_guess(self, sample, h, w):
+    """Initial guess for the system of an h x w sample, in pixel order.
+
+    None stands for zeros. The cache is keyed on the sample's "name" and
+    size, samples without a name are never cached.
+    """
+    N = h*w
+    if self.init == "cache":
+      x = self.cache.get(_solution_key(sample, h, w))
+      if x is not None:
+        return Variable(_like(x, sample['kToU']))
+    if self.init in ["kToU", "cache"]:
+      return sample['kToU'].contiguous().view(N)
+    if self.init == "vanilla":
+      return sample['vanilla'].contiguous().view(N)
+    return None
+
+  def remember(self, sample, h, w, x):
+    """Stores the solution x of the system of an h x w sample (pixel order)."""
+    if self.cache is None:
+      return
+    key = _solution_key(sample, h, w)
+    if key is not None:
+      self.cache.put(key, x.data)
+
+  def _preconditioner(self, A, shapes, orderings):
+    if self.precond == "block_jacobi":
+      return optim.preconditioner(self.precond, A, block_size=self.block_size)
+    if self.precond == "multigrid":
+      if shapes is None:
+        raise ValueError("The multigrid preconditioner needs the image sizes.")
+      return optim.preconditioner(self.precond, A, shapes=shapes,
+                                  orderings=orderings, smoother=self.smoother)
+    return optim.preconditioner(self.precond, A)
+
+  def forward(self, A, b, shapes=None, orderings=None, x0=None):
+    """Solves A.x = b, from x0 (zeros when None).
+
+    `shapes` are the (h, w) of the images of the systems (one per block of
+    a block diagonal A) and `orderings` their orderings (see
+    MattingSystem.reorder), only used by the "multigrid" preconditioner.
+    """
     start = time.time()
-    x0 = Variable(th.zeros(b.shape[0]).cuda(), requires_grad=False)
-    x_opt, err, stop_step = optim.sparse_cg(A, b, x0, steps=self.steps, verbose=self.verbose)
+    if x0 is None:
+      x0 = Variable(b.data.new(b.size()).zero_(), requires_grad=False)
+    self.init_errs = _residuals(A, b, x0)
+    history = []
+    if self.backward == "implicit":
+      if not isinstance(A, sp.Sparse):
+        raise ValueError("The implicit backward needs an assembled system.")
+      precond = self._preconditioner(sp.detach(A), shapes, orderings)
+      if self.precision == "mixed":
+        self.implicit = optim.ImplicitCG(
+            steps=self.steps, thresh=self.refine_thresh, verbose=self.verbose,
+            check_every=self.check_every, refinements=self.refinements,
+            krylov=self.krylov)
+      else:
+        self.implicit = optim.ImplicitCG(
+            steps=self.steps, thresh=self.thresh, verbose=self.verbose,
+            check_every=self.check_every, krylov=self.krylov)
+      x_opt, errs, stop_steps = self.implicit(A, b, x0, precond)
+      history = self.implicit.history
+    elif self.checkpoint > 0:
+      x_opt, err, stop_step = optim.sparse_cg(
+          A, b, x0, steps=self.steps, thresh=self.thresh, verbose=self.verbose,
+          check_every=self.check_every, history=history,
+          checkpoint=self.checkpoint)
+      errs, stop_steps = [err], [stop_step]
+    else:
+      # one system per block of A, or per column of b
+      x_opt, errs, stop_steps = optim.solve(
+          self.krylov, A, b, x0, steps=self.steps, thresh=self.thresh,
+          verbose=self.verbose,
+          precond=self._preconditioner(A, shapes, orderings),
+          check_every=self.check_every, history=history)
+    err = max(errs)
+    stop_step = max(stop_steps)
     end = time.time()
     if self.verbose:
       log.debug("solve system {:.2f}s".format((end-start)))
     self.err = err
     self.stop_step = stop_step
+    self.errs = errs
+    self.stop_steps = stop_steps
+    self.history = history
+    self.records = self._records(_system_stats(A), history, end - start)
     return x_opt
 
+  def solve_many(self, systems, shapes, orderings=None, x0s=None):
+    """Solves a list of independent (A, b) systems, returns their solutions.
+
+    The systems run in lock-step (optim.sparse_cg_many), each drops out
+    once converged. With the implicit backward or another solver than
+    "cg", they are stacked in a sp.block_diag and solved at once by
+    `forward`; with checkpointing, one at a time. `shapes`, `orderings`
+    and the initial guesses `x0s` (None for zeros) are per system.
+    """
+    n = len(systems)
+    if orderings is None:
+      orderings = [None]*n
+    if x0s is None:
+      x0s = [None]*n
+    x0s = [Variable(b.data.new(b.size()).zero_()) if x0 is None else x0
+           for x0, (_, b) in zip(x0s, systems)]
+    if (self.backward == "implicit" or self.krylov != "cg" or
+        self.checkpoint > 0):
+      if (self.checkpoint == 0 and
+          all(isinstance(A, sp.Sparse) for A, _ in systems)):
+        A = sp.block_diag([A for A, _ in systems])
+        b = th.cat([b for _, b in systems], 0)
+        return A.split(self(A, b, shapes, orderings, th.cat(x0s, 0)))
+      # matrix-free or checkpointed systems, one at a time
+      xs, solves, records = [], [], []
+      for i, ((A, b), x0) in enumerate(zip(systems, x0s)):
+        xs.append(self(A, b, shapes[i:i+1], orderings[i:i+1], x0))
+        solves.append((self.errs[0], self.stop_steps[0], self.init_errs[0]))
+        records.extend(self.records)
+      self.errs, self.stop_steps, self.init_errs = [
+          list(v) for v in zip(*solves)]
+      self.records = records
+      self.err = max(self.errs)
+      self.stop_step = max(self.stop_steps)
+      return xs
+
+    start = time.time()
+    self.init_errs = [_residuals(A, b, x0)[0]
+                      for (A, b), x0 in zip(systems, x0s)]
+    preconds = [self._preconditioner(A, shapes[i:i+1], orderings[i:i+1])
+                for i, (A, _) in enumerate(systems)]
+    history = []
+    xs, errs, stop_steps = optim.sparse_cg_many(
+        systems, x0s, steps=self.steps, thresh=self.thresh,
+        verbose=self.verbose,
+        preconds=preconds, check_every=self.check_every, history=history)
+    end = time.time()
+    if self.verbose:
+      log.debug("solve {} systems {:.2f}s".format(n, end-start))
+    self.err = max(errs)
+    self.stop_step = max(stop_steps)
+    self.errs = errs
+    self.stop_steps = stop_steps
+    self.history = history
+    self.records = self._records(
+        [_system_stats(A)[0] for A, _ in systems], history, end - start)
+    return xs
+
+  def _record(self, i, size, nnz, history, solve_time, batch):
+    """Telemetry record of the i-th system of the last solve.
+
+    `size` and `nnz` describe its matrix, `history` holds the residuals of
+    all the systems and `solve_time` is the wall time of the `batch`
+    systems solved together.
+    """
+    thresh = self.refine_thresh if self.precision == "mixed" else self.thresh
+    residuals = [row[i] if isinstance(row, list) else row for row in history]
+    if self.precision == "single":
+      # systems solved together keep their last residual once stopped
+      residuals = residuals[:self.stop_steps[i]]
+    return {
+      "time": time.time(),
+      "solver": self.krylov,
+      "precond": self.precond,
+      "init": self.init,
+      "backward": self.backward,
+      "precision": self.precision,
+      "size": size,
+      "nnz": nnz,
+      "batch": batch,
+      "max_steps": self.steps,
+      "thresh": thresh,
+      "steps": self.stop_steps[i],
+      "init_residual": self.init_errs[i],
+      "residual": self.errs[i],
+      "residuals": residuals,
+      "solve_time": solve_time,
+      "reason": telemetry.reason(residuals, self.errs[i], self.init_errs[i],
+                                 thresh),
+    }
+
+  def _records(self, stats, history, solve_time):
+    """Records of each system of the last solve, `stats` are their (size,
+    nnz), columns of b share those of A."""
+    if len(stats) < len(self.errs):
+      stats = stats*len(self.errs)
+    records = []
+    for i, (size, nnz) in enumerate(stats):
+      record = self._record(i, size, nnz, history, solve_time, len(stats))
+      if record["reason"] in telemetry.FAILURES:
+        log.warning("CG {} on system {} ({} unknowns): residual {:g} in {} "
+                    "steps, from {:g}".format(
+                      record["reason"], i, size, record["residual"],
+                      record["steps"], record["init_residual"]))
+      records.append(record)
+    return records
+
+
+def _system_stats(A):
+  """(size, nnz) of each system of A, one per block of a sp.BlockDiagonal.
+
+  nnz is None for operators that do not count their nonzeros.
+  """
+  if isinstance(A, sp.BlockDiagonal):
+    row = sp._data(A.csr_row_idx)
+    ends = [int(row[o]) for o in A.offsets + [A.size[0]]]
+    return [(size, end - start) for size, start, end in
+            zip(A.sizes, ends[:-1], ends[1:])]
+  return [(int(A.size[0]), getattr(A, "nnz", None))]
+
+
+def _residuals(A, b, x):
+  """|b - A.x| of each system (block of A, or column of b), a list."""
+  r = (b - sp.spmm_dense(A, x)).data
+  if r.dim() == 2:
+    rr = (r*r).sum(0)
+  elif isinstance(A, sp.BlockDiagonal):
+    rr = r.new(A.nblocks).zero_().index_add_(0, A.segments, r*r)
+  else:
+    rr = (r*r).view(1, -1).sum(1)
+  return [float(e) for e in rr.sqrt().cpu().numpy()]
+
+
+def _pattern_key(sample, *term):
+  """Key of the pattern of an IFM matrix of a sample (see sp.from_coo).
+
+  The indices of a sample only depend on its file: samples are keyed on
+  their "name", samples without one are hashed instead (None).
+  """
+  if 'name' not in sample:
+    return None
+  return ("ifm", sample['name']) + term
+
+
+def _solution_key(sample, h, w):
+  if 'name' not in sample:
+    return None
+  return (sample['name'], h, w)
+
+
+class SolutionCache(object):
+  """LRU cache of the last solution of each sample, kept on the host.
+
+  Evicts the least recently used solutions once they take more than
+  `capacity` bytes.
+  """
+  def __init__(self, capacity=256*2**20):
+    self.capacity = capacity
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._solutions = OrderedDict()
+
+  def get(self, key):
+    """Solution stored under `key`, None on a miss."""
+    x = self._solutions.pop(key, None)
+    if x is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._solutions[key] = x
+    return x
+
+  def put(self, key, x):
+    old = self._solutions.pop(key, None)
+    if old is not None:
+      self.nbytes -= 4*old.numel()
+    x = x.cpu().float().clone()
+    self._solutions[key] = x
+    self.nbytes += 4*x.numel()
+    while self.nbytes > self.capacity and self._solutions:
+      _, old = self._solutions.popitem(last=False)
+      self.nbytes -= 4*old.numel()
+
+  def clear(self):
+    self._solutions.clear()
+    self.nbytes = 0
+
+  def __len__(self):
+    return len(self._solutions)
+
 
 class MattingSystem(nn.Module):
-  """docstring for MattingSystem"""
-  def __init__(self):
+  """Builds the sparse linear system A.alpha = b of a sample.
+
+  Args:
+    reorder: None, "rcm" (reverse Cuthill-McKee) or "tiles", optional
+      symmetric reordering of the system applied by `reorder`.
+    tile_size: side of the tiles of the "tiles" ordering.
+    matrix_free_loc: apply the local matting Laplacian from the windows'
+      flows (sp.LocalLaplacian) instead of assembling it, A is then a
+      sp.OperatorSum.
+  """
+  REORDERINGS = [None, "rcm", "tiles"]
+
+  def __init__(self, reorder=None, tile_size=32, matrix_free_loc=False):
     super(MattingSystem, self).__init__()
-    
+    if reorder not in MattingSystem.REORDERINGS:
+      raise ValueError("Unknown reordering {}, should be one of {}".format(
+        reorder, MattingSystem.REORDERINGS))
+    if reorder is not None and matrix_free_loc:
+      raise ValueError("Reordering needs an assembled system, "
+                       "it cannot be combined with matrix_free_loc.")
+    self.matrix_free_loc = matrix_free_loc
+    self.reorder_method = reorder
+    self.tile_size = tile_size
+
+  def reorder(self, A, b, h, w):
+    """Permutes the system of an h x w image to improve memory locality.
+
+    Returns (A, b, ordering), the solution of the permuted system maps back
+    to pixel order with `ordering.restore`. ordering is None when the
+    system is left as is. Orderings are cached on A's pattern (or the image
+    size for tiles), so a sample is only analyzed once.
+    """
+    if self.reorder_method is None:
+      return A, b, None
+    start = time.time()
+    if self.reorder_method == "rcm":
+      ordering = sp.rcm_ordering(A)
+    else:
+      ordering = sp.tile_ordering(h, w, self.tile_size, b)
+    A = sp.permute(A, ordering)
+    b = ordering.vector(b)
+    end = time.time()
+    log.debug("reorder system {:.2f}s/im".format((end-start)))
+    return A, b, ordering
+
   def forward(self, sample, CM_weights, LOC_weights, IU_weights, KU_weights, lmbda, N):
     start = time.time()
     Lcm = self._color_mixture(N, sample, CM_weights)
@@ -140,16 +632,15 @@ class MattingSystem(nn.Module):
     known = sample['known']
     kToU = sample['kToU']
 
-    linear_idx = Variable(th.from_numpy(np.arange(N, dtype=np.int32)).cuda())
-    linear_csr_row_idx = Variable(th.from_numpy(np.arange(N+1, dtype=np.int32)).cuda())
-
-    KU = sp.Sparse(linear_csr_row_idx, linear_idx, KU_weights.mul(kToUconf), th.Size((N,N)))
-    known = sp.Sparse(linear_csr_row_idx, linear_idx, lmbda.mul(known), th.Size((N,N)))
+    KU = sp.Diagonal(KU_weights.mul(kToUconf))
+    known = sp.Diagonal(lmbda.mul(known))
+    data_term = sp.spadd(KU, known)
 
-    # A = sp.spadd(Lmat, sp.spadd(KU, known))
-    # A = sp.spadd(Lcm, sp.spadd(sp.spadd(KU, known), Lcs))
-    A = sp.spadd(Lcm, sp.spadd(Lmat, sp.spadd(sp.spadd(KU, known), Lcs)))
-    b = sp.spmv(sp.spadd(KU, known), kToU)
+    if isinstance(Lmat, sp.MatrixFree):
+      A = sp.OperatorSum([sp.spadd_many([Lcm, data_term, Lcs]), Lmat])
+    else:
+      A = sp.spadd_many([Lcm, Lmat, data_term, Lcs])
+    b = sp.spmv(data_term, kToU)
 
     end = time.time()
     log.debug("prepare system {:.2f}s/im".format((end-start)))
@@ -158,27 +649,23 @@ class MattingSystem(nn.Module):
 
   def _color_mixture(self, N, sample, CM_weights):
     # CM
-    linear_idx = Variable(th.from_numpy(np.arange(N, dtype=np.int32)).cuda())
-    linear_csr_row_idx = Variable(th.from_numpy(np.arange(N+1, dtype=np.int32)).cuda())
-
     Wcm = sp.from_coo(sample["Wcm_row"], sample["Wcm_col"].view(-1),
-                      sample["Wcm_data"], th.Size((N, N)))
-
-    diag = sp.Sparse(linear_csr_row_idx, linear_idx, CM_weights, th.Size((N, N)))
-    Wcm = sp.spmm(diag, Wcm)
-    ones = Variable(th.ones(N).cuda())
-    row_sum = sp.spmv(Wcm, ones)
-    Wcm.mul_(-1.0)
-    Lcm = sp.spadd(sp.from_coo(linear_idx, linear_idx, row_sum.data, th.Size((N, N))), Wcm)
-    Lcmt = sp.transpose(Lcm)
-    Lcm = sp.spmm(Lcmt, Lcm)
+                      sample["Wcm_data"], th.Size((N, N)),
+                      pattern_key=_pattern_key(sample, "Wcm"))
+    Wcm = sp.spmm(sp.Diagonal(CM_weights), Wcm)
+    Lcm = sp.sp_gram(sp.sp_laplacian(Wcm))
     return Lcm
 
-  def _matting_laplacian(self, N, sample, LOC_weights):
-    linear_idx = Variable(th.from_numpy(np.arange(N, dtype=np.int32)).cuda())
-
+  def _loc_neighbors(self, sample):
+    """Linear indices of the 3x3 window around each LOC_inInd pixel."""
     w = sample['image'].shape[-1]
-    h = sample['image'].shape[-2]
+    inInd = sample["LOC_inInd"]
+    return th.cat(
+        [inInd-1-w, inInd-1, inInd-1+w, inInd-w, inInd, inInd+w, inInd+1-w, inInd+1, inInd+1+w], 1)
+
+  def _matting_laplacian(self, N, sample, LOC_weights):
+    if self.matrix_free_loc:
+      return self._matting_laplacian_operator(N, sample, LOC_weights)
 
     # Matting Laplacian
     inInd = sample["LOC_inInd"]
@@ -188,30 +675,29 @@ class MattingSystem(nn.Module):
     tiled_weights = weights.view(1, 1, -1).repeat(flow_sz, flow_sz, 1)
     flows = flows.mul(tiled_weights)
 
-    neighInds = th.cat(
-        [inInd-1-w, inInd-1, inInd-1+w, inInd-w, inInd, inInd+w, inInd+1-w, inInd+1, inInd+1+w], 1)
+    neighInds = self._loc_neighbors(sample)
 
+    iWmats = []
     for i in range(9):
       iRows = neighInds[:, i:i+1].clone().repeat(1, 9)
       iFlows = flows[:, i, :].contiguous().permute(1, 0).clone()
-      iWmat = sp.from_coo(iRows.view(-1), neighInds.view(-1), iFlows.view(-1), th.Size((N, N)))
-      if i == 0:
-        Wmat = iWmat
-      else:
-        Wmat = sp.spadd(Wmat, iWmat)
-
-    Wmatt = sp.transpose(Wmat)
-    Wmat = sp.spadd(Wmat, Wmatt)
-    Wmat.mul_(0.5)
-    ones = Variable(th.ones(N).cuda())
-    row_sum = sp.spmv(Wmat, ones)
-    Wmat.mul_(-1.0)
-    diag = sp.from_coo(linear_idx, linear_idx, row_sum, th.Size((N, N)))
-    Lmat = sp.spadd(diag, Wmat)
+      iWmats.append(sp.from_coo(
+          iRows.view(-1), neighInds.view(-1), iFlows.view(-1), th.Size((N, N)),
+          pattern_key=_pattern_key(sample, "LOC", i)))
+    Wmat = sp.spadd_many(iWmats)
+    Lmat = sp.sp_laplacian(Wmat, symmetrize=True)
     return Lmat
 
+  def _matting_laplacian_operator(self, N, sample, LOC_weights):
+    """Matrix-free version of _matting_laplacian."""
+    inInd = sample["LOC_inInd"]
+    weights = LOC_weights[inInd.long().view(-1)]
+    return sp.LocalLaplacian(
+        self._loc_neighbors(sample), sample['LOC_flows'], weights,
+        th.Size((N, N)))
+
   def _matting_laplacian_verbose(self, N, sample, LOC_weights):
-    linear_idx = Variable(th.from_numpy(np.arange(N, dtype=np.int32)).cuda())
+    linear_idx = Variable(_like(th.from_numpy(np.arange(N, dtype=np.int32)), LOC_weights))
 
     w = sample['image'].shape[-1]
     h = sample['image'].shape[-2]
@@ -310,10 +796,11 @@ class MattingSystem(nn.Module):
     Wmat_transp = sp.transpose(Wmat)
     Wmat = sp.spadd(Wmat, Wmat_transp)
     Wmat.val *= (0.5)
-    ones = Variable(th.ones(N).cuda())
+    ones = Variable(LOC_weights.data.new(N).fill_(1.0))
     row_sum = sp.spmv(Wmat, ones)
     Wmat.mul_(-1.0)
-    diag = sp.from_coo(linear_idx, linear_idx, row_sum, th.Size((N, N)))
+    diag = sp.from_coo(linear_idx, linear_idx, row_sum, th.Size((N, N)),
+                       pattern_key=("diagonal",))
     Lmat = sp.spadd(diag, Wmat)
 
     # import ipdb; ipdb.set_trace()
@@ -321,8 +808,6 @@ class MattingSystem(nn.Module):
     return Lmat
 
   def _intra_unknowns(self, N, sample, IU_weights):
-    linear_idx = Variable(th.from_numpy(np.arange(N, dtype=np.int32)).cuda())
-
     weights = IU_weights[sample["IU_inInd"].long().view(-1)]
     nweights = weights.numel()
     flows = sample['IU_flows']
@@ -331,15 +816,9 @@ class MattingSystem(nn.Module):
     neighInd = sample["IU_neighInd"].contiguous()
     inInd = sample["IU_inInd"].clone()
     inInd = inInd.repeat(1, neighInd.shape[1])
-    Wcs = sp.from_coo(inInd.view(-1), neighInd.view(-1), flows.data.view(-1), th.Size((N, N)))
-    Wcst = sp.transpose(Wcs)
-    Wcs = sp.spadd(Wcs, Wcst)
-    Wcs.mul_(0.5)
-    ones = Variable(th.ones(N).cuda())
-    row_sum = sp.spmv(Wcs, ones)
-    Wcs.mul_(-1)
-    diag = sp.from_coo(linear_idx, linear_idx, row_sum.data, th.Size((N, N)))
-    Lcs = sp.spadd(diag, Wcs)
+    Wcs = sp.from_coo(inInd.view(-1), neighInd.view(-1), flows.data.view(-1),
+                      th.Size((N, N)), pattern_key=_pattern_key(sample, "IU"))
+    Lcs = sp.sp_laplacian(Wcs, symmetrize=True)
     return Lcs
 
 
@@ -1,57 +1,1362 @@
 import logging
+import math
 
+import numpy as np
 import torch as th
+from torch.autograd import Variable
 
 import matting.sparse as sp
+import matting.functions.sparse as spfuncs
+import matting.functions.sparse_cpu as spcpu
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
-def cg(A, b, x0, steps=1, thresh=1e-5, verbose=False):
-  r = b - A.matmul(x0)
-  p = r.clone()
+def cg(A, b, x0, steps=1, thresh=1e-5, verbose=False, check_every=1):
+  """Conjugate gradient on A.x = b for A a sp.LinearOperator or dense matrix.
+
+  solve("cg") on sp.aslinearoperator(A), returns x and its residual.
+  """
+  x, errs, _ = solve("cg", sp.aslinearoperator(A), b, x0, steps=steps,
+                     thresh=thresh, verbose=verbose, check_every=check_every)
+  return x, errs[0]
+
+
+def sparse_cg(A, b, x0, steps=1, thresh=1e-4, verbose=False, precond=None,
+              check_every=1, history=None, checkpoint=0):
+  """Conjugate gradient on A.x = b, A sparse and symmetric positive definite.
+
+  Each step is one fused spmv+dot pass, one fused x/r update that also
+  returns the new residual norm and one direction update. Without autograd,
+  the vectors are updated in place, otherwise the fused steps are autograd
+  Functions that keep only the step vectors for the backward pass.
+
+  `precond` (see JacobiPreconditioner) turns it into preconditioned CG,
+  the residual reported and compared to `thresh` is still |b - A.x|.
+
+  The residuals stay on the device and the host reads them every
+  `check_every` steps to stop (never with 0: a fixed number of steps). In
+  between, a solve under `thresh` is frozen on the device, x and the
+  reported step count are those of a check at every step. A `history`
+  list gets the residual of each step, read once at the end.
+
+  With `checkpoint` k > 0, autograd only keeps the state every k steps and
+  the backward pass recomputes the steps in between (_CheckpointedCG):
+  O(steps/k + k) vectors instead of O(steps), for one more forward pass.
+  It needs an assembled A and no preconditioner.
+  """
+  if (precond is None and isinstance(A, sp.Sparse) and
+      not _needs_grad(A.val, b, x0)):
+    x, err, k = _sparse_cg_inplace(A, b, x0, steps, thresh, verbose,
+                                   check_every, history)
+    return Variable(x), err, k
+  if checkpoint > 0 and (precond is not None or not isinstance(A, sp.Sparse)):
+    raise ValueError("Checkpointed CG needs an assembled matrix and no "
+                     "preconditioner.")
+
+  r = b - sp.spmv(A, x0)
   x = x0.clone()
-  res_old = r.dot(r)
-  err = -1
+  rr = r.dot(r)
+  if precond is None:
+    z = r
+    res_old = rr
+  else:
+    z = precond.apply(r)
+    res_old = r.dot(z)
+  p = z.clone()
+  freeze = check_every != 1
+  if checkpoint > 0:
+    run = _CheckpointedCG(A, steps, thresh, verbose, check_every, checkpoint)
+    x = spfuncs.Checkpoint.apply(A.val, run, x, r, p, rr)
+    err, stop = _stop_step(run.rrs, run.ran, thresh, history)
+    if verbose and err < thresh:
+      log.info("CG converged with residual {}.".format(err))
+    return x, err, stop
+  rrs = r.data.new(max(steps, 1)).zero_()
+  k = -1
 
   for k in range(steps):
-    Ap = A.matmul(p)
-    alpha = res_old / p.dot(Ap)
-    x = x +  alpha*p
-    r = r - alpha*Ap
-    res_new = r.dot(r)
-    err = th.sqrt(res_new).data[0]
-    if (err < thresh):
+    x, r, rr, mask = _cg_update(A, x, r, p, rr, res_old, thresh, freeze)
+    rrs.narrow(0, k, 1).copy_(rr.data.view(1))
+    if _checks(k+1, check_every):
+      err = math.sqrt(rrs[k])
+      if (err < thresh):
+        break
       if verbose:
-        log.info("CG converged with residual {}.".format(err))
+        log.info("CG step {} / {}, residual = {:g}".format(k+1, steps, err))
+    if precond is None:
+      z = r
+      res_new = rr
+    else:
+      z = precond.apply(r)
+      res_new = r.dot(z)
+    p = _cg_direction(z, p, res_new, res_old, mask)
+    res_old = res_new
+  err, stop = _stop_step(rrs, k+1, thresh, history)
+  if verbose and err < thresh:
+    log.info("CG converged with residual {}.".format(err))
+  return x, err, stop
+
+
+def _cg_update(A, x, r, p, rr, res_old, thresh, freeze):
+  """x, r and |r|^2 after an unrolled step of sparse_cg, and its freeze mask.
+
+  The mask is None without freezing.
+  """
+  Ap, pAp = sp.spmv_dot(A, p)
+  if not freeze:
+    x, r, rr = spfuncs.CGUpdate.apply(x, r, p, Ap, res_old, pAp)
+    return x, r, rr, None
+  mask = _active(rr, thresh)
+  x, r, rr = spfuncs.CGUpdate.apply(x, r, p, Ap, mask*res_old,
+                                    pAp + (1 - mask))
+  return x, r, rr, mask
+
+
+def _cg_direction(z, p, res_new, res_old, mask):
+  """Next direction of an unrolled step of sparse_cg."""
+  if mask is None:
+    return spfuncs.CGDirection.apply(z, p, res_new, res_old)
+  return spfuncs.CGDirection.apply(z, p, mask*res_new, res_old + (1 - mask))
+
+
+class _CheckpointedCG(object):
+  """Unrolled steps of sparse_cg (no preconditioner), for spfuncs.Checkpoint.
+
+  The forward pass runs the steps without a graph and keeps the state
+  (x, r, p, |r|^2) every `every` steps. The backward pass recomputes the
+  steps from the last kept state to the end, backpropagates through them,
+  and goes on with the state before. Each recomputed step reads A's values
+  through its own spfuncs.Tap, which adds their gradient into a single
+  buffer as it arrives: one nnz-sized gradient is live at a time, and they
+  are summed last step first, in the order autograd sums them for a full
+  unroll, so the gradients are the same to the bit.
+  """
+  def __init__(self, A, steps, thresh, verbose, check_every, every):
+    self.A = A
+    self.steps = steps
+    self.thresh = thresh
+    self.verbose = verbose
+    self.check_every = check_every
+    self.freeze = check_every != 1
+    self.every = every
+
+  def _steps(self, val, state, start, stop):
+    """State after steps start..stop-1, the last one without its direction
+    when the solve stopped there."""
+    x, r, p, rr = state
+    for k in range(start, stop):
+      A = sp.with_values(self.A, spfuncs.Tap.apply(val, self._accumulate))
+      x, r, rr_new, mask = _cg_update(A, x, r, p, rr, rr, self.thresh,
+                                      self.freeze)
+      if k + 1 == self.ran and self.converged:
+        return x, r, p, rr_new
+      p = _cg_direction(r, p, rr_new, rr, mask)
+      rr = rr_new
+    return x, r, p, rr
+
+  def forward(self, val, state):
+    self.val = val
+    x, r, p, rr = [Variable(t) for t in state]
+    A = sp.with_values(self.A, Variable(val))
+    self.rrs = val.new(max(self.steps, 1)).zero_()
+    self.checkpoints = []
+    self.converged = False
+    k = -1
+    for k in range(self.steps):
+      if k % self.every == 0:
+        self.checkpoints.append((k, [x.data, r.data, p.data, rr.data]))
+      x, r, rr_new, mask = _cg_update(A, x, r, p, rr, rr, self.thresh,
+                                      self.freeze)
+      self.rrs.narrow(0, k, 1).copy_(rr_new.data.view(1))
+      if _checks(k+1, self.check_every):
+        err = math.sqrt(self.rrs[k])
+        if (err < self.thresh):
+          self.converged = True
+          break
+        if self.verbose:
+          log.info("CG step {} / {}, residual = {:g}".format(
+            k+1, self.steps, err))
+      p = _cg_direction(r, p, rr_new, rr, mask)
+      rr = rr_new
+    self.ran = k + 1
+    return x.data.clone()
+
+  def _accumulate(self, grad):
+    if self.grad_val is None:
+      self.grad_val = grad.data.clone()
+    else:
+      self.grad_val.add_(grad.data)
+
+  def backward(self, grad_x):
+    grads = [grad_x, None, None, None]
+    val = Variable(self.val, requires_grad=True)
+    self.grad_val = None
+    for start, state in reversed(self.checkpoints):
+      leaves = [Variable(t, requires_grad=True) for t in state]
+      outputs = self._steps(val, leaves, start,
+                            min(start + self.every, self.ran))
+      pairs = [(o, g) for o, g in zip(outputs, grads) if g is not None]
+      th.autograd.backward([o for o, _ in pairs], [g for _, g in pairs])
+      grads = [l.grad for l in leaves]
+    if self.grad_val is None:
+      self.grad_val = self.val.new(self.val.size()).zero_()
+    grad_val, self.grad_val = Variable(self.grad_val), None
+    return grad_val, grads
+
+
+def _checks(k, check_every):
+  """Whether the residuals are read on the host after k steps."""
+  return check_every > 0 and k % check_every == 0
+
+
+def _active(rr, thresh):
+  """1 where the residual norm is still over `thresh`, 0 elsewhere, on device."""
+  return Variable(th.sqrt(sp._data(rr)).ge(thresh).type_as(sp._data(rr)))
+
+
+def _stop_step(rrs, steps, thresh, history):
+  """Residual and step count of a single solve from its squared residuals.
+
+  The solve stopped at the first step under `thresh`, or ran all `steps`.
+  """
+  if steps == 0:
+    return -1, 0
+  norms = np.sqrt(rrs[:steps].cpu().numpy())
+  below = np.nonzero(norms < thresh)[0]
+  stop = below[0] + 1 if below.size > 0 else steps
+  if history is not None:
+    history.extend(float(e) for e in norms[:stop])
+  return float(norms[stop-1]), int(stop)
+
+
+class JacobiPreconditioner(object):
+  """M = diag(A), for Sparse, Diagonal and MatrixFree A.
+
+  M is built from A's values with differentiable ops, gradients flow
+  through the preconditioned iterations.
+  """
+  def __init__(self, A):
+    self.inv_diag = 1.0 / sp.diagonal(A)
+
+  def apply(self, r):
+    """M^-1.r, r is a vector or has one vector per column."""
+    if r.dim() == 2:
+      return self.inv_diag.view(-1, 1)*r
+    return self.inv_diag*r
+
+
+class BlockJacobiPreconditioner(object):
+  """M = the diagonal blocks of `block_size` consecutive unknowns of A.
+
+  With row-major pixels these are horizontal runs of pixels, with the
+  "tiles" reordering of MattingSystem they follow the tiles. A must be
+  assembled. Like JacobiPreconditioner, M is differentiable.
+  """
+  def __init__(self, A, block_size=8):
+    blocks = sp.diagonal_blocks(A, block_size)
+    self.n = A.size[0]
+    self.block_size = block_size
+    self.nblocks = blocks.shape[0]
+    self.inv_blocks = spfuncs.BatchInverse.apply(blocks)
+
+  def apply(self, r):
+    """M^-1.r, r is a vector or has one vector per column."""
+    k = r.shape[1] if r.dim() == 2 else 1
+    r = r.contiguous().view(self.n, k)
+    npad = self.nblocks*self.block_size - self.n
+    if npad > 0:
+      r = th.cat([r, Variable(r.data.new(npad, k).zero_())], 0)
+    z = th.bmm(self.inv_blocks, r.view(self.nblocks, self.block_size, k))
+    z = z.view(-1, k)[:self.n]
+    if k == 1:
+      z = z.contiguous().view(self.n)
+    return z
+
+
+class IncompleteCholeskyPreconditioner(object):
+  """M = L.L^T, the zero fill-in incomplete Cholesky factorization of A.
+
+  L has the pattern of A's lower triangle. Its structure and the level
+  schedules of the triangular solves are cached per pattern (sp.ic0_plan),
+  the factorization and the solves run on the host, level by level (in
+  parallel with the omp engine). If a pivot breaks down, A + shift.diag(A)
+  is factorized instead, with shift growing from `shift`.
+
+  M is a constant for autograd: gradients flow through M^-1.r to r, not to
+  A's values through M. Without _ext.sparse_omp (or on doubles) the
+  factorization and the solves run in numpy one level at a time, and the
+  color neighbours of the matting systems chain most rows together: past
+  `max_levels` levels this raises a RuntimeError instead of crawling.
+  """
+  def __init__(self, A, shift=1e-3, max_shifts=8, max_levels=1000):
+    plan = sp.ic0_plan(A)
+    lower = sp._data(A.val).cpu().index_select(0, plan.source)
+    levels = max(plan.levels[1].numel(), plan.t_levels[1].numel()) - 1
+    if not spcpu._native(lower) and levels > max_levels:
+      raise RuntimeError(
+          "IC(0) of {} rows in {} levels without the omp engine: the numpy "
+          "fallback runs one level at a time. Build _ext.sparse_omp "
+          "(make cpu) or use another preconditioner".format(A.size[0], levels))
+    diag = plan.csr_row_idx[1:].long() - 1
+    current = 0.0
+    for attempt in range(max_shifts+1):
+      val = lower.clone()
+      if current > 0:
+        val.index_copy_(0, diag, val.index_select(0, diag)*(1 + current))
+      if spcpu.ic0(plan.csr_row_idx, plan.col_idx, val, *plan.levels) == 0:
+        break
+      current = shift if current == 0 else 10*current
+    else:
+      raise ValueError("IC(0) broke down, is A positive definite?")
+    if current > 0:
+      log.debug("IC(0) with a diagonal shift of {:g}".format(current))
+    self.shift = current
+    self.plan = plan
+    self.val = val
+    self.t_val = val.index_select(0, plan.t_perm)
+
+  def solve(self, r):
+    """(L.L^T)^-1.r on tensors, r is a vector or has one per column."""
+    if r.dim() == 2:
+      return th.stack([self.solve(r[:, j]) for j in range(r.shape[1])], 1)
+    plan = self.plan
+    y = self.val.new()
+    x = self.val.new()
+    spcpu.sptrsv(plan.csr_row_idx, plan.col_idx, self.val, plan.levels[0],
+                 plan.levels[1], r.cpu().type_as(self.val), y, True)
+    spcpu.sptrsv(plan.t_csr_row_idx, plan.t_col_idx, self.t_val,
+                 plan.t_levels[0], plan.t_levels[1], y, x, False)
+    if r.is_cuda:
+      x = x.cuda(r.get_device())
+    return x.type_as(r)
+
+  def apply(self, r):
+    return spfuncs.SymmetricSolve.apply(r, self.solve)
+
+
+class _Level(object):
+  """A level of the multigrid hierarchy, with its smoother's parameters."""
+  def __init__(self, A, P):
+    self.A = A
+    self.P = P
+    self.Pt = sp.transpose(P)
+    self.inv_diag = 1.0 / sp.diagonal(A)
+    self.lmax = _jacobi_bound(A)
+
+
+def _jacobi_bound(A):
+  """Gershgorin bound on the largest eigenvalue of diag(A)^-1.A, a float."""
+  val = sp._data(A.val)
+  absA = sp.Sparse(A.csr_row_idx, A.col_idx, Variable(val.abs()), A.size,
+                   pattern_key=A.pattern_key)
+  rowsum = sp.spmv(absA, Variable(val.new(A.size[1]).fill_(1))).data
+  return float((rowsum / sp.diagonal(A).data).max())
+
+
+def _scale(d, r):
+  if r.dim() == 2:
+    return d.view(-1, 1)*r
+  return d*r
+
+
+class MultigridPreconditioner(object):
+  """One V-cycle of aggregation multigrid on the image pyramid.
+
+  The unknowns of A are the pixels of images of sizes `shapes` (one per
+  block of a block diagonal A), in the order of their `orderings` when the
+  systems are reordered. Each level aggregates the 2x2 blocks of pixels
+  (sp.pixel_aggregation) and its operator is the Galerkin product P^T.A.P,
+  down to at most `coarse_size` unknowns, solved with a dense inverse.
+
+  The smoothers are `sweeps` steps of damped Jacobi ("jacobi") or a
+  Chebyshev polynomial of degree `sweeps` in diag(A)^-1.A ("chebyshev"),
+  both scaled by a Gershgorin bound of its spectrum. Pre- and
+  post-smoothing are the same, M stays symmetric positive definite. The
+  hierarchy is built with differentiable ops, as for JacobiPreconditioner,
+  the spectral bounds are constants for autograd.
+  """
+  SMOOTHERS = ["jacobi", "chebyshev"]
+
+  def __init__(self, A, shapes, orderings=None, smoother="jacobi", sweeps=2,
+               coarse_size=256, max_levels=12):
+    if not isinstance(A, sp.Sparse):
+      raise ValueError("Multigrid needs an assembled matrix.")
+    if smoother not in MultigridPreconditioner.SMOOTHERS:
+      raise ValueError("Unknown smoother {}, should be one of {}".format(
+        smoother, MultigridPreconditioner.SMOOTHERS))
+    if sum(h*w for h, w in shapes) != A.size[0]:
+      raise ValueError("Multigrid: the images do not match the unknowns.")
+    self.smoother = smoother
+    self.sweeps = sweeps
+    self.levels = []
+    while (A.size[0] > coarse_size and len(self.levels) < max_levels - 1 and
+           any(h*w > 1 for h, w in shapes)):
+      P, shapes = sp.pixel_aggregation(shapes, A.val, orderings)
+      orderings = None
+      level = _Level(A, P)
+      self.levels.append(level)
+      A = sp.spmm(sp.spmm(level.Pt, A), P)
+    self.n_coarse = A.size[0]
+    self.inv_coarse = spfuncs.BatchInverse.apply(
+        sp.diagonal_blocks(A, self.n_coarse))
+
+  def _smooth(self, level, x, b):
+    """Improves x towards A.x = b, from zero when x is None."""
+    if self.smoother == "jacobi":
+      omega = 4.0 / (3.0*level.lmax)
+      for k in range(self.sweeps):
+        r = b if x is None else b - sp.spmm_dense(level.A, x)
+        step = omega*_scale(level.inv_diag, r)
+        x = step if x is None else x + step
+      return x
+    # Chebyshev on [lmax/30, lmax]
+    upper = level.lmax
+    lower = upper / 30.0
+    theta = 0.5*(upper + lower)
+    delta = 0.5*(upper - lower)
+    sigma = theta / delta
+    rho = 1.0 / sigma
+    r = b if x is None else b - sp.spmm_dense(level.A, x)
+    d = _scale(level.inv_diag, r) / theta
+    for k in range(self.sweeps):
+      x = d if x is None else x + d
+      if k == self.sweeps - 1:
+        break
+      r = r - sp.spmm_dense(level.A, d)
+      rho_new = 1.0 / (2.0*sigma - rho)
+      d = rho_new*rho*d + (2.0*rho_new/delta)*_scale(level.inv_diag, r)
+      rho = rho_new
+    return x
+
+  def _cycle(self, depth, b):
+    if depth == len(self.levels):
+      k = b.shape[1] if b.dim() == 2 else 1
+      x = th.bmm(self.inv_coarse, b.contiguous().view(1, self.n_coarse, k))
+      return x.view(b.size())
+    level = self.levels[depth]
+    x = self._smooth(level, None, b)
+    r = b - sp.spmm_dense(level.A, x)
+    x = x + sp.spmm_dense(level.P,
+                          self._cycle(depth+1, sp.spmm_dense(level.Pt, r)))
+    return self._smooth(level, x, b)
+
+  def apply(self, r):
+    """M^-1.r, r is a vector or has one vector per column."""
+    return self._cycle(0, r)
+
+
+PRECONDITIONERS = {
+  "jacobi": JacobiPreconditioner,
+  "block_jacobi": BlockJacobiPreconditioner,
+  "ic0": IncompleteCholeskyPreconditioner,
+  "multigrid": MultigridPreconditioner,
+}
+
+
+def preconditioner(name, A, **kwargs):
+  """Preconditioner `name` (a key of PRECONDITIONERS) of A, None for None."""
+  if name is None:
+    return None
+  if name not in PRECONDITIONERS:
+    raise ValueError("Unknown preconditioner {}, should be one of {}".format(
+      name, sorted(PRECONDITIONERS.keys())))
+  return PRECONDITIONERS[name](A, **kwargs)
+
+
+class _CGSystem(object):
+  """Forward and adjoint CG solves of a constant system, for LinearSolve."""
+  def __init__(self, owner, cg, A, x0, adjoint_x0, precond):
+    self.owner = owner
+    self.cg = cg
+    self.A = A
+    self.x0 = x0
+    self.adjoint_x0 = adjoint_x0
+    self.precond = precond
+
+  def _run(self, rhs, x0, steps, thresh, history):
+    owner = self.owner
+    if x0 is None:
+      x0 = rhs.new(rhs.size()).zero_()
+    if owner.refinements > 0:
+      x, errs, stop_steps = refined_cg(
+          self.A, rhs, sp._data(x0), refinements=owner.refinements,
+          thresh=thresh, steps=steps, inner_thresh=owner.inner_thresh,
+          verbose=owner.verbose, precond=self.precond,
+          check_every=owner.check_every, history=history,
+          krylov=owner.krylov)
+      if x.type() != rhs.type():
+        # report the residual of the rounded x that is returned
+        x = x.type_as(rhs)
+        errs = _residuals(self.A, rhs, x)
+        if history:
+          history[-1] = errs
+      return x, errs, stop_steps
+    x, errs, stop_steps = self.cg(
+        self.A, Variable(rhs), Variable(sp._data(x0)), steps=steps,
+        thresh=thresh, verbose=owner.verbose, precond=self.precond,
+        check_every=owner.check_every, history=history)
+    return x.data, errs, stop_steps
+
+  def solve(self, b):
+    owner = self.owner
+    owner.history = []
+    x, owner.errs, owner.stop_steps = self._run(
+        b, self.x0, owner.steps, owner.thresh, owner.history)
+    return x
+
+  def adjoint(self, g):
+    owner = self.owner
+    owner.adjoint_history = []
+    lmbda, owner.adjoint_errs, owner.adjoint_stop_steps = self._run(
+        g, self.adjoint_x0, owner.adjoint_steps, owner.adjoint_thresh,
+        owner.adjoint_history)
+    owner.last_adjoint = lmbda
+    return lmbda
+
+
+class ImplicitCG(object):
+  """CG on A.x = b, differentiated implicitly (spfuncs.LinearSolve).
+
+  The iterations run outside autograd and the backward pass solves
+  A.lmbda = dL/dx with a second CG, from `adjoint_x0` (zeros when None):
+  memory does not grow with the step count and the backward time follows
+  convergence. A must be assembled and symmetric positive definite, the
+  runs are those of solve_cg, or of the solver `krylov` of SOLVERS.
+  `precond` should be built on sp.detach(A), it is not differentiated.
+
+  Calls return x, the residual of each system and the number of steps
+  each system ran. `check_every` is as in sparse_cg, `history` gets the
+  residuals of each step (see solve_cg). After the backward pass,
+  `adjoint_errs`, `adjoint_stop_steps`, `adjoint_history` and
+  `last_adjoint` describe the adjoint solve.
+
+  With `refinements` > 0, both solves are mixed precision (refined_cg):
+  `steps` and `inner_thresh` bound each float32 correction, `thresh` is
+  the float64 residual to reach and the histories get the residuals after
+  each refinement.
+  """
+  def __init__(self, steps=1, thresh=1e-4, adjoint_steps=None,
+               adjoint_thresh=None, verbose=False, check_every=1,
+               refinements=0, inner_thresh=1e-3, krylov="cg"):
+    if krylov not in SOLVERS:
+      raise ValueError("Unknown solver {}, should be one of {}".format(
+        krylov, sorted(SOLVERS.keys())))
+    self.krylov = krylov
+    self.steps = steps
+    self.check_every = check_every
+    self.refinements = refinements
+    self.inner_thresh = inner_thresh
+    self.history = self.adjoint_history = None
+    self.thresh = thresh
+    self.adjoint_steps = steps if adjoint_steps is None else adjoint_steps
+    self.adjoint_thresh = thresh if adjoint_thresh is None else adjoint_thresh
+    self.verbose = verbose
+    self.errs = self.stop_steps = None
+    self.adjoint_errs = self.adjoint_stop_steps = None
+    self.last_adjoint = None
+
+  def __call__(self, A, b, x0=None, precond=None, adjoint_x0=None):
+    if not isinstance(A, sp.Sparse):
+      raise ValueError("ImplicitCG needs an assembled matrix.")
+    system = _CGSystem(self, SOLVERS[self.krylov], sp.detach(A), x0,
+                       adjoint_x0, precond)
+    x = spfuncs.LinearSolve.apply(A.csr_row_idx, A.col_idx, A.val, b, A.size,
+                                  system)
+    return x, self.errs, self.stop_steps
+
+
+class _DoubleProduct(object):
+  """Products with an assembled A computed in float64.
+
+  The values stay in A's storage type and are converted on the fly, the
+  products gather x by column and sum into rows on any device.
+  """
+  def __init__(self, A):
+    s = A.structure
+    self.rows = s.coo_row_idx.long()
+    self.cols = s.col_idx.long()
+    self.val = sp._data(A.val)
+    self.n = A.size[0]
+
+  def matmul(self, x):
+    val = self.val.double()
+    if x.dim() == 2:
+      val = val.view(-1, 1).expand(val.numel(), x.shape[1])
+    terms = val*x.index_select(0, self.cols)
+    out = x.new(self.n, *x.size()[1:]).zero_()
+    return out.index_add_(0, self.rows, terms)
+
+
+def _system_norms(A, r):
+  """|r| restricted to each system (block of A, or column of r), numpy."""
+  if r.dim() == 2:
+    rr = (r*r).sum(0).view(-1)
+  elif isinstance(A, sp.BlockDiagonal):
+    rr = r.new(A.nblocks).zero_().index_add_(0, A.segments, r*r)
+  else:
+    rr = (r*r).view(1, -1).sum(1)
+  return np.sqrt(rr.cpu().numpy())
+
+
+def _residuals(A, b, x):
+  """Residual of each system of A.x = b computed in float64, a list."""
+  r = b.double() - _DoubleProduct(A).matmul(x.double())
+  return [float(e) for e in _system_norms(A, r)]
+
+
+def refined_cg(A, b, x0=None, refinements=10, thresh=1e-10, steps=1,
+               inner_thresh=1e-3, verbose=False, precond=None, check_every=1,
+               history=None, krylov="cg"):
+  """Mixed-precision CG: float32 solves refined in float64.
+
+  x and the residual b - A.x are kept in float64, each refinement solves
+  A.d = r for a correction with float32 CG on float32 values of A (at most
+  `steps` steps, to `inner_thresh` relative to |r|) and adds it to x. The
+  float32 products read half the bytes of float64 ones, the refinements
+  bring the residual down to `thresh`, far beyond float32 CG.
+
+  A is assembled, the float32 solves run the solver `krylov` of SOLVERS
+  (solve_cg: independent blocks of a sp.BlockDiagonal and columns of a
+  2-D b are separate systems), `precond` is built on the float32 A.
+  Tensors in and out, x is float64. Returns x, the residual of
+  each system and the CG steps each ran over all refinements; stops early
+  when a refinement no longer decreases the residual (the float32 solves
+  cannot resolve it). A `history` list gets the residuals after each
+  refinement.
+  """
+  if not isinstance(A, sp.Sparse):
+    raise ValueError("refined_cg needs an assembled matrix.")
+  cg = SOLVERS[krylov]
+  A64 = _DoubleProduct(A)
+  A32 = sp.single(A)
+  b = b.double()
+  if x0 is None:
+    x = b.new(b.size()).zero_()
+  else:
+    x = x0.double()
+  r = b - A64.matmul(x)
+  err = _system_norms(A, r)
+  stop_steps = np.zeros(err.size, dtype=np.int64)
+  for i in range(refinements):
+    if (err < thresh).all():
       break
+    # solve for the normalized residual, float32 keeps its relative accuracy
+    scale = float(err.max())
+    rhs = (r / scale).float()
+    d, _, ran = cg(
+        A32, Variable(rhs), Variable(rhs.new(rhs.size()).zero_()),
+        steps=steps, thresh=inner_thresh, precond=precond,
+        check_every=check_every)
+    stop_steps += np.array(ran)
+    new_x = x + d.data.double()*scale
+    r_new = b - A64.matmul(new_x)
+    new_err = _system_norms(A, r_new)
     if verbose:
-      log.info("CG step {} / {}, residual = {:g}".format(k+1, steps, err))
-    p = r + res_new/res_old*p
-    res_old = res_new
-  return x, err
+      log.info("Refinement {} / {}, residual = {:g} in {} steps".format(
+        i+1, refinements, new_err.max(), np.max(ran)))
+    if new_err.max() >= err.max():
+      # the float32 corrections no longer help, keep the best x
+      break
+    x, r, err = new_x, r_new, new_err
+    if history is not None:
+      history.append([float(e) for e in err])
+  return x, [float(e) for e in err], [int(s) for s in stop_steps]
+
+
+def _needs_grad(*variables):
+  return any(v.requires_grad for v in variables)
 
 
-def sparse_cg(A, b, x0, steps=1, thresh=1e-4, verbose=False):
+def _sparse_cg_inplace(A, b, x0, steps, thresh, verbose, check_every,
+                       history):
+  """sparse_cg on tensors, the vectors are allocated once and updated in place."""
+  row, col, val = A.csr_row_idx.data, A.col_idx.data, A.val.data
   r = b - sp.spmv(A, x0)
+  res_old = r.dot(r).data
+  r = r.data.contiguous()
   p = r.clone()
+  x = x0.data.clone()
+  Ap = r.new()
+  pAp = r.new()
+  res_new = r.new()
+  rrs = r.new(max(steps, 1)).zero_()
+  freeze = check_every != 1
+  k = -1
+
+  for k in range(steps):
+    spfuncs.spmv_dot_(row, col, val, p, Ap, pAp, A.size)
+    if freeze:
+      mask = th.sqrt(res_old).ge(thresh).type_as(res_old)
+      spfuncs.cg_update_(x, r, p, Ap, mask*res_old, pAp + (1 - mask), res_new)
+    else:
+      spfuncs.cg_update_(x, r, p, Ap, res_old, pAp, res_new)
+    rrs.narrow(0, k, 1).copy_(res_new.view(1))
+    if _checks(k+1, check_every):
+      err = math.sqrt(rrs[k])
+      if (err < thresh):
+        break
+      if verbose:
+        log.info("CG step {} / {}, residual = {:g}".format(k+1, steps, err))
+    if freeze:
+      spfuncs.cg_direction_(p, r, mask*res_new, res_old + (1 - mask))
+    else:
+      spfuncs.cg_direction_(p, r, res_new, res_old)
+    res_old, res_new = res_new, res_old
+  err, stop = _stop_step(rrs, k+1, thresh, history)
+  if verbose and err < thresh:
+    log.info("CG converged with residual {}.".format(err))
+  return x, err, stop
+
+
+def _segment_dot(u, v, segments, nblocks):
+  """Dot products of u and v restricted to each block."""
+  out = Variable(u.data.new(nblocks).zero_())
+  return out.index_add(0, segments, u*v)
+
+
+def _masked_cg(matmul, dot, spread, b, x0, nsystems, steps, thresh, verbose,
+               name, precond=None, check_every=1, history=None):
+  """CG on `nsystems` independent systems that share their products.
+
+  `dot` returns one dot product per system and `spread` broadcasts one
+  scalar per system back to the shape of the iterates. A system stops
+  updating once its residual falls under `thresh`, a device-side mask: the
+  host reads the residuals every `check_every` steps (never with 0) to
+  stop when they all have. `precond` is as in sparse_cg, `history` gets
+  the residuals of each system after each step.
+  """
+  r = b - matmul(x0)
   x = x0.clone()
-  res_old = r.dot(r)
-  err = -1
+  rr = dot(r, r)
+  if precond is None:
+    z = r
+    res_old = rr
+  else:
+    z = precond.apply(r)
+    res_old = dot(r, z)
+  p = z.clone()
+  rrs = b.data.new(steps + 1, nsystems).zero_()
+  rrs[0].copy_(rr.data)
 
   for k in range(steps):
-    Ap = sp.spmv(A, p)
-    alpha = res_old / p.dot(Ap)
-    x = x +  alpha*p
+    if _checks(k, check_every):
+      err = np.sqrt(rrs[k].cpu().numpy())
+      # systems solved by their initial guess never step
+      if not (err >= thresh).any():
+        break
+      if verbose and k > 0:
+        log.info("CG step {} / {}, residual = {:g}, {} / {} {}s active".format(
+          k, steps, err.max(), (err >= thresh).sum(), nsystems, name))
+    mask = _active(rr, thresh)
+    Ap = matmul(p)
+    # finished systems get a zero step, the shift keeps their ratio finite
+    alpha = spread(mask*res_old / (dot(p, Ap) + (1 - mask)))
+    x = x + alpha*p
     r = r - alpha*Ap
-    res_new = r.dot(r)
-    err = th.sqrt(res_new).data[0]
-    if (err < thresh):
-      if verbose:
-        log.info("CG converged with residual {}.".format(err))
+    rr = dot(r, r)
+    rrs[k+1].copy_(rr.data)
+    if precond is None:
+      z = r
+      res_new = rr
+    else:
+      z = precond.apply(r)
+      res_new = dot(r, z)
+    beta = mask*res_new / (res_old + (1 - mask))
+    p = z + spread(beta)*p
+    res_old = res_new
+  else:
+    k = steps
+
+  errs, stop_steps = _stop_steps(rrs, k, steps, thresh, history)
+  if verbose:
+    for i, (e, s) in enumerate(zip(errs, stop_steps)):
+      if e < thresh:
+        log.info("CG converged on {} {} with residual {} in {} steps.".format(
+          name, i, e, s))
+  return x, errs, stop_steps
+
+
+def _stop_steps(rrs, ran, steps, thresh, history):
+  """Residual and step count of each system from their squared residuals.
+
+  `rrs` has one row per step, a system stopped at its first residual under
+  `thresh`, or ran all `steps`.
+  """
+  norms = np.sqrt(rrs[:ran+1].cpu().numpy())
+  errs, stop_steps = [], []
+  for i in range(norms.shape[1]):
+    below = np.nonzero(norms[:, i] < thresh)[0]
+    stop = below[0] if below.size > 0 else ran
+    errs.append(float(norms[stop, i]))
+    stop_steps.append(int(stop) if below.size > 0 else steps)
+    # frozen systems keep their last residual
+    norms[stop:, i] = norms[stop, i]
+  if history is not None:
+    last = min(max(stop_steps), ran)
+    history.extend([float(e) for e in row] for row in norms[1:last+1])
+  return errs, stop_steps
+
+
+def batched_sparse_cg(A, b, x0, steps=1, thresh=1e-4, verbose=False,
+                      precond=None, check_every=1, history=None):
+  """Conjugate gradient on the independent systems of a sp.BlockDiagonal.
+
+  Every block runs its own CG recurrence and stops updating once its
+  residual falls under `thresh`. Returns x, the residual of each block and
+  the number of steps each block ran. `check_every` and `history` are as
+  in _masked_cg.
+  """
+  nblocks = A.nblocks
+  segments = Variable(A.segments)
+  return _masked_cg(
+      lambda v: sp.spmv(A, v),
+      lambda u, v: _segment_dot(u, v, segments, nblocks),
+      lambda a: a.index_select(0, segments),
+      b, x0, nblocks, steps, thresh, verbose, "block", precond, check_every,
+      history)
+
+
+def block_sparse_cg(A, B, X0, steps=1, thresh=1e-4, verbose=False,
+                    precond=None, check_every=1, history=None):
+  """Conjugate gradient on A.X = B for the k right-hand sides in B's columns.
+
+  Each column runs its own CG recurrence, the products with A are shared:
+  the matrix is read once per step for all columns. Returns X, the residual
+  of each column and the number of steps each column ran. `check_every` and
+  `history` are as in _masked_cg.
+  """
+  n, k = B.shape[0], B.shape[1]
+  return _masked_cg(
+      lambda v: sp.spmm_dense(A, v),
+      lambda u, v: (u*v).sum(0).view(k),
+      lambda a: a.view(1, k).expand(n, k),
+      B, X0, k, steps, thresh, verbose, "column", precond, check_every,
+      history)
+
+
+class _SystemStack(object):
+  """Independent systems `members` of a list, stacked in one vector.
+
+  Assembled systems share one sp.block_diag product, others are applied
+  one by one.
+  """
+  def __init__(self, systems, preconds, members):
+    mats = [systems[i][0] for i in members]
+    like = systems[members[0]][1].data
+    self.members = members
+    self.sizes = [systems[i][1].shape[0] for i in members]
+    self.offsets = [int(o) for o in np.cumsum([0] + self.sizes[:-1])]
+    self.preconds = [preconds[i] for i in members]
+    self.index = sp._upload(np.array(members, dtype=np.int64), like)
+    if all(isinstance(A, sp.Sparse) for A in mats):
+      self.A = sp.block_diag(mats)
+      self.segments = Variable(self.A.segments)
+    else:
+      self.A = None
+      self.mats = mats
+      self.segments = Variable(sp._upload(
+          np.repeat(np.arange(len(members)), self.sizes), like))
+
+  def __len__(self):
+    return len(self.members)
+
+  def split(self, v):
+    return [v.narrow(0, o, sz) for o, sz in zip(self.offsets, self.sizes)]
+
+  def matmul(self, v):
+    if self.A is not None:
+      return sp.spmv(self.A, v)
+    return th.cat([sp.spmv(A, vi) for A, vi in zip(self.mats, self.split(v))],
+                  0)
+
+  def dot(self, u, v):
+    return _segment_dot(u, v, self.segments, len(self))
+
+  def spread(self, a):
+    return a.index_select(0, self.segments)
+
+  def precondition(self, r):
+    if all(pc is None for pc in self.preconds):
+      return r
+    return th.cat([ri if pc is None else pc.apply(ri)
+                   for pc, ri in zip(self.preconds, self.split(r))], 0)
+
+  def rows(self, keep):
+    """Rows of the systems at positions `keep` in the stack."""
+    rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i] +
+                                     self.sizes[i]) for i in keep])
+    return Variable(sp._upload(rows, self.segments.data))
+
+
+def sparse_cg_many(systems, x0s=None, steps=1, thresh=1e-4, verbose=False,
+                   preconds=None, check_every=1, history=None):
+  """Conjugate gradient on a list of independent (A, b) systems, in lock-step.
+
+  The systems still running are stacked: one product per step (a single
+  sp.block_diag SpMV when they are all assembled) and per-system step
+  sizes. A system under `thresh` is frozen on the device, the host reads
+  the residuals every `check_every` steps (never with 0) and the frozen
+  systems then drop out of the stack, later steps only pay for the ones
+  left. `x0s` and `preconds` are per-system initial guesses and
+  preconditioners, None entries for zeros and plain CG. `history` is as in
+  _masked_cg.
+
+  Returns the solutions, the residual of each system and the number of
+  steps each system ran.
+  """
+  n = len(systems)
+  if x0s is None:
+    x0s = [None]*n
+  if preconds is None:
+    preconds = [None]*n
+  x0s = [Variable(b.data.new(b.size()).zero_()) if x0 is None else x0
+         for x0, (_, b) in zip(x0s, systems)]
+  xs = list(x0s)
+
+  stack = _SystemStack(systems, preconds, list(range(n)))
+  x = th.cat(x0s, 0)
+  r = th.cat([b for _, b in systems], 0) - stack.matmul(x)
+  rr = stack.dot(r, r)
+  z = stack.precondition(r)
+  res_old = stack.dot(r, z)
+  p = z.clone()
+  rrs = r.data.new(steps + 1, n).zero_()
+  rrs[0].copy_(rr.data)
+
+  for k in range(steps + 1):
+    if _checks(k, check_every):
+      err = np.sqrt(rrs[k].cpu().numpy())[stack.members]
+      # systems solved by their initial guess never step
+      done = err < thresh
+      if done.any():
+        for i, xi, d in zip(stack.members, stack.split(x), done):
+          if d:
+            xs[i] = xi
+        keep = np.nonzero(~done)[0]
+        if keep.size == 0:
+          break
+        rows = stack.rows(keep)
+        x, r, p = x.index_select(0, rows), r.index_select(0, rows), \
+            p.index_select(0, rows)
+        index = Variable(sp._upload(keep, rows.data))
+        rr, res_old = rr.index_select(0, index), res_old.index_select(0, index)
+        stack = _SystemStack(systems, preconds,
+                             [stack.members[i] for i in keep])
+      if verbose and k > 0:
+        log.info("CG step {} / {}, residual = {:g}, {} / {} systems active".format(
+          k, steps, err.max(), len(stack), n))
+    if k == steps:
       break
-    if verbose:
-      log.info("CG step {} / {}, residual = {:g}".format(k+1, steps, err))
-    p = r + res_new/res_old*p
+    mask = _active(rr, thresh)
+    Ap = stack.matmul(p)
+    # frozen systems get a zero step, the shift keeps their ratio finite
+    alpha = stack.spread(mask*res_old / (stack.dot(p, Ap) + (1 - mask)))
+    x = x + alpha*p
+    r = r - alpha*Ap
+    rr = stack.dot(r, r)
+    rrs[k+1].index_copy_(0, stack.index, rr.data)
+    z = stack.precondition(r)
+    res_new = rr if z is r else stack.dot(r, z)
+    beta = mask*res_new / (res_old + (1 - mask))
+    p = z + stack.spread(beta)*p
     res_old = res_new
-  return x, err, k+1
+
+  # systems still running after all the steps (or the last ones finished)
+  for i, xi in zip(stack.members, stack.split(x)):
+    xs[i] = xi
+  errs, stop_steps = _stop_steps(rrs, k, steps, thresh, history)
+  if verbose:
+    for i, (e, s) in enumerate(zip(errs, stop_steps)):
+      if e < thresh:
+        log.info("CG converged on system {} with residual {} in {} steps.".format(
+          i, e, s))
+  return xs, errs, stop_steps
+
+
+class _Systems(object):
+  """Products and reductions of the independent systems of A.x = b.
+
+  One system for a vector b, one per column of a 2-D b and one per block
+  of a sp.BlockDiagonal A. The scalars of the solvers hold one value per
+  system, `spread` broadcasts them to the shape of the vectors.
+  """
+  def __init__(self, A, b):
+    self.A = sp.aslinearoperator(A)
+    self.n = b.shape[0]
+    self.columns = b.dim() == 2
+    self.segments = None
+    if self.columns:
+      self.nsystems, self.name = b.shape[1], "column"
+    elif isinstance(A, sp.BlockDiagonal):
+      self.nsystems, self.name = A.nblocks, "block"
+      self.segments = Variable(A.segments)
+    else:
+      self.nsystems, self.name = 1, "system"
+
+  @property
+  def single(self):
+    return not self.columns and self.segments is None
+
+  def matmul(self, v):
+    return sp.spmm_dense(self.A, v)
+
+  def dots(self, us, vs):
+    """Dot products of the pairs of `us` and `vs`, in a single reduction."""
+    k = len(us)
+    if self.columns:
+      out = (th.cat(us, 1)*th.cat(vs, 1)).sum(0).view(k, self.nsystems)
+    else:
+      prod = th.stack(us, 1)*th.stack(vs, 1)
+      if self.single:
+        out = prod.sum(0).view(k, 1)
+      else:
+        out = Variable(prod.data.new(self.nsystems, k).zero_()).index_add(
+            0, self.segments, prod).t()
+    return [out[i] for i in range(k)]
+
+  def dot(self, u, v):
+    return self.dots([u], [v])[0]
+
+  def spread(self, a):
+    if self.columns:
+      return a.view(1, self.nsystems).expand(self.n, self.nsystems)
+    if self.segments is not None:
+      return a.index_select(0, self.segments)
+    return a.expand(self.n)
+
+
+def _nonzero(d):
+  """d with its zeros replaced by ones, a safe denominator."""
+  return d + Variable(sp._data(d).eq(0).type_as(sp._data(d)))
+
+
+def _finish(systems, rrs, ran, steps, thresh, history, verbose, name):
+  """Residuals and step counts of each system, see _stop_steps.
+
+  `history` gets one residual per step for a single system, one list per
+  step otherwise.
+  """
+  rows = None if history is None else []
+  errs, stop_steps = _stop_steps(rrs, ran, steps, thresh, rows)
+  if history is not None:
+    history.extend(row[0] if systems.single else row for row in rows)
+  if verbose:
+    for i, (e, s) in enumerate(zip(errs, stop_steps)):
+      if e < thresh:
+        log.info("{} converged on {} {} with residual {} in {} steps.".format(
+          name, systems.name, i, e, s))
+  return errs, stop_steps
+
+
+def solve_cg(A, b, x0, steps=1, thresh=1e-4, verbose=False, precond=None,
+             check_every=1, history=None):
+  """sparse_cg, batched_sparse_cg or block_sparse_cg, as fits A and b.
+
+  The residuals and step counts are lists, one entry per system.
+  """
+  if b.dim() == 2:
+    return block_sparse_cg(A, b, x0, steps=steps, thresh=thresh,
+                           verbose=verbose, precond=precond,
+                           check_every=check_every, history=history)
+  if isinstance(A, sp.BlockDiagonal):
+    return batched_sparse_cg(A, b, x0, steps=steps, thresh=thresh,
+                             verbose=verbose, precond=precond,
+                             check_every=check_every, history=history)
+  x, err, stop_step = sparse_cg(A, b, x0, steps=steps, thresh=thresh,
+                                verbose=verbose, precond=precond,
+                                check_every=check_every, history=history)
+  return x, [err], [stop_step]
+
+
+def _lanczos_bounds(systems, r, precond, steps):
+  """Bounds of the spectrum of M^-1.A from a few CG steps on A.d = r.
+
+  The CG coefficients give the Lanczos tridiagonal matrix of each system,
+  its extreme eigenvalues bound the spectrum from the inside: the upper
+  one is padded by 10%. Returns (lmin, lmax) over all systems.
+  """
+  r = Variable(sp._data(r).clone())
+  z = r if precond is None else precond.apply(r)
+  rz = systems.dot(r, z)
+  p = z
+  alphas, betas = [], []
+  for j in range(steps):
+    Ap = systems.matmul(p)
+    alpha = rz / _nonzero(systems.dot(p, Ap))
+    r = r - systems.spread(alpha)*Ap
+    z = r if precond is None else precond.apply(r)
+    rz_new = systems.dot(r, z)
+    beta = rz_new / _nonzero(rz)
+    p = z + systems.spread(beta)*p
+    rz = rz_new
+    alphas.append(alpha.data)
+    betas.append(beta.data)
+  alphas = th.stack(alphas, 0).cpu().numpy()
+  betas = th.stack(betas, 0).cpu().numpy()
+  lmin, lmax = np.inf, 0.0
+  for i in range(systems.nsystems):
+    a, b = alphas[:, i], betas[:, i]
+    # a system that converged stops giving coefficients
+    valid = np.isfinite(a) & np.isfinite(b) & (a > 0) & (b > 0)
+    m = np.argmin(valid) if not valid.all() else a.size
+    if m == 0:
+      continue
+    a, b = a[:m], b[:m]
+    diag = 1.0 / a
+    diag[1:] += b[:-1] / a[:-1]
+    off = np.sqrt(b[:-1]) / a[:-1]
+    T = np.diag(diag) + np.diag(off, 1) + np.diag(off, -1)
+    eig = np.linalg.eigvalsh(T)
+    lmin, lmax = min(lmin, eig[0]), max(lmax, eig[-1])
+  if not np.isfinite(lmin):
+    raise ValueError("Cannot estimate the spectrum, the systems are solved.")
+  return float(lmin), 1.1*float(lmax)
+
+
+def chebyshev(A, b, x0, steps=1, thresh=1e-4, verbose=False, precond=None,
+              check_every=1, history=None, bounds=None, lanczos_steps=10):
+  """Chebyshev iteration on A.x = b, A symmetric positive definite.
+
+  The steps have no inner products, only products with A and `precond`
+  and vector updates: nothing to reduce over the vectors, the residuals
+  are only computed when the host reads them every `check_every` steps
+  (once at the end with 0), the step counts are multiples of it.
+
+  `bounds` enclose the spectrum of A (preconditioned: M^-1.A), they are
+  estimated by `lanczos_steps` CG steps when None. A is a
+  sp.LinearOperator or a dense matrix, b a vector or one vector per
+  column, independent blocks of a sp.BlockDiagonal and columns of b are
+  separate systems. All run until all are under `thresh`. Returns x, the
+  residual of each system and the steps each ran. `history` gets the
+  residuals at each check, as in _finish.
+  """
+  systems = _Systems(A, b)
+  r = b - systems.matmul(x0)
+  x = x0
+  if bounds is None:
+    bounds = _lanczos_bounds(systems, r, precond, lanczos_steps)
+  lmin, lmax = bounds
+  theta = 0.5*(lmax + lmin)
+  delta = 0.5*(lmax - lmin)
+  sigma = theta / delta
+  rho = 1.0 / sigma
+  z = r if precond is None else precond.apply(r)
+  d = z / theta
+
+  checks, norms = [], []
+  def check(k):
+    rr = systems.dot(r, r)
+    checks.append(k)
+    norms.append(np.sqrt(rr.data.cpu().numpy()))
+    return norms[-1]
+
+  for k in range(steps):
+    if _checks(k, check_every):
+      err = check(k)
+      if not (err >= thresh).any():
+        break
+      if verbose and k > 0:
+        log.info("Chebyshev step {} / {}, residual = {:g}".format(
+          k, steps, err.max()))
+    x = x + d
+    r = r - systems.matmul(d)
+    z = r if precond is None else precond.apply(r)
+    rho_new = 1.0 / (2.0*sigma - rho)
+    d = (rho_new*rho)*d + (2.0*rho_new/delta)*z
+    rho = rho_new
+  else:
+    k = steps
+  if not checks or checks[-1] != k:
+    check(k)
+
+  # stop at the first check under thresh
+  norms = np.stack(norms, 0)
+  errs, stop_steps = [], []
+  for i in range(systems.nsystems):
+    below = np.nonzero(norms[:, i] < thresh)[0]
+    stop = below[0] if below.size > 0 else len(checks) - 1
+    errs.append(float(norms[stop, i]))
+    stop_steps.append(checks[stop] if below.size > 0 else steps)
+  if history is not None:
+    history.extend(float(row[0]) if systems.single else [float(e) for e in row]
+                   for row in norms[1:])
+  if verbose:
+    log.info("Chebyshev residual {:g} in {} steps.".format(max(errs), k))
+  return x, errs, stop_steps
+
+
+def pipelined_cg(A, b, x0, steps=1, thresh=1e-4, verbose=False, precond=None,
+                 check_every=1, history=None, replace_every=None):
+  """Pipelined (preconditioned) CG on A.x = b, A symmetric positive definite.
+
+  The recurrences of Ghysels and Vanroose: the three inner products of a
+  step are a single reduction, independent of the step's products with A
+  and `precond` so both can overlap, at the price of more vector updates.
+  Every `replace_every` steps (never with 0) the vectors are recomputed
+  from x and the direction, for 4 more products with A and 2 with
+  `precond`. None replaces every 5 steps in float32, where the recursive
+  residual of the matting systems drifts from b - A.x within 10 steps,
+  and never in float64, where it does not. Systems, `check_every` and the
+  returns are as in chebyshev, a system under `thresh` is frozen as in
+  _masked_cg.
+  """
+  if replace_every is None:
+    replace_every = 5 if sp._data(b).type().endswith("FloatTensor") else 0
+  systems = _Systems(A, b)
+  M = (lambda v: v) if precond is None else precond.apply
+  r = b - systems.matmul(x0)
+  x = x0
+  u = M(r)
+  w = systems.matmul(u)
+  gamma, delta, rr = systems.dots([r, w, r], [u, u, r])
+  rrs = b.data.new(steps + 1, systems.nsystems).zero_()
+  rrs[0].copy_(rr.data)
+  mask = _active(rr, thresh)
+
+  for k in range(steps):
+    if _checks(k, check_every):
+      err = np.sqrt(rrs[k].cpu().numpy())
+      if not (err >= thresh).any():
+        break
+      if verbose and k > 0:
+        log.info("Pipelined CG step {} / {}, residual = {:g}".format(
+          k, steps, err.max()))
+    mask = mask*_active(rr, thresh)
+    m = M(w)
+    n = systems.matmul(m)
+    # frozen systems get zero steps, the shifts keep their ratios finite
+    if k == 0:
+      alpha = mask*gamma / (delta + (1 - mask))
+      z, q, s, p = n, m, w, u
+    else:
+      beta = mask*gamma / (gamma_old + (1 - mask))
+      alpha = mask*gamma / (delta - beta*gamma/(alpha_old + (1 - mask)) +
+                            (1 - mask))
+      sb = systems.spread(beta)
+      z, q, s, p = n + sb*z, m + sb*q, w + sb*s, u + sb*p
+    sa = systems.spread(alpha)
+    x = x + sa*p
+    if replace_every > 0 and (k + 1) % replace_every == 0:
+      r = b - systems.matmul(x)
+      u = M(r)
+      w = systems.matmul(u)
+      s = systems.matmul(p)
+      q = M(s)
+      z = systems.matmul(q)
+    else:
+      r = r - sa*s
+      u = r if precond is None else u - sa*q
+      w = w - sa*z
+    gamma_old, alpha_old = gamma, alpha
+    gamma, delta, rr = systems.dots([r, w, r], [u, u, r])
+    rrs[k+1].copy_(rr.data)
+  else:
+    k = steps
+
+  errs, stop_steps = _finish(systems, rrs, k, steps, thresh, history, verbose,
+                             "Pipelined CG")
+  return x, errs, stop_steps
+
+
+def minres(A, b, x0, steps=1, thresh=1e-4, verbose=False, precond=None,
+           check_every=1, history=None):
+  """MINRES on A.x = b, A symmetric (possibly indefinite).
+
+  The recurrences of Paige and Saunders, minimizing |b - A.x| (with
+  `precond`, symmetric positive definite, its M^-1 norm) over the Krylov
+  space. Without preconditioner the residual comes from the recurrence,
+  with one it is updated from the products with A already computed: it
+  stays closer to b - A.x than CG's, and so stalls earlier in float32.
+  Systems, `check_every` and the returns are as in chebyshev, a system
+  under `thresh` is frozen as in _masked_cg.
+  """
+  systems = _Systems(A, b)
+  M = (lambda v: v) if precond is None else precond.apply
+  r = b - systems.matmul(x0)
+  x = x0
+  r1 = r2 = r
+  y = M(r)
+  rr, ry = systems.dots([r, r], [r, y])
+  beta = ry.sqrt()
+  oldb = 0*beta
+  phibar = beta
+  dbar = epsln = sn = 0*beta
+  cs = sn - 1
+  w = w2 = 0*r
+  Aw = Aw2 = w
+  rrs = b.data.new(steps + 1, systems.nsystems).zero_()
+  rrs[0].copy_(rr.data)
+  mask = _active(rr, thresh)
+
+  for k in range(steps):
+    if _checks(k, check_every):
+      err = np.sqrt(rrs[k].cpu().numpy())
+      if not (err >= thresh).any():
+        break
+      if verbose and k > 0:
+        log.info("MINRES step {} / {}, residual = {:g}".format(
+          k, steps, err.max()))
+    mask = mask*_active(rr, thresh)
+    # frozen (or exactly solved) systems keep finite ratios
+    v = systems.spread(1 / _nonzero(beta))*y
+    Av = systems.matmul(v)
+    y = Av
+    if k > 0:
+      y = y - systems.spread(beta / _nonzero(oldb))*r1
+    alfa = systems.dot(v, y)
+    y = y - systems.spread(alfa / _nonzero(beta))*r2
+    r1, r2 = r2, y
+    y = M(r2)
+    oldb = beta
+    beta = systems.dot(r2, y).clamp(min=0).sqrt()
+    oldeps = epsln
+    delta = cs*dbar + sn*alfa
+    gbar = sn*dbar - cs*alfa
+    epsln = sn*beta
+    dbar = -cs*beta
+    gamma = _nonzero((gbar*gbar + beta*beta).sqrt())
+    cs = gbar / gamma
+    sn = beta / gamma
+    phi = mask*cs*phibar
+    phibar = sn*phibar
+    w1, w2 = w2, w
+    Aw1, Aw2 = Aw2, Aw
+    w = (v - systems.spread(oldeps)*w1 - systems.spread(delta)*w2)*(
+        systems.spread(1 / gamma))
+    x = x + systems.spread(phi)*w
+    if precond is None:
+      rr = mask*phibar*phibar + (1 - mask)*rr
+    else:
+      Aw = (Av - systems.spread(oldeps)*Aw1 - systems.spread(delta)*Aw2)*(
+          systems.spread(1 / gamma))
+      r = r - systems.spread(phi)*Aw
+      rr = systems.dot(r, r)
+    rrs[k+1].copy_(rr.data)
+  else:
+    k = steps
+
+  errs, stop_steps = _finish(systems, rrs, k, steps, thresh, history, verbose,
+                             "MINRES")
+  return x, errs, stop_steps
+
+
+SOLVERS = {
+    "cg": solve_cg,
+    "chebyshev": chebyshev,
+    "pipelined_cg": pipelined_cg,
+    "minres": minres,
+}
+
+
+def solve(name, A, b, x0, **kwargs):
+  """Runs the solver `name` (a key of SOLVERS) on A.x = b from x0.
+
+  Solvers take A, b, x0, steps, thresh, verbose, precond, check_every and
+  history, and return x, the residual of each system and the steps each
+  ran.
+  """
+  if name not in SOLVERS:
+    raise ValueError("Unknown solver {}, should be one of {}".format(
+      name, sorted(SOLVERS.keys())))
+  return SOLVERS[name](A, b, x0, **kwargs)
@@ -1,15 +1,37 @@
+import copy
+import functools
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 import torch as th
 import matting.functions.sparse as spfuncs
+import matting.functions.sparse_cpu as spcpu
 
 from torch.autograd import Variable
 
 import scipy.sparse as scp
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+
+
+class LinearOperator(object):
+  """Square operator, the protocol of the Krylov solvers of matting.optim.
+
+  Operators have a `size`, `matmul(v)` applies them to a vector and
+  `diagonal()` returns their diagonal (Jacobi preconditioning). Sparse,
+  Diagonal and MatrixFree implement it, see aslinearoperator for dense
+  matrices. spmm_dense applies any of them to one vector per column.
+  """
+  def matmul(self, v):
+    return spmm_dense(self, v)
 
+  def diagonal(self):
+    return diagonal(self)
 
-class Sparse(object):
+
+class Sparse(LinearOperator):
   """"""
-  def __init__(self, csr_row_idx, col_idx, val, size):
+  def __init__(self, csr_row_idx, col_idx, val, size, pattern_key=None):
     if csr_row_idx.numel() != size[0]+1:
       raise ValueError("CSR row should have rows+1 elements")
     if col_idx.numel() != val.numel():
@@ -21,6 +43,9 @@ class Sparse(object):
     self.val = val
     self.size = size
     self.storage = "csr"
+    self._pattern_key = pattern_key
+    self._structure = None
+    self._csc = None
 
   def make_variable(self, requires_grad=False):
     self.csr_row_idx = Variable(self.csr_row_idx)
@@ -31,10 +56,54 @@ class Sparse(object):
   def nnz(self):
     return self.val.numel()
 
+  @property
+  def pattern_key(self):
+    """Hashable identifier of the sparsity pattern (size, rows and columns).
+
+    Results of sparse ops derive it from their operands' keys, matrices built
+    from raw indices hash them once on first use.
+    """
+    if self._pattern_key is None:
+      self._pattern_key = _hash_pattern(self.csr_row_idx, self.col_idx, self.size)
+    return self._pattern_key
+
+  @property
+  def structure(self):
+    """Structure of the pattern, with its transpose (CSC view).
+
+    Computed on first use and shared, through `pattern_cache`, by every
+    matrix with the same pattern.
+    """
+    if self._structure is None:
+      def build():
+        row, col = self.host_pattern()
+        return Structure(row, col, self.size[1], _data(self.val))
+      self._structure = pattern_cache.get(
+          ("structure", self.pattern_key, _device_key(self.val)), build)
+    return self._structure
+
+  def csc(self, val=None):
+    """CSR indices and values of the transpose, as tensors.
+
+    `val` defaults to the current values. They are gathered once and reused
+    for as long as the same `val` is asked for.
+    """
+    if val is None:
+      val = self.val
+    if self._csc is None or self._csc[0] is not val:
+      s = self.structure
+      t_val = _data(val).index_select(0, s.permutation)
+      self._csc = (val, (s.t_csr_row_idx, s.t_col_idx, t_val))
+    return self._csc[1]
+
   def mul_(self, s):
     self.val = self.val.mul(s)
     # self.val.mul_(s)
 
+  def host_pattern(self):
+    """CSR row pointer and column indices as numpy arrays."""
+    return _host(self.csr_row_idx), _host(self.col_idx)
+
   def to_dense(self):
     vals = self.val.data.cpu()
     ptr = self.csr_row_idx.data.cpu()
@@ -51,18 +120,473 @@ class Sparse(object):
     return s
 
 
-def from_coo(row_idx, col_idx, val, size):
-  """Construct a sparse matrix from THTensors describing a COO format."""
+class BlockDiagonal(Sparse):
+  """Block-diagonal stack of independent square systems.
+
+  `sizes` and `offsets` locate each block, `segments` maps every row to the
+  index of its block (LongTensor on the matrix's device).
+  """
+  def __init__(self, csr_row_idx, col_idx, val, sizes, segments,
+               pattern_key=None):
+    n = int(np.sum(sizes))
+    super(BlockDiagonal, self).__init__(
+        csr_row_idx, col_idx, val, th.Size((n, n)), pattern_key=pattern_key)
+    self.sizes = [int(sz) for sz in sizes]
+    self.offsets = [int(o) for o in np.cumsum([0] + self.sizes[:-1])]
+    self.segments = segments
+
+  @property
+  def nblocks(self):
+    return len(self.sizes)
+
+  def split(self, x):
+    """Split a vector over the rows of the matrix into one slice per block."""
+    return [x.narrow(0, o, sz) for o, sz in zip(self.offsets, self.sizes)]
+
+
+class Diagonal(LinearOperator):
+  """Diagonal matrix, only its values are stored.
+
+  Sums, products and matrix-vector products involving a Diagonal reduce to
+  adding to a diagonal, scaling rows/columns and elementwise products.
+  """
+  def __init__(self, val, size=None):
+    if size is None:
+      size = th.Size((val.numel(), val.numel()))
+    if size[0] != size[1] or val.numel() != size[0]:
+      raise ValueError("Diagonal should be square with one value per row.")
+    self.val = val
+    self.size = size
+
+  @property
+  def nnz(self):
+    return self.val.numel()
+
+  @property
+  def pattern_key(self):
+    return ("diag", self.size[0], self.size[1])
+
+  def mul_(self, s):
+    self.val = self.val.mul(s)
+
+  def host_pattern(self):
+    n = self.size[0]
+    return np.arange(n+1, dtype=np.int32), np.arange(n, dtype=np.int32)
+
+  def to_dense(self):
+    return np.diag(_data(self.val).cpu().numpy())
+
+  def __str__(self):
+    s = "Diagonal matrix {}\n".format(self.size)
+    s += "  val {}\n".format(self.val)
+    return s
+
+
+class MatrixFree(LinearOperator):
+  """Linear operator applied without assembling its matrix.
+
+  Subclasses define `size` and `matmul(v)`, spmv and spmv_dot dispatch to
+  the latter.
+  """
+  def matmul(self, v):
+    raise NotImplementedError
+
+  def diagonal(self):
+    raise NotImplementedError
+
+
+class Dense(MatrixFree):
+  """Dense matrix M (a Variable) as an operator."""
+  def __init__(self, M):
+    if M.dim() != 2 or M.shape[0] != M.shape[1]:
+      raise ValueError("Dense: the matrix should be square.")
+    self.M = M
+    self.size = M.size()
+
+  @property
+  def nnz(self):
+    return self.M.numel()
+
+  def diagonal(self):
+    return self.M.diag()
+
+  def matmul(self, v):
+    return self.M.matmul(v)
+
+
+class LocalLaplacian(MatrixFree):
+  """Laplacian of the weighted 3x3 windows of the local matting term.
+
+  Window k couples the 9 pixels `neighbors[k]` with the 9x9 affinities
+  `flows[:, :, k]` scaled by `weights[k]`. The operator is
+  diag(row_sum(W)) - W for W the symmetrized sum of the windows, as built
+  by sp_laplacian(.., symmetrize=True), and is applied with one gather and
+  one scatter over the windows. Differentiable with respect to the flows,
+  the weights and the vector.
+  """
+  def __init__(self, neighbors, flows, weights, size):
+    if flows.shape[0] != 9 or flows.shape[1] != 9:
+      raise ValueError("LocalLaplacian: flows should be 9 x 9 x windows.")
+    self.size = size
+    self.nwindows = neighbors.shape[0]
+    # one row of window pixels per neighbor position
+    self.index = neighbors.long().t().contiguous().view(-1)
+    self.flows = flows
+    self.weights = weights.view(1, -1)
+    self.degrees = self._scatter(flows.sum(1) + flows.sum(0))
+
+  @property
+  def nnz(self):
+    return self.nwindows*81
+
+  def _scatter(self, y):
+    """Accumulates the window contributions y (9 x windows) of W.v."""
+    out = Variable(_data(self.weights).new(self.size[0]).zero_())
+    return out.index_add(0, self.index, (0.5*self.weights*y).view(-1))
+
+  def diagonal(self):
+    # W's diagonal comes from the flows of each pixel with itself
+    self_flows = self.flows.view(81, -1).index_select(
+        0, Variable(_upload(np.arange(0, 81, 10), _data(self.weights))))
+    return self.degrees - self._scatter(2*self_flows)
+
+  def matmul(self, v):
+    u = v.index_select(0, self.index).view(9, self.nwindows)
+    y = None
+    for j in range(9):
+      uj = u[j:j+1, :]
+      yj = self.flows[:, j, :]*uj + self.flows[j, :, :]*uj
+      y = yj if y is None else y + yj
+    return self.degrees*v - self._scatter(y)
+
+
+class OperatorSum(MatrixFree):
+  """Sum of square operators, Sparse, Diagonal or MatrixFree."""
+  def __init__(self, terms):
+    self.terms = list(terms)
+    self.size = self.terms[0].size
+    for t in self.terms:
+      if t.size != self.size:
+        raise ValueError("OperatorSum: terms have different sizes.")
+
+  @property
+  def nnz(self):
+    return sum(t.nnz for t in self.terms)
+
+  def diagonal(self):
+    out = None
+    for t in self.terms:
+      d = diagonal(t)
+      out = d if out is None else out + d
+    return out
+
+  def matmul(self, v):
+    out = None
+    for t in self.terms:
+      tv = spmv(t, v)
+      out = tv if out is None else out + tv
+    return out
+
+
+class PatternCache(object):
+  """LRU cache of symbolic plans, keyed on the sparsity patterns they serve.
+
+  Evicts the least recently used plans once their tensors and arrays take
+  more than `capacity` bytes, the last plan is always kept.
+  """
+  def __init__(self, capacity=512*2**20):
+    self.capacity = capacity
+    self.hits = 0
+    self.misses = 0
+    self.nbytes = 0
+    self._plans = OrderedDict()
+
+  def get(self, key, build):
+    """Plan stored under `key`, calls `build()` to create it on a miss."""
+    entry = self._plans.pop(key, None)
+    if entry is None:
+      self.misses += 1
+      plan = build()
+      entry = (plan, _nbytes(plan))
+      self.nbytes += entry[1]
+    else:
+      self.hits += 1
+    self._plans[key] = entry
+    while self.nbytes > self.capacity and len(self._plans) > 1:
+      _, (_, nbytes) = self._plans.popitem(last=False)
+      self.nbytes -= nbytes
+    return entry[0]
+
+  def clear(self):
+    self._plans.clear()
+    self.nbytes = 0
+
+  def __len__(self):
+    return len(self._plans)
+
+
+pattern_cache = PatternCache()
+
+
+def _nbytes(plan, seen=None):
+  """Bytes of the tensors and arrays held by a plan, each counted once."""
+  if seen is None:
+    seen = set()
+  if id(plan) in seen:
+    return 0
+  seen.add(id(plan))
+  if th.is_tensor(plan):
+    return plan.numel()*plan.storage().element_size()
+  if isinstance(plan, np.ndarray):
+    return plan.nbytes
+  if isinstance(plan, (list, tuple)):
+    return sum(_nbytes(p, seen) for p in plan)
+  if isinstance(plan, dict):
+    return sum(_nbytes(p, seen) for p in plan.values())
+  if hasattr(plan, "__dict__"):
+    return sum(_nbytes(p, seen) for p in vars(plan).values())
+  return 0
+
+
+class CooPlan(object):
+  """CSR pattern of a COO matrix and the COO entry of each CSR value."""
+  def __init__(self, csr_row_idx, col_idx, permutation):
+    self.csr_row_idx = csr_row_idx
+    self.col_idx = col_idx
+    self.permutation = permutation
+
+
+class SpAddPlan(object):
+  """Merged pattern of a sum, with the position of each term's entries in it."""
+  def __init__(self, csr_row_idx, col_idx, maps):
+    self.csr_row_idx = csr_row_idx
+    self.col_idx = col_idx
+    self.maps = maps
+
+  @property
+  def nnz(self):
+    return self.col_idx.numel()
+
+
+class BlockDiagPlan(object):
+  """Stacked indices of a block-diagonal matrix and the block of each row."""
+  def __init__(self, csr_row_idx, col_idx, segments):
+    self.csr_row_idx = csr_row_idx
+    self.col_idx = col_idx
+    self.segments = segments
+
+
+class Structure(object):
+  """CSR pattern with its COO rows and its transposed (CSC) structure.
+
+  `t_csr_row_idx` and `t_col_idx` are the CSR indices of the transpose, whose
+  values are `val[permutation]`.
+  """
+  def __init__(self, csr_row, col, cols, like):
+    t_csr_row, t_col, permutation = spcpu.csr2csc_symbolic(csr_row, col, cols)
+    self.csr_row_idx = _upload(csr_row.astype(np.int32), like)
+    self.col_idx = _upload(col.astype(np.int32), like)
+    self.coo_row_idx = _upload(
+        spcpu._csr_rows(csr_row, col.size).astype(np.int32), like)
+    self.t_csr_row_idx = _upload(t_csr_row, like)
+    self.t_col_idx = _upload(t_col, like)
+    self.permutation = _upload(permutation.astype(np.int64), like)
+
+  @property
+  def nnz(self):
+    return self.col_idx.numel()
+
+
+class Ordering(object):
+  """Symmetric reordering of a linear system.
+
+  `perm[i]` is the original index of the i-th unknown: the reordered system
+  is A[perm][:, perm].y = b[perm], and x = y[inverse].
+  """
+  def __init__(self, perm, like, key):
+    inverse = np.empty_like(perm)
+    inverse[perm] = np.arange(perm.size, dtype=perm.dtype)
+    self.key = key
+    self.host_inverse = inverse
+    self.perm = _upload(perm.astype(np.int64), like)
+    self.inverse = _upload(inverse.astype(np.int64), like)
+
+  def __len__(self):
+    return self.perm.numel()
+
+  def vector(self, v):
+    """v in the new ordering."""
+    return v.index_select(0, Variable(self.perm))
+
+  def restore(self, x):
+    """x, given in the new ordering, back in the original one."""
+    return x.index_select(0, Variable(self.inverse))
+
+
+class GatherPlan(object):
+  """Scatter of a subset of a matrix's values into a dense tensor.
+
+  Value `source[i]` of the matrix goes to `index[i]` of a tensor
+  initialized with `fill`.
+  """
+  def __init__(self, index, source, fill):
+    self.index = index
+    self.source = source
+    self.fill = fill
+
+
+class IC0Plan(object):
+  """Structure of the IC(0) factor L of a matrix and its level schedules.
+
+  Host tensors: `source` gathers L's values from A's, L^T's values are
+  L's gathered with `t_perm`.
+  """
+  def __init__(self, source, csr_row_idx, col_idx, t_csr_row_idx, t_col_idx,
+               t_perm, levels, t_levels):
+    self.source = source
+    self.csr_row_idx = csr_row_idx
+    self.col_idx = col_idx
+    self.t_csr_row_idx = t_csr_row_idx
+    self.t_col_idx = t_col_idx
+    self.t_perm = t_perm
+    self.levels = levels
+    self.t_levels = t_levels
+
+
+class PermutePlan(object):
+  """Pattern of P.A.Pt and the entry of A each of its values comes from."""
+  def __init__(self, csr_row_idx, col_idx, source):
+    self.csr_row_idx = csr_row_idx
+    self.col_idx = col_idx
+    self.source = source
+
+
+class AggregationPlan(object):
+  """Pattern of a pixel aggregation operator and the coarse image sizes."""
+  def __init__(self, csr_row_idx, col_idx, cols, coarse_shapes):
+    self.csr_row_idx = csr_row_idx
+    self.col_idx = col_idx
+    self.cols = cols
+    self.coarse_shapes = coarse_shapes
+
+
+class SpMMPlan(object):
+  """Pattern of C = A.B and the structures its numeric passes gather from."""
+  def __init__(self, a, b, c, rows, inner, outer):
+    self.a = a
+    self.b = b
+    self.c = c
+    self.rows = rows
+    self.inner = inner
+    self.outer = outer
+
+
+class GramPlan(object):
+  """Pattern of C = At.A and the structure of A its products gather from."""
+  def __init__(self, a, c, rows, cols):
+    self.a = a
+    self.c = c
+    self.rows = rows
+    self.cols = cols
+
+
+def _data(t):
+  if isinstance(t, Variable):
+    return t.data
+  return t
+
+
+def _host(t):
+  return _data(t).cpu().numpy()
+
+
+def _upload(array, like):
+  """Tensor from a numpy array, on the device of `like`."""
+  t = th.from_numpy(np.ascontiguousarray(array))
+  if like.is_cuda:
+    t = t.cuda(like.get_device())
+  return t
+
+
+def _device_key(t):
+  t = _data(t)
+  if t.is_cuda:
+    return t.get_device()
+  return -1
+
+
+def _hash_pattern(csr_row_idx, col_idx, size):
+  digest = hashlib.sha1()
+  for idx in (csr_row_idx, col_idx):
+    digest.update(np.ascontiguousarray(_host(idx), dtype=np.int32).tobytes())
+  return ("csr", size[0], size[1], digest.hexdigest())
+
+
+def detach(A):
+  """A with constant values, sharing its pattern and cached structures."""
+  if isinstance(A, Diagonal):
+    return Diagonal(Variable(_data(A.val)), A.size)
+  if isinstance(A, MatrixFree):
+    raise ValueError("detach: needs an assembled matrix.")
+  return with_values(A, Variable(_data(A.val)))
+
+
+def with_values(A, val):
+  """Sparse A with the values `val`, sharing its pattern and structures."""
+  C = copy.copy(A)
+  C.val = val
+  return C
+
+
+def single(A):
+  """detach(A) with float32 values, for the float32 kernels."""
+  C = detach(A)
+  C.val = Variable(_data(C.val).float())
+  return C
+
+
+def aslinearoperator(A):
+  """A as a LinearOperator, dense matrices are wrapped in a Dense."""
+  if isinstance(A, LinearOperator):
+    return A
+  return Dense(A)
+
+
+def from_coo(row_idx, col_idx, val, size, pattern_key=None):
+  """Construct a sparse matrix from THTensors describing a COO format.
+
+  With a `pattern_key` naming the pattern of (row_idx, col_idx), the CSR
+  pattern is computed on the first call only and cached in
+  `pattern_cache`: later calls only gather the values, without reading the
+  indices. The key must change whenever the indices do.
+  """
   if row_idx.numel() != col_idx.numel():
     raise ValueError("Row and Col should have the same number of elements.")
   if row_idx.numel() != val.numel():
     raise ValueError("Row and Val should have the same number of elements.")
   if row_idx.numel() > size[0]*size[1]:
     raise ValueError("NNZ should be less than rows*cols.")
+  if pattern_key is not None:
+    key = ("coo", pattern_key, size[0], size[1])
+    plan = pattern_cache.get(key + (_device_key(val),),
+                             lambda: _coo_plan(row_idx, col_idx, size, val))
+    permutation = plan.permutation
+    if isinstance(val, Variable):
+      permutation = Variable(permutation)
+    return Sparse(Variable(plan.csr_row_idx), Variable(plan.col_idx),
+                  val.index_select(0, permutation), size, pattern_key=key)
   csr_row_idx, csr_col_idx, csr_val = spfuncs.Coo2Csr.apply(row_idx, col_idx, val, size)
   return Sparse(csr_row_idx, csr_col_idx, csr_val, size)
 
 
+def _coo_plan(row_idx, col_idx, size, val):
+  row, col, permutation = spcpu.coo2csr_symbolic(
+      _host(row_idx), _host(col_idx), size[0])
+  like = _data(val)
+  return CooPlan(_upload(row, like), _upload(col, like),
+                 _upload(permutation.astype(np.int64), like))
+
+
 def size_to_variable(size):
   asize = np.array(list(size)).astype(np.int32)
   asize = Variable(th.from_numpy(asize))
@@ -70,40 +594,419 @@ def size_to_variable(size):
 
 
 def transpose(A):
-  # asize = size_to_variable(A.size)
-  csc_row_idx, csc_col_idx, csc_val = spfuncs.Transpose.apply(A.csr_row_idx, A.col_idx, A.val, A.size)
-  return Sparse(csc_col_idx, csc_row_idx, csc_val, th.Size((A.size[1], A.size[0])))
+  """Transpose of A, a gather of its values into its cached CSC structure."""
+  if isinstance(A, Diagonal):
+    return A
+  s = A.structure
+  t_val = A.val.index_select(0, Variable(s.permutation))
+  return Sparse(Variable(s.t_csr_row_idx), Variable(s.t_col_idx), t_val,
+                th.Size((A.size[1], A.size[0])),
+                pattern_key=("transpose", A.pattern_key))
+
+
+def _spadd_plan(mats):
+  size = mats[0].size
+  rowC, colC, maps = spcpu.spadd_symbolic(
+      [A.host_pattern() for A in mats], size[0], size[1])
+  like = _data(mats[0].val)
+  return SpAddPlan(_upload(rowC, like), _upload(colC, like),
+                   [_upload(m, like) for m in maps])
+
+
+def spadd_many(mats, scales=None):
+  """Weighted sum of sparse matrices, sum_i scales[i]*mats[i], in one pass.
+
+  The merged pattern is computed once per combination of input patterns and
+  cached in `pattern_cache`, repeated calls only scatter the values. Terms
+  can be Sparse or Diagonal, a sum of Diagonals stays Diagonal.
+  """
+  if len(mats) == 0:
+    raise ValueError("spadd_many needs at least one matrix.")
+  if scales is None:
+    scales = [1.0]*len(mats)
+  if len(scales) != len(mats):
+    raise ValueError("spadd_many: expected one scale per matrix.")
+  size = mats[0].size
+  for A in mats:
+    if A.size != size:
+      raise ValueError("spadd_many: all matrices should have the same size.")
+  if all(isinstance(A, Diagonal) for A in mats):
+    val = sum(A.val.mul(s) if s != 1.0 else A.val for A, s in zip(mats, scales))
+    return Diagonal(val, size)
+  key = ("spadd",) + tuple(A.pattern_key for A in mats)
+  plan = pattern_cache.get(key + (_device_key(mats[0].val),),
+                           lambda: _spadd_plan(mats))
+  valC = spfuncs.SpAddNumeric.apply(
+      plan, tuple(float(s) for s in scales), *[A.val for A in mats])
+  return Sparse(Variable(plan.csr_row_idx), Variable(plan.col_idx), valC,
+                size, pattern_key=key)
+
 
+def spadd(A, B, alpha=1.0, beta=1.0):
+  """Sum of sparse matrices, alpha*A + beta*B."""
+  return spadd_many([A, B], [alpha, beta])
 
-def spadd(A, B):
-  """Sum of sparse matrices"""
-  rowC, colC, valC = spfuncs.SpAdd.apply(
-      A.csr_row_idx, A.col_idx, A.val,
-      B.csr_row_idx, B.col_idx, B.val,
-      A.size)
-  return Sparse(rowC, colC, valC, A.size)
 
+def _block_diag_plan(mats):
+  rows, cols, nnz = [], [], 0
+  offset = 0
+  for A in mats:
+    row, col = A.host_pattern()
+    rows.append(row[:-1].astype(np.int64) + nnz)
+    cols.append(col.astype(np.int64) + offset)
+    nnz += col.size
+    offset += A.size[0]
+  rows.append(np.array([nnz], dtype=np.int64))
+  sizes = [A.size[0] for A in mats]
+  segments = np.repeat(np.arange(len(mats), dtype=np.int64), sizes)
+  like = _data(mats[0].val)
+  return BlockDiagPlan(
+      _upload(np.concatenate(rows).astype(np.int32), like),
+      _upload(np.concatenate(cols).astype(np.int32), like),
+      _upload(segments, like))
 
-def spmv(A, v):
-  """Sparse matrix - dense vector product."""
-  return spfuncs.SpMV.apply(A.csr_row_idx, A.col_idx, A.val, v, A.size)
+
+def block_diag(mats):
+  """Block-diagonal matrix from square systems of possibly different sizes."""
+  if len(mats) == 0:
+    raise ValueError("block_diag needs at least one matrix.")
+  for A in mats:
+    if A.size[0] != A.size[1]:
+      raise ValueError("block_diag: blocks should be square.")
+  key = ("block_diag",) + tuple(A.pattern_key for A in mats)
+  plan = pattern_cache.get(key + (_device_key(mats[0].val),),
+                           lambda: _block_diag_plan(mats))
+  val = th.cat([A.val for A in mats], 0)
+  return BlockDiagonal(Variable(plan.csr_row_idx), Variable(plan.col_idx), val,
+                       [A.size[0] for A in mats], plan.segments,
+                       pattern_key=key)
+
+
+def _diagonal_plan(A):
+  row, col = A.host_pattern()
+  rows = spcpu._csr_rows(row, col.size)
+  source = np.nonzero(rows == col)[0]
+  like = _data(A.val)
+  return GatherPlan(_upload(rows[source], like), _upload(source, like),
+                    like.new(A.size[0]).zero_())
+
+
+def diagonal(A):
+  """Diagonal of a square matrix or operator, as a vector.
+
+  Differentiable with respect to the matrix's values.
+  """
+  if A.size[0] != A.size[1]:
+    raise ValueError("diagonal: the matrix should be square.")
+  if isinstance(A, Diagonal):
+    return A.val
+  if isinstance(A, MatrixFree):
+    return A.diagonal()
+  plan = pattern_cache.get(("diagonal", A.pattern_key, _device_key(A.val)),
+                           lambda: _diagonal_plan(A))
+  # the plan is shared by the float32 and float64 values of the pattern
+  return Variable(plan.fill.type_as(_data(A.val)).clone()).index_add(
+      0, Variable(plan.index), A.val.index_select(0, Variable(plan.source)))
+
+
+def _diagonal_blocks_plan(A, block_size):
+  n = A.size[0]
+  nblocks = (n + block_size - 1) // block_size
+  row, col = A.host_pattern()
+  rows = spcpu._csr_rows(row, col.size)
+  col = col.astype(np.int64)
+  source = np.nonzero(rows // block_size == col // block_size)[0]
+  index = ((rows[source] // block_size)*block_size*block_size +
+           (rows[source] % block_size)*block_size + col[source] % block_size)
+  # the padding of the last block is the identity
+  fill = np.zeros((nblocks, block_size, block_size))
+  for i in range(n, nblocks*block_size):
+    fill[-1, i % block_size, i % block_size] = 1.0
+  like = _data(A.val)
+  return GatherPlan(_upload(index, like), _upload(source, like),
+                    like.new(*fill.shape).copy_(th.from_numpy(fill)))
+
+
+def diagonal_blocks(A, block_size):
+  """Dense diagonal blocks of a square sparse matrix.
+
+  Returns the (nblocks x block_size x block_size) blocks of consecutive
+  rows/columns, the last one padded with the identity. Differentiable with
+  respect to the matrix's values.
+  """
+  if A.size[0] != A.size[1]:
+    raise ValueError("diagonal_blocks: the matrix should be square.")
+  if isinstance(A, MatrixFree):
+    raise ValueError("diagonal_blocks: needs an assembled matrix.")
+  key = ("diagonal_blocks", block_size, A.pattern_key, _device_key(A.val))
+  plan = pattern_cache.get(key, lambda: _diagonal_blocks_plan(A, block_size))
+  blocks = Variable(plan.fill.type_as(_data(A.val)).clone())
+  return blocks.view(-1).index_add(
+      0, Variable(plan.index), A.val.index_select(0, Variable(plan.source))
+      ).view(blocks.size())
+
+
+def _ic0_plan(A):
+  n = A.size[0]
+  source, row, col, t_row, t_col, t_perm = spcpu.ic0_symbolic(
+      *(A.host_pattern() + (n,)))
+  levels = spcpu.triangular_levels(row, col, n)
+  t_levels = spcpu.triangular_levels(t_row, t_col, n)
+  host = lambda a: th.from_numpy(np.ascontiguousarray(a))
+  return IC0Plan(host(source), host(row.astype(np.int32)), host(col),
+                 host(t_row.astype(np.int32)), host(t_col), host(t_perm),
+                 [host(l) for l in levels], [host(l) for l in t_levels])
+
+
+def ic0_plan(A):
+  """IC0Plan of a square sparse matrix, cached per pattern."""
+  if A.size[0] != A.size[1] or not isinstance(A, Sparse):
+    raise ValueError("ic0_plan: needs a square, assembled matrix.")
+  return pattern_cache.get(("ic0", A.pattern_key), lambda: _ic0_plan(A))
+
+
+def rcm_ordering(A):
+  """Reverse Cuthill-McKee ordering of a square matrix, cached per pattern.
+
+  Reduces the bandwidth of A, so that the products read nearby entries of
+  the vector.
+  """
+  def build():
+    row, col = A.host_pattern()
+    ones = scp.csr_matrix(
+        (np.ones(col.size, dtype=np.float32), col, row), shape=A.size)
+    perm = reverse_cuthill_mckee(ones, symmetric_mode=True)
+    return Ordering(perm.astype(np.int64), _data(A.val), key)
+  key = ("rcm", A.pattern_key)
+  return pattern_cache.get(key + (_device_key(A.val),), build)
+
+
+def tile_ordering(h, w, tile, like):
+  """Ordering of the pixels of an h x w image, tile by tile.
+
+  Pixels are row-major within each tile x tile block, blocks are visited in
+  row-major order.
+  """
+  def build():
+    y, x = np.mgrid[0:h, 0:w]
+    perm = np.lexsort(((x % tile).ravel(), (y % tile).ravel(),
+                       (x // tile).ravel(), (y // tile).ravel()))
+    return Ordering(perm.astype(np.int64), _data(like), key)
+  key = ("tiles", h, w, tile)
+  return pattern_cache.get(key + (_device_key(like),), build)
+
+
+def _aggregation_plan(shapes, orderings, like):
+  cols = []
+  coarse_shapes = []
+  offset = 0
+  for (h, w), ordering in zip(shapes, orderings):
+    hc, wc = (h+1) // 2, (w+1) // 2
+    y, x = np.mgrid[0:h, 0:w]
+    col = offset + ((y // 2)*wc + x // 2).ravel()
+    if ordering is not None:
+      # the i-th unknown is pixel perm[i]
+      col[ordering.host_inverse] = col.copy()
+    cols.append(col)
+    coarse_shapes.append((hc, wc))
+    offset += hc*wc
+  col = np.concatenate(cols)
+  row = np.arange(col.size + 1)
+  return AggregationPlan(_upload(row.astype(np.int32), like),
+                         _upload(col.astype(np.int32), like), offset,
+                         coarse_shapes)
+
+
+def pixel_aggregation(shapes, like, orderings=None):
+  """Aggregation of the pixels of images into their 2x2 blocks.
+
+  `shapes` are the (h, w) of the images whose pixels are stacked in the
+  unknowns, `orderings` their Ordering (or None) when their systems are
+  reordered. Returns (P, coarse_shapes): P is the n x nc 0/1 matrix mapping
+  each coarse pixel to its fine pixels, coarse pixels are row-major.
+  """
+  shapes = [tuple(int(d) for d in s) for s in shapes]
+  if orderings is None:
+    orderings = [None]*len(shapes)
+  key = ("aggregation", tuple(shapes),
+         tuple(o.key if o is not None else None for o in orderings))
+  plan = pattern_cache.get(key + (_device_key(like),),
+                           lambda: _aggregation_plan(shapes, orderings, _data(like)))
+  n = plan.col_idx.numel()
+  P = Sparse(Variable(plan.csr_row_idx), Variable(plan.col_idx),
+             Variable(_data(like).new(n).fill_(1)),
+             th.Size((n, plan.cols)), pattern_key=key)
+  return P, plan.coarse_shapes
+
+
+def _permute_plan(A, ordering):
+  row, col = A.host_pattern()
+  inverse = ordering.host_inverse
+  new_row = inverse[spcpu._csr_rows(row, col.size)]
+  new_col = inverse[col]
+  source = np.lexsort((new_col, new_row))
+  like = _data(A.val)
+  return PermutePlan(
+      _upload(spcpu._row_ptr(new_row[source], A.size[0]), like),
+      _upload(new_col[source].astype(np.int32), like),
+      _upload(source.astype(np.int64), like))
+
+
+def permute(A, ordering):
+  """P.A.Pt, the square matrix A with rows and columns in `ordering`."""
+  if A.size[0] != A.size[1] or A.size[0] != len(ordering):
+    raise ValueError("permute: A should be square and match the ordering.")
+  if isinstance(A, Diagonal):
+    return Diagonal(ordering.vector(A.val), A.size)
+  key = ("permute", ordering.key, A.pattern_key)
+  plan = pattern_cache.get(key + (_device_key(A.val),),
+                           lambda: _permute_plan(A, ordering))
+  val = A.val.index_select(0, Variable(plan.source))
+  return Sparse(Variable(plan.csr_row_idx), Variable(plan.col_idx), val,
+                A.size, pattern_key=key)
+
+
+def set_cpu_engine(name, threads=0):
+  """Run the CPU products with scipy ("scipy") or with the OpenMP kernels of
+  the native extension ("omp"), on `threads` threads (0: all cores)."""
+  spcpu.set_engine(name, threads)
+
+
+def spmv(A, v, engine=None):
+  """Sparse matrix - dense vector product.
+
+  `engine` overrides the CPU engine (see set_cpu_engine) for this product,
+  the backward pass runs with the current one.
+  """
+  if isinstance(A, Diagonal):
+    return A.val.mul(v)
+  if isinstance(A, MatrixFree):
+    return A.matmul(v)
+  # the transpose is only built if the backward pass runs
+  with spcpu.engine(engine):
+    return spfuncs.SpMV.apply(A.csr_row_idx, A.col_idx, A.val, v, A.size,
+                              functools.partial(A.csc, A.val))
+
+
+def spmv_dot(A, v):
+  """A.v and v.(A.v) for A square, in a single pass over the matrix."""
+  if isinstance(A, (Diagonal, MatrixFree)):
+    Av = spmv(A, v)
+    return Av, v.dot(Av)
+  return spfuncs.SpMVDot.apply(A.csr_row_idx, A.col_idx, A.val, v, A.size,
+                               functools.partial(A.csc, A.val))
+
+
+def spmm_dense(A, X, engine=None):
+  """Sparse matrix - dense matrix product, X has one vector per column.
+
+  The matrix is streamed once for all columns of X. `engine` is as in spmv.
+  """
+  if X.dim() == 1:
+    return spmv(A, X, engine)
+  if isinstance(A, Diagonal):
+    return A.val.view(-1, 1).mul(X)
+  if isinstance(A, MatrixFree):
+    return th.stack([A.matmul(X[:, j]) for j in range(X.shape[1])], 1)
+  with spcpu.engine(engine):
+    return spfuncs.SpMMDense.apply(A.csr_row_idx, A.col_idx, A.val, X, A.size,
+                                   functools.partial(A.csc, A.val))
+
+
+def _spmm_plan(A, B):
+  rowA, colA = A.host_pattern()
+  rowB, colB = B.host_pattern()
+  rows, inner, outer = A.size[0], A.size[1], B.size[1]
+  rowC, colC = spcpu.spmm_symbolic(rowA, colA, rowB, colB, rows, inner, outer)
+  like = _data(A.val)
+  return SpMMPlan(A.structure, B.structure,
+                  Structure(rowC, colC, outer, like), rows, inner, outer)
+
+
+def _coo_rows(A):
+  """Row index of each nonzero of A, as a LongTensor on A's device."""
+  def build():
+    row, col = A.host_pattern()
+    return _upload(spcpu._csr_rows(row, col.size), _data(A.val))
+  return pattern_cache.get(
+      ("coo_rows", A.pattern_key, _device_key(A.val)), build)
 
 
 def spmm(A, B):
-  """Sparse matrix product."""
-  rowC, colC, valC = spfuncs.SpMM.apply(
-      A.csr_row_idx, A.col_idx, A.val, A.size,
-      B.csr_row_idx, B.col_idx, B.val, B.size)
+  """Sparse matrix product.
+
+  The output pattern and the transposed structures used by the numeric
+  passes are computed once per pair of input patterns and cached in
+  `pattern_cache`. A Diagonal operand scales the rows (or columns) of the
+  other one, which keeps its pattern.
+  """
+  if A.size[1] != B.size[0]:
+    raise ValueError("spmm: A and B should have compatible inner dimensions.")
+  if isinstance(A, Diagonal) and isinstance(B, Diagonal):
+    return Diagonal(A.val.mul(B.val), A.size)
+  if isinstance(A, Diagonal):
+    valC = A.val.index_select(0, Variable(_coo_rows(B))).mul(B.val)
+    return Sparse(B.csr_row_idx, B.col_idx, valC, B.size,
+                  pattern_key=B._pattern_key)
+  if isinstance(B, Diagonal):
+    valC = A.val.mul(B.val.index_select(0, A.col_idx.long()))
+    return Sparse(A.csr_row_idx, A.col_idx, valC, A.size,
+                  pattern_key=A._pattern_key)
+  key = ("spmm", A.pattern_key, B.pattern_key)
+  plan = pattern_cache.get(key + (_device_key(A.val),),
+                           lambda: _spmm_plan(A, B))
+  valC = spfuncs.SpMMNumeric.apply(A.val, B.val, plan)
   sizeC = th.Size((A.size[0], B.size[1]))
-  return Sparse(rowC, colC, valC, sizeC)
+  C = Sparse(Variable(plan.c.csr_row_idx), Variable(plan.c.col_idx), valC,
+             sizeC, pattern_key=key)
+  C._structure = plan.c
+  return C
+
+
+def _gram_plan(A):
+  row, col = A.host_pattern()
+  rows, cols = A.size[0], A.size[1]
+  rowC, colC = spcpu.gram_symbolic(row, col, rows, cols)
+  like = _data(A.val)
+  return GramPlan(A.structure, Structure(rowC, colC, cols, like), rows, cols)
 
 
 def sp_gram(s_mat):
   """A^T.A for A sparse"""
-  raise NotImplemented
+  key = ("gram", s_mat.pattern_key)
+  plan = pattern_cache.get(key + (_device_key(s_mat.val),),
+                           lambda: _gram_plan(s_mat))
+  valC = spfuncs.SpGram.apply(s_mat.val, plan)
+  sizeC = th.Size((s_mat.size[1], s_mat.size[1]))
+  C = Sparse(Variable(plan.c.csr_row_idx), Variable(plan.c.col_idx), valC,
+             sizeC, pattern_key=key)
+  C._structure = plan.c
+  return C
+
+
+def _laplacian_plan(A, symmetrize):
+  rowL, colL, maps = spcpu.laplacian_symbolic(
+      _host(A.csr_row_idx), _host(A.col_idx), A.size[0], symmetrize)
+  like = _data(A.val)
+  return SpAddPlan(_upload(rowL, like), _upload(colL, like),
+                   [_upload(m, like) for m in maps])
+
 
+def sp_laplacian(s_mat, symmetrize=False):
+  """diag(row_sum(A)) - A for A sparse
 
-def sp_laplacian(s_mat):
-  """diag(row_sum(A)) - A for A sparse"""
-  # row_sum = spmv(A, )
-  raise NotImplemented
+  With `symmetrize`, A is first replaced by (A + A^T)/2. The result is built
+  in a single scatter of A's values into a cached pattern.
+  """
+  if s_mat.size[0] != s_mat.size[1]:
+    raise ValueError("sp_laplacian: the matrix should be square.")
+  key = ("laplacian", symmetrize, s_mat.pattern_key)
+  plan = pattern_cache.get(key + (_device_key(s_mat.val),),
+                           lambda: _laplacian_plan(s_mat, symmetrize))
+  if symmetrize:
+    scales = (-0.5, 0.5, -0.5, 0.5)
+  else:
+    scales = (-1.0, 1.0)
+  valL = spfuncs.SpAddNumeric.apply(plan, scales, *([s_mat.val]*len(scales)))
+  return Sparse(Variable(plan.csr_row_idx), Variable(plan.col_idx), valL,
+                s_mat.size, pattern_key=key)
@@ -642,3 +642,270 @@ int spmm_backward(
 
   return 0;
 }
+
+
+int spmm_sampled(
+    THCudaIntTensor *A_csr_row, THCudaIntTensor *A_csr_col, THCudaTensor *A_val,
+    THCudaIntTensor *B_csr_row, THCudaIntTensor *B_csr_col, THCudaTensor *B_val,
+    THCudaIntTensor *C_coo_row, THCudaIntTensor *C_col, THCudaTensor *C_val,
+    const long inner) {
+
+  // C_ij = sum_k A_ik.B_jk, only for the (i, j) listed in C's pattern.
+  THCAssertSameGPU(THCudaTensor_checkGPU(
+        state, 9,
+        A_csr_row, A_csr_col, A_val,
+        B_csr_row, B_csr_col, B_val,
+        C_coo_row, C_col, C_val));
+
+  long nnzC = THCudaIntTensor_size(state, C_col, 0);
+  THArgCheck(nnzC == THCudaIntTensor_size(state, C_coo_row, 0), 7,
+      "C rows and cols should have nnz entries");
+
+  // Grab reference
+  A_csr_row = THCudaIntTensor_newContiguous(state, A_csr_row);
+  A_csr_col = THCudaIntTensor_newContiguous(state, A_csr_col);
+  A_val = THCudaTensor_newContiguous(state, A_val);
+  B_csr_row = THCudaIntTensor_newContiguous(state, B_csr_row);
+  B_csr_col = THCudaIntTensor_newContiguous(state, B_csr_col);
+  B_val = THCudaTensor_newContiguous(state, B_val);
+  C_coo_row = THCudaIntTensor_newContiguous(state, C_coo_row);
+  C_col = THCudaIntTensor_newContiguous(state, C_col);
+
+  THCudaTensor_resize1d(state, C_val, nnzC);
+
+  matmul_preserve_sparsity_cuda(
+      THCudaIntTensor_data(state, A_csr_row),
+      THCudaIntTensor_data(state, A_csr_col),
+      THCudaTensor_data(state, A_val),
+      THCudaIntTensor_data(state, B_csr_row),
+      THCudaIntTensor_data(state, B_csr_col),
+      THCudaTensor_data(state, B_val),
+      THCudaIntTensor_data(state, C_coo_row),
+      THCudaIntTensor_data(state, C_col),
+      THCudaTensor_data(state, C_val), nnzC);
+
+  // Release references
+  THCudaIntTensor_free(state, A_csr_row);
+  THCudaIntTensor_free(state, A_csr_col);
+  THCudaTensor_free(state, A_val);
+  THCudaIntTensor_free(state, B_csr_row);
+  THCudaIntTensor_free(state, B_csr_col);
+  THCudaTensor_free(state, B_val);
+  THCudaIntTensor_free(state, C_coo_row);
+  THCudaIntTensor_free(state, C_col);
+
+  return 0;
+}
+
+
+int spmm_dense(
+    THCudaIntTensor *csr_row, THCudaIntTensor *csr_col, THCudaTensor *val,
+    THCudaTensor *dense,
+    THCudaTensor *output,
+    const long rows, const long cols) {
+
+  // output = A.dense, with dense a (cols x k) row-major matrix
+  THCAssertSameGPU(THCudaTensor_checkGPU(
+        state, 5, csr_row, csr_col, val, dense, output));
+
+  long nnz = THCudaTensor_size(state, val, 0);
+
+  THArgCheck(rows+1 == THCudaIntTensor_size(state, csr_row, 0), 0,
+      "csr rows should have rows+1 entries");
+  THArgCheck(nnz == THCudaIntTensor_size(state, csr_col, 0), 1,
+      "csr cols should have nnz entries");
+  THArgCheck(THCudaTensor_nDimension(state, dense) == 2, 3,
+      "dense should be a 2D matrix");
+  THArgCheck(cols == THCudaTensor_size(state, dense, 0), 3,
+      "cols should match the rows of dense");
+
+  long k = THCudaTensor_size(state, dense, 1);
+
+  // Grab a reference
+  csr_row = THCudaIntTensor_newContiguous(state, csr_row);
+  csr_col = THCudaIntTensor_newContiguous(state, csr_col);
+  val = THCudaTensor_newContiguous(state, val);
+  dense = THCudaTensor_newContiguous(state, dense);
+
+  // Setup cusparse
+  cusparseHandle_t handle = THCState_getCurrentSparseHandle(state);
+  cusparseMatDescr_t descr=0;
+  THCusparseCheck(cusparseCreateMatDescr(&descr));
+  THCusparseCheck(cusparseSetMatType(descr, CUSPARSE_MATRIX_TYPE_GENERAL));
+  THCusparseCheck(cusparseSetMatIndexBase(descr, CUSPARSE_INDEX_BASE_ZERO));
+
+  // A row-major (cols x k) matrix is a column-major (k x cols) one: cusparse
+  // reads it transposed and writes a column-major (rows x k) result, i.e.
+  // a row-major (k x rows) one that is transposed back into output.
+  THCudaTensor *scratch = THCudaTensor_newWithSize2d(state, k, rows);
+  float zero = 0.0f;
+  float one = 1.0f;
+  THCusparseCheck(cusparseScsrmm2(handle,
+        CUSPARSE_OPERATION_NON_TRANSPOSE, CUSPARSE_OPERATION_TRANSPOSE,
+        rows, k, cols, nnz, &one, descr,
+        THCudaTensor_data(state, val),
+        THCudaIntTensor_data(state, csr_row),
+        THCudaIntTensor_data(state, csr_col),
+        THCudaTensor_data(state, dense), k,
+        &zero, THCudaTensor_data(state, scratch), rows));
+
+  THCudaTensor_resize2d(state, output, rows, k);
+  THCudaTensor_transpose(state, scratch, NULL, 0, 1);
+  THCudaTensor_copy(state, output, scratch);
+
+  // Release references
+  THCusparseCheck(cusparseDestroyMatDescr(descr));
+  THCudaTensor_free(state, scratch);
+  THCudaIntTensor_free(state, csr_row);
+  THCudaIntTensor_free(state, csr_col);
+  THCudaTensor_free(state, val);
+  THCudaTensor_free(state, dense);
+  return 0;
+}
+
+
+int spmm_dense_backward_matrix(
+    THCudaIntTensor *csr_row, THCudaIntTensor *csr_col,
+    THCudaTensor *dense,
+    THCudaTensor *grad_output,
+    THCudaTensor *grad_matrix,
+    const long rows, const long cols) {
+
+  // C = A.X
+  // dL/dA_ij = sum_k dL/dC_ik.X_jk, on A's pattern
+  cusparseHandle_t handle = THCState_getCurrentSparseHandle(state);
+
+  long nnz = THCudaIntTensor_size(state, csr_col, 0);
+  long k = THCudaTensor_size(state, dense, 1);
+
+  // Grab references
+  csr_row = THCudaIntTensor_newContiguous(state, csr_row);
+  csr_col = THCudaIntTensor_newContiguous(state, csr_col);
+  dense = THCudaTensor_newContiguous(state, dense);
+  grad_output = THCudaTensor_newContiguous(state, grad_output);
+
+  int* p_cooRow;
+  THCudaCheck(THCudaMalloc(state, (void**) &p_cooRow, nnz*sizeof(int)));
+  THCusparseCheck(cusparseXcsr2coo(
+      handle, THCudaIntTensor_data(state, csr_row), nnz, rows, p_cooRow,
+      CUSPARSE_INDEX_BASE_ZERO));
+
+  THCudaTensor_resize1d(state, grad_matrix, nnz);
+
+  spmm_dense_backward_matrix_cuda(
+      p_cooRow, THCudaIntTensor_data(state, csr_col),
+      THCudaTensor_data(state, dense),
+      THCudaTensor_data(state, grad_output),
+      THCudaTensor_data(state, grad_matrix), k, nnz);
+
+  // Free scratch data
+  THCudaCheck(THCudaFree(state, p_cooRow));
+
+  // Release references
+  THCudaIntTensor_free(state, csr_row);
+  THCudaIntTensor_free(state, csr_col);
+  THCudaTensor_free(state, dense);
+  THCudaTensor_free(state, grad_output);
+
+  return 0;
+}
+
+
+int spmv_dot(
+    THCudaIntTensor *csr_row, THCudaIntTensor *csr_col, THCudaTensor *val,
+    THCudaTensor *vector,
+    THCudaTensor *output, THCudaTensor *dot,
+    const long rows, const long cols) {
+
+  // output = A.vector and dot = vector.output, in a single pass
+  THCAssertSameGPU(THCudaTensor_checkGPU(
+        state, 6, csr_row, csr_col, val, vector, output, dot));
+
+  THArgCheck(rows == cols, 6, "spmv_dot: the matrix should be square");
+  THArgCheck(rows+1 == THCudaIntTensor_size(state, csr_row, 0), 0,
+      "csr rows should have rows+1 entries");
+  THArgCheck(cols == THCudaTensor_size(state, vector, 0), 3,
+      "cols should match vector size");
+
+  // Grab a reference
+  csr_row = THCudaIntTensor_newContiguous(state, csr_row);
+  csr_col = THCudaIntTensor_newContiguous(state, csr_col);
+  val = THCudaTensor_newContiguous(state, val);
+  vector = THCudaTensor_newContiguous(state, vector);
+
+  THCudaTensor_resize1d(state, output, rows);
+  THCudaTensor_resize1d(state, dot, 1);
+  THCudaTensor_zero(state, dot);
+
+  spmv_dot_cuda(
+      THCudaIntTensor_data(state, csr_row),
+      THCudaIntTensor_data(state, csr_col),
+      THCudaTensor_data(state, val),
+      THCudaTensor_data(state, vector),
+      THCudaTensor_data(state, output),
+      THCudaTensor_data(state, dot), rows);
+
+  // Release references
+  THCudaIntTensor_free(state, csr_row);
+  THCudaIntTensor_free(state, csr_col);
+  THCudaTensor_free(state, val);
+  THCudaTensor_free(state, vector);
+  return 0;
+}
+
+
+int cg_update(
+    THCudaTensor *x, THCudaTensor *r, THCudaTensor *p, THCudaTensor *Ap,
+    THCudaTensor *rr, THCudaTensor *pAp, THCudaTensor *rr_new) {
+
+  // alpha = rr/pAp, x += alpha.p, r -= alpha.Ap and rr_new = r.r, in place
+  THCAssertSameGPU(THCudaTensor_checkGPU(
+        state, 7, x, r, p, Ap, rr, pAp, rr_new));
+
+  long n = THCudaTensor_size(state, x, 0);
+  THArgCheck(THCudaTensor_isContiguous(state, x), 0, "x should be contiguous");
+  THArgCheck(THCudaTensor_isContiguous(state, r), 1, "r should be contiguous");
+  THArgCheck(n == THCudaTensor_size(state, r, 0), 1, "x and r sizes differ");
+
+  // Grab a reference
+  p = THCudaTensor_newContiguous(state, p);
+  Ap = THCudaTensor_newContiguous(state, Ap);
+
+  THCudaTensor_resize1d(state, rr_new, 1);
+  THCudaTensor_zero(state, rr_new);
+
+  cg_update_cuda(
+      THCudaTensor_data(state, x), THCudaTensor_data(state, r),
+      THCudaTensor_data(state, p), THCudaTensor_data(state, Ap),
+      THCudaTensor_data(state, rr), THCudaTensor_data(state, pAp),
+      THCudaTensor_data(state, rr_new), n);
+
+  // Release references
+  THCudaTensor_free(state, p);
+  THCudaTensor_free(state, Ap);
+  return 0;
+}
+
+
+int cg_direction(
+    THCudaTensor *p, THCudaTensor *r, THCudaTensor *rr_new,
+    THCudaTensor *rr_old) {
+
+  // p = r + rr_new/rr_old.p, in place
+  THCAssertSameGPU(THCudaTensor_checkGPU(state, 4, p, r, rr_new, rr_old));
+
+  long n = THCudaTensor_size(state, p, 0);
+  THArgCheck(THCudaTensor_isContiguous(state, p), 0, "p should be contiguous");
+  THArgCheck(n == THCudaTensor_size(state, r, 0), 1, "p and r sizes differ");
+
+  // Grab a reference
+  r = THCudaTensor_newContiguous(state, r);
+
+  cg_direction_cuda(
+      THCudaTensor_data(state, p), THCudaTensor_data(state, r),
+      THCudaTensor_data(state, rr_new), THCudaTensor_data(state, rr_old), n);
+
+  // Release references
+  THCudaTensor_free(state, r);
+  return 0;
+}
@@ -58,3 +58,35 @@ int spmm_backward(
     const long rowsB, const long colsB,
     THCudaIntTensor *C_csr_row, THCudaIntTensor *C_csr_col, THCudaTensor *C_grad_val);
 
+int spmm_sampled(
+    THCudaIntTensor *A_csr_row, THCudaIntTensor *A_csr_col, THCudaTensor *A_val,
+    THCudaIntTensor *B_csr_row, THCudaIntTensor *B_csr_col, THCudaTensor *B_val,
+    THCudaIntTensor *C_coo_row, THCudaIntTensor *C_col, THCudaTensor *C_val,
+    const long inner);
+
+int spmm_dense(
+    THCudaIntTensor *csr_row, THCudaIntTensor *csr_col, THCudaTensor *val,
+    THCudaTensor *dense,
+    THCudaTensor *output,
+    const long rows, const long cols);
+
+int spmm_dense_backward_matrix(
+    THCudaIntTensor *csr_row, THCudaIntTensor *csr_col,
+    THCudaTensor *dense,
+    THCudaTensor *grad_output,
+    THCudaTensor *grad_matrix,
+    const long rows, const long cols);
+
+int spmv_dot(
+    THCudaIntTensor *csr_row, THCudaIntTensor *csr_col, THCudaTensor *val,
+    THCudaTensor *vector,
+    THCudaTensor *output, THCudaTensor *dot,
+    const long rows, const long cols);
+
+int cg_update(
+    THCudaTensor *x, THCudaTensor *r, THCudaTensor *p, THCudaTensor *Ap,
+    THCudaTensor *rr, THCudaTensor *pAp, THCudaTensor *rr_new);
+
+int cg_direction(
+    THCudaTensor *p, THCudaTensor *r, THCudaTensor *rr_new,
+    THCudaTensor *rr_old);
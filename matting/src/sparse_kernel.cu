@@ -31,6 +31,130 @@ void spmv_backward_matrix_cuda(
 
 
 
+__global__ void spmm_dense_backward_matrix_kernel(
+    const int* p_cooRow, const int* p_csrCol, const float* p_dense,
+    const float* p_grad_output, float* p_grad_matrix,
+    const int k, const int nnz) {
+  const int64_t idx = blockIdx.x*blockDim.x + threadIdx.x;
+  if (idx < nnz) {
+    const float* grad_row = p_grad_output + p_cooRow[idx]*k;
+    const float* dense_row = p_dense + p_csrCol[idx]*k;
+    float acc = 0.0f;
+    for (int j = 0; j < k; ++j) {
+      acc += grad_row[j]*dense_row[j];
+    }
+    p_grad_matrix[idx] = acc;
+  }
+}
+
+
+void spmm_dense_backward_matrix_cuda(
+    const int* p_cooRow, const int* p_csrCol, const float* p_dense,
+    const float* p_grad_output, float* p_grad_matrix,
+    const int k, const int nnz) {
+
+  const int64_t block_sz = 512;
+  const int64_t nblocks = (nnz + block_sz - 1) / block_sz;
+  spmm_dense_backward_matrix_kernel<<<nblocks, block_sz, 0, THCState_getCurrentStream(state)>>>(
+      p_cooRow, p_csrCol, p_dense, p_grad_output, p_grad_matrix, k, nnz);
+  THCudaCheck(cudaPeekAtLastError());
+}
+
+
+// Sum `value` over the block and add it to *out, blockDim.x is a power of 2.
+__device__ void block_reduce_add(float value, float* out) {
+  __shared__ float partial[512];
+  partial[threadIdx.x] = value;
+  __syncthreads();
+  for (int s = blockDim.x / 2; s > 0; s >>= 1) {
+    if (threadIdx.x < s) {
+      partial[threadIdx.x] += partial[threadIdx.x + s];
+    }
+    __syncthreads();
+  }
+  if (threadIdx.x == 0) {
+    atomicAdd(out, partial[0]);
+  }
+}
+
+
+__global__ void spmv_dot_kernel(
+    const int* p_csrRow, const int* p_csrCol, const float* p_val,
+    const float* p_vector, float* p_output, float* p_dot, const int rows) {
+  const int64_t idx = blockIdx.x*blockDim.x + threadIdx.x;
+  float acc = 0.0f;
+  if (idx < rows) {
+    float y = 0.0f;
+    for (int ptr = p_csrRow[idx]; ptr < p_csrRow[idx+1]; ++ptr) {
+      y += p_val[ptr]*p_vector[p_csrCol[ptr]];
+    }
+    p_output[idx] = y;
+    acc = p_vector[idx]*y;
+  }
+  block_reduce_add(acc, p_dot);
+}
+
+
+void spmv_dot_cuda(
+    const int* p_csrRow, const int* p_csrCol, const float* p_val,
+    const float* p_vector, float* p_output, float* p_dot, const int rows) {
+  const int64_t block_sz = 512;
+  const int64_t nblocks = (rows + block_sz - 1) / block_sz;
+  spmv_dot_kernel<<<nblocks, block_sz, 0, THCState_getCurrentStream(state)>>>(
+      p_csrRow, p_csrCol, p_val, p_vector, p_output, p_dot, rows);
+  THCudaCheck(cudaPeekAtLastError());
+}
+
+
+__global__ void cg_update_kernel(
+    float* p_x, float* p_r, const float* p_p, const float* p_Ap,
+    const float* p_rr, const float* p_pAp, float* p_rr_new, const int n) {
+  const int64_t idx = blockIdx.x*blockDim.x + threadIdx.x;
+  const float alpha = p_rr[0] / p_pAp[0];
+  float acc = 0.0f;
+  if (idx < n) {
+    p_x[idx] += alpha*p_p[idx];
+    const float r = p_r[idx] - alpha*p_Ap[idx];
+    p_r[idx] = r;
+    acc = r*r;
+  }
+  block_reduce_add(acc, p_rr_new);
+}
+
+
+void cg_update_cuda(
+    float* p_x, float* p_r, const float* p_p, const float* p_Ap,
+    const float* p_rr, const float* p_pAp, float* p_rr_new, const int n) {
+  const int64_t block_sz = 512;
+  const int64_t nblocks = (n + block_sz - 1) / block_sz;
+  cg_update_kernel<<<nblocks, block_sz, 0, THCState_getCurrentStream(state)>>>(
+      p_x, p_r, p_p, p_Ap, p_rr, p_pAp, p_rr_new, n);
+  THCudaCheck(cudaPeekAtLastError());
+}
+
+
+__global__ void cg_direction_kernel(
+    float* p_p, const float* p_r, const float* p_rr_new, const float* p_rr_old,
+    const int n) {
+  const int64_t idx = blockIdx.x*blockDim.x + threadIdx.x;
+  if (idx < n) {
+    const float beta = p_rr_new[0] / p_rr_old[0];
+    p_p[idx] = p_r[idx] + beta*p_p[idx];
+  }
+}
+
+
+void cg_direction_cuda(
+    float* p_p, const float* p_r, const float* p_rr_new, const float* p_rr_old,
+    const int n) {
+  const int64_t block_sz = 512;
+  const int64_t nblocks = (n + block_sz - 1) / block_sz;
+  cg_direction_kernel<<<nblocks, block_sz, 0, THCState_getCurrentStream(state)>>>(
+      p_p, p_r, p_rr_new, p_rr_old, n);
+  THCudaCheck(cudaPeekAtLastError());
+}
+
+
 __global__ void spadd_backward_kernel(
       const int* p_csr_rowA, const int* p_csr_colA, float* p_gradA, const int nnzA,
       const int* p_csr_rowB, const int* p_csr_colB, float* p_gradB, const int nnzB,
@@ -49,7 +173,7 @@ __global__ void spadd_backward_kernel(
 
     if (ptrA < endA && p_csr_colA[ptrA] == col) {
       // update gradient
-      p_gradA[ptrA] = p_gradC[idx];
+      p_gradA[ptrA] = alpha*p_gradC[idx];
     }
 
     int ptrB = p_csr_rowB[row];
@@ -60,7 +184,7 @@ __global__ void spadd_backward_kernel(
 
     if (ptrB < endB && p_csr_colB[ptrB] == col) {
       // update gradient
-      p_gradB[ptrB] = p_gradC[idx];
+      p_gradB[ptrB] = beta*p_gradC[idx];
     }
 
   }
@@ -10,6 +10,23 @@ void spmv_backward_matrix_cuda(
     const float* p_grad_output, float* p_grad_matrix,
     const int rows, const int cols, const int nnz);
 
+void spmm_dense_backward_matrix_cuda(
+    const int* p_cooRow, const int* p_csrCol, const float* p_dense,
+    const float* p_grad_output, float* p_grad_matrix,
+    const int k, const int nnz);
+
+void spmv_dot_cuda(
+    const int* p_csrRow, const int* p_csrCol, const float* p_val,
+    const float* p_vector, float* p_output, float* p_dot, const int rows);
+
+void cg_update_cuda(
+    float* p_x, float* p_r, const float* p_p, const float* p_Ap,
+    const float* p_rr, const float* p_pAp, float* p_rr_new, const int n);
+
+void cg_direction_cuda(
+    float* p_p, const float* p_r, const float* p_rr_new, const float* p_rr_old,
+    const int n);
+
 void spadd_backward_cuda(
       const int* p_csr_rowA, const int* p_csr_colA, float* p_gradA, const int nnzA,
       const int* p_csr_rowB, const int* p_csr_colB, float* p_gradB, const int nnzB,
@@ -0,0 +1,430 @@
+#include <TH/TH.h>
+#include <math.h>
+#include <omp.h>
+
+// Multithreaded CPU kernels. Rows are split in contiguous chunks holding
+// about the same number of nonzeros, one per thread.
+
+
+static int resolve_threads(const int nthreads) {
+  if (nthreads > 0) {
+    return nthreads;
+  }
+  return omp_get_max_threads();
+}
+
+
+// bounds[t] is the first row of chunk t, bounds[nchunks] = rows.
+static void balance_rows(const int* row_ptr, const long rows,
+                         const int nchunks, long* bounds) {
+  const long nnz = row_ptr[rows];
+  bounds[0] = 0;
+  for (int t = 1; t < nchunks; ++t) {
+    const long target = (nnz*t) / nchunks;
+    long lo = bounds[t-1];
+    long hi = rows;
+    // smallest row whose first nonzero is at or after the target
+    while (lo < hi) {
+      const long mid = (lo + hi) / 2;
+      if (row_ptr[mid] < target) {
+        lo = mid + 1;
+      } else {
+        hi = mid;
+      }
+    }
+    bounds[t] = lo;
+  }
+  bounds[nchunks] = rows;
+}
+
+
+int omp_max_threads() {
+  return omp_get_max_threads();
+}
+
+
+int spmv_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THFloatTensor *vector,
+    THFloatTensor *output,
+    const long rows, const long cols, const int nthreads) {
+
+  THArgCheck(rows+1 == THIntTensor_size(csr_row, 0), 0,
+      "csr rows should have rows+1 entries");
+  THArgCheck(cols == THFloatTensor_size(vector, 0), 3,
+      "cols should match vector size");
+
+  // Grab a reference
+  csr_row = THIntTensor_newContiguous(csr_row);
+  csr_col = THIntTensor_newContiguous(csr_col);
+  val = THFloatTensor_newContiguous(val);
+  vector = THFloatTensor_newContiguous(vector);
+  THFloatTensor_resize1d(output, rows);
+
+  const int *p_row = THIntTensor_data(csr_row);
+  const int *p_col = THIntTensor_data(csr_col);
+  const float *p_val = THFloatTensor_data(val);
+  const float *p_vector = THFloatTensor_data(vector);
+  float *p_output = THFloatTensor_data(output);
+
+  const int nchunks = resolve_threads(nthreads);
+  long *bounds = (long*) THAlloc((nchunks+1)*sizeof(long));
+  balance_rows(p_row, rows, nchunks, bounds);
+
+  #pragma omp parallel num_threads(nchunks)
+  {
+    for (int t = omp_get_thread_num(); t < nchunks; t += omp_get_num_threads()) {
+      for (long i = bounds[t]; i < bounds[t+1]; ++i) {
+        float acc = 0.0f;
+        for (int ptr = p_row[i]; ptr < p_row[i+1]; ++ptr) {
+          acc += p_val[ptr]*p_vector[p_col[ptr]];
+        }
+        p_output[i] = acc;
+      }
+    }
+  }
+
+  // Release references
+  THFree(bounds);
+  THIntTensor_free(csr_row);
+  THIntTensor_free(csr_col);
+  THFloatTensor_free(val);
+  THFloatTensor_free(vector);
+  return 0;
+}
+
+
+int spmv_dot_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THFloatTensor *vector,
+    THFloatTensor *output, THFloatTensor *dot,
+    const long rows, const long cols, const int nthreads) {
+
+  // output = A.vector and dot = vector.output, in a single pass
+  THArgCheck(rows == cols, 6, "spmv_dot: the matrix should be square");
+  THArgCheck(rows+1 == THIntTensor_size(csr_row, 0), 0,
+      "csr rows should have rows+1 entries");
+  THArgCheck(cols == THFloatTensor_size(vector, 0), 3,
+      "cols should match vector size");
+
+  // Grab a reference
+  csr_row = THIntTensor_newContiguous(csr_row);
+  csr_col = THIntTensor_newContiguous(csr_col);
+  val = THFloatTensor_newContiguous(val);
+  vector = THFloatTensor_newContiguous(vector);
+  THFloatTensor_resize1d(output, rows);
+  THFloatTensor_resize1d(dot, 1);
+
+  const int *p_row = THIntTensor_data(csr_row);
+  const int *p_col = THIntTensor_data(csr_col);
+  const float *p_val = THFloatTensor_data(val);
+  const float *p_vector = THFloatTensor_data(vector);
+  float *p_output = THFloatTensor_data(output);
+
+  const int nchunks = resolve_threads(nthreads);
+  long *bounds = (long*) THAlloc((nchunks+1)*sizeof(long));
+  balance_rows(p_row, rows, nchunks, bounds);
+
+  double total = 0.0;
+  #pragma omp parallel num_threads(nchunks) reduction(+:total)
+  {
+    for (int t = omp_get_thread_num(); t < nchunks; t += omp_get_num_threads()) {
+      for (long i = bounds[t]; i < bounds[t+1]; ++i) {
+        float acc = 0.0f;
+        for (int ptr = p_row[i]; ptr < p_row[i+1]; ++ptr) {
+          acc += p_val[ptr]*p_vector[p_col[ptr]];
+        }
+        p_output[i] = acc;
+        total += p_vector[i]*acc;
+      }
+    }
+  }
+  THFloatTensor_set1d(dot, 0, (float) total);
+
+  // Release references
+  THFree(bounds);
+  THIntTensor_free(csr_row);
+  THIntTensor_free(csr_col);
+  THFloatTensor_free(val);
+  THFloatTensor_free(vector);
+  return 0;
+}
+
+
+int spmm_dense_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THFloatTensor *dense,
+    THFloatTensor *output,
+    const long rows, const long cols, const int nthreads) {
+
+  // output = A.dense, with dense a (cols x k) row-major matrix
+  THArgCheck(rows+1 == THIntTensor_size(csr_row, 0), 0,
+      "csr rows should have rows+1 entries");
+  THArgCheck(THFloatTensor_nDimension(dense) == 2, 3,
+      "dense should be a 2D matrix");
+  THArgCheck(cols == THFloatTensor_size(dense, 0), 3,
+      "cols should match the rows of dense");
+
+  const long k = THFloatTensor_size(dense, 1);
+
+  // Grab a reference
+  csr_row = THIntTensor_newContiguous(csr_row);
+  csr_col = THIntTensor_newContiguous(csr_col);
+  val = THFloatTensor_newContiguous(val);
+  dense = THFloatTensor_newContiguous(dense);
+  THFloatTensor_resize2d(output, rows, k);
+
+  const int *p_row = THIntTensor_data(csr_row);
+  const int *p_col = THIntTensor_data(csr_col);
+  const float *p_val = THFloatTensor_data(val);
+  const float *p_dense = THFloatTensor_data(dense);
+  float *p_output = THFloatTensor_data(output);
+
+  const int nchunks = resolve_threads(nthreads);
+  long *bounds = (long*) THAlloc((nchunks+1)*sizeof(long));
+  balance_rows(p_row, rows, nchunks, bounds);
+
+  #pragma omp parallel num_threads(nchunks)
+  {
+    for (int t = omp_get_thread_num(); t < nchunks; t += omp_get_num_threads()) {
+      for (long i = bounds[t]; i < bounds[t+1]; ++i) {
+        float *out_row = p_output + i*k;
+        for (long j = 0; j < k; ++j) {
+          out_row[j] = 0.0f;
+        }
+        for (int ptr = p_row[i]; ptr < p_row[i+1]; ++ptr) {
+          const float a = p_val[ptr];
+          const float *dense_row = p_dense + ((long) p_col[ptr])*k;
+          for (long j = 0; j < k; ++j) {
+            out_row[j] += a*dense_row[j];
+          }
+        }
+      }
+    }
+  }
+
+  // Release references
+  THFree(bounds);
+  THIntTensor_free(csr_row);
+  THIntTensor_free(csr_col);
+  THFloatTensor_free(val);
+  THFloatTensor_free(dense);
+  return 0;
+}
+
+
+int spmm_sampled_omp(
+    THIntTensor *A_csr_row, THIntTensor *A_csr_col, THFloatTensor *A_val,
+    THIntTensor *B_csr_row, THIntTensor *B_csr_col, THFloatTensor *B_val,
+    THIntTensor *C_coo_row, THIntTensor *C_col, THFloatTensor *C_val,
+    const int nthreads) {
+
+  // C_ij = sum_k A_ik.B_jk for the (i, j) of C's pattern: row i of A is
+  // intersected with row j of B, both sorted by column.
+  THArgCheck(THIntTensor_size(A_csr_col, 0) == THFloatTensor_size(A_val, 0),
+      2, "A's columns and values should have the same size");
+  THArgCheck(THIntTensor_size(B_csr_col, 0) == THFloatTensor_size(B_val, 0),
+      5, "B's columns and values should have the same size");
+  THArgCheck(THIntTensor_size(C_coo_row, 0) == THIntTensor_size(C_col, 0),
+      7, "C's rows and columns should have the same size");
+
+  const long nnz = THIntTensor_size(C_col, 0);
+
+  // Grab a reference
+  A_csr_row = THIntTensor_newContiguous(A_csr_row);
+  A_csr_col = THIntTensor_newContiguous(A_csr_col);
+  A_val = THFloatTensor_newContiguous(A_val);
+  B_csr_row = THIntTensor_newContiguous(B_csr_row);
+  B_csr_col = THIntTensor_newContiguous(B_csr_col);
+  B_val = THFloatTensor_newContiguous(B_val);
+  C_coo_row = THIntTensor_newContiguous(C_coo_row);
+  C_col = THIntTensor_newContiguous(C_col);
+  THFloatTensor_resize1d(C_val, nnz);
+
+  const int *p_rowA = THIntTensor_data(A_csr_row);
+  const int *p_colA = THIntTensor_data(A_csr_col);
+  const float *p_valA = THFloatTensor_data(A_val);
+  const int *p_rowB = THIntTensor_data(B_csr_row);
+  const int *p_colB = THIntTensor_data(B_csr_col);
+  const float *p_valB = THFloatTensor_data(B_val);
+  const int *p_rowC = THIntTensor_data(C_coo_row);
+  const int *p_colC = THIntTensor_data(C_col);
+  float *p_valC = THFloatTensor_data(C_val);
+
+  #pragma omp parallel for num_threads(resolve_threads(nthreads)) schedule(dynamic, 1024)
+  for (long idx = 0; idx < nnz; ++idx) {
+    const int i = p_rowC[idx];
+    const int j = p_colC[idx];
+    int a = p_rowA[i];
+    int b = p_rowB[j];
+    const int end_a = p_rowA[i+1];
+    const int end_b = p_rowB[j+1];
+    float acc = 0.0f;
+    while (a < end_a && b < end_b) {
+      if (p_colA[a] < p_colB[b]) {
+        ++a;
+      } else if (p_colA[a] > p_colB[b]) {
+        ++b;
+      } else {
+        acc += p_valA[a]*p_valB[b];
+        ++a;
+        ++b;
+      }
+    }
+    p_valC[idx] = acc;
+  }
+
+  // Release references
+  THIntTensor_free(A_csr_row);
+  THIntTensor_free(A_csr_col);
+  THFloatTensor_free(A_val);
+  THIntTensor_free(B_csr_row);
+  THIntTensor_free(B_csr_col);
+  THFloatTensor_free(B_val);
+  THIntTensor_free(C_coo_row);
+  THIntTensor_free(C_col);
+  return 0;
+}
+
+
+// Factorizes row i of L in place, the rows it depends on are done. The
+// diagonal is the last entry of the row. Returns 1 on a non-positive pivot.
+static int ic0_row(const int *p_row, const int *p_col, float *p_val,
+                   const long i) {
+  const int start = p_row[i];
+  const int diag = p_row[i+1] - 1;
+  int breakdown = 0;
+  for (int ptr = start; ptr <= diag; ++ptr) {
+    const int j = p_col[ptr];
+    const int j_diag = p_row[j+1] - 1;
+    // sum of L_ik.L_jk over the k < j in both rows
+    double s = 0.0;
+    int a = start;
+    int b = p_row[j];
+    while (a < ptr && b < j_diag) {
+      if (p_col[a] < p_col[b]) {
+        ++a;
+      } else if (p_col[a] > p_col[b]) {
+        ++b;
+      } else {
+        s += p_val[a]*p_val[b];
+        ++a;
+        ++b;
+      }
+    }
+    if (ptr == diag) {
+      double d = p_val[ptr] - s;
+      if (d <= 0.0) {
+        breakdown = 1;
+        d = fabs(d) + 1e-12;
+      }
+      p_val[ptr] = (float) sqrt(d);
+    } else {
+      p_val[ptr] = (float) ((p_val[ptr] - s) / p_val[j_diag]);
+    }
+  }
+  return breakdown;
+}
+
+
+int ic0_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THIntTensor *level_rows, THIntTensor *level_ptr, const int nthreads) {
+
+  // IC(0) in place: val holds the lower triangle of A, rows are
+  // factorized level by level, the rows of a level in parallel.
+  THArgCheck(THFloatTensor_isContiguous(val), 2, "val should be contiguous");
+  THArgCheck(THIntTensor_size(csr_col, 0) == THFloatTensor_size(val, 0), 2,
+      "csr_col and val should have the same size");
+
+  // Grab a reference
+  csr_row = THIntTensor_newContiguous(csr_row);
+  csr_col = THIntTensor_newContiguous(csr_col);
+  level_rows = THIntTensor_newContiguous(level_rows);
+  level_ptr = THIntTensor_newContiguous(level_ptr);
+
+  const int *p_row = THIntTensor_data(csr_row);
+  const int *p_col = THIntTensor_data(csr_col);
+  const int *p_lrows = THIntTensor_data(level_rows);
+  const int *p_lptr = THIntTensor_data(level_ptr);
+  float *p_val = THFloatTensor_data(val);
+  const long nlevels = THIntTensor_size(level_ptr, 0) - 1;
+
+  int breakdown = 0;
+  #pragma omp parallel num_threads(resolve_threads(nthreads)) reduction(|:breakdown)
+  {
+    for (long l = 0; l < nlevels; ++l) {
+      #pragma omp for schedule(dynamic, 64)
+      for (long r = p_lptr[l]; r < p_lptr[l+1]; ++r) {
+        breakdown |= ic0_row(p_row, p_col, p_val, p_lrows[r]);
+      }
+    }
+  }
+
+  // Release references
+  THIntTensor_free(csr_row);
+  THIntTensor_free(csr_col);
+  THIntTensor_free(level_rows);
+  THIntTensor_free(level_ptr);
+  return breakdown;
+}
+
+
+int sptrsv_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THIntTensor *level_rows, THIntTensor *level_ptr,
+    THFloatTensor *rhs,
+    THFloatTensor *output,
+    const int diag_last, const int nthreads) {
+
+  // Triangular solve T.output = rhs, level by level. The diagonal is the
+  // last (lower triangular T) or first (upper triangular T) entry of a row.
+  const long rows = THIntTensor_size(csr_row, 0) - 1;
+  THArgCheck(rows == THFloatTensor_size(rhs, 0), 5,
+      "rhs should have one entry per row");
+
+  // Grab a reference
+  csr_row = THIntTensor_newContiguous(csr_row);
+  csr_col = THIntTensor_newContiguous(csr_col);
+  val = THFloatTensor_newContiguous(val);
+  level_rows = THIntTensor_newContiguous(level_rows);
+  level_ptr = THIntTensor_newContiguous(level_ptr);
+  rhs = THFloatTensor_newContiguous(rhs);
+  THFloatTensor_resize1d(output, rows);
+
+  const int *p_row = THIntTensor_data(csr_row);
+  const int *p_col = THIntTensor_data(csr_col);
+  const float *p_val = THFloatTensor_data(val);
+  const int *p_lrows = THIntTensor_data(level_rows);
+  const int *p_lptr = THIntTensor_data(level_ptr);
+  const float *p_rhs = THFloatTensor_data(rhs);
+  float *p_output = THFloatTensor_data(output);
+  const long nlevels = THIntTensor_size(level_ptr, 0) - 1;
+
+  #pragma omp parallel num_threads(resolve_threads(nthreads))
+  {
+    for (long l = 0; l < nlevels; ++l) {
+      #pragma omp for schedule(static)
+      for (long r = p_lptr[l]; r < p_lptr[l+1]; ++r) {
+        const long i = p_lrows[r];
+        const int diag = diag_last ? p_row[i+1] - 1 : p_row[i];
+        const int first = diag_last ? p_row[i] : p_row[i] + 1;
+        const int last = diag_last ? p_row[i+1] - 1 : p_row[i+1];
+        float acc = 0.0f;
+        for (int ptr = first; ptr < last; ++ptr) {
+          acc += p_val[ptr]*p_output[p_col[ptr]];
+        }
+        p_output[i] = (p_rhs[i] - acc) / p_val[diag];
+      }
+    }
+  }
+
+  // Release references
+  THIntTensor_free(csr_row);
+  THIntTensor_free(csr_col);
+  THFloatTensor_free(val);
+  THIntTensor_free(level_rows);
+  THIntTensor_free(level_ptr);
+  THFloatTensor_free(rhs);
+  return 0;
+}
@@ -0,0 +1,36 @@
+int spmv_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THFloatTensor *vector,
+    THFloatTensor *output,
+    const long rows, const long cols, const int nthreads);
+
+int spmv_dot_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THFloatTensor *vector,
+    THFloatTensor *output, THFloatTensor *dot,
+    const long rows, const long cols, const int nthreads);
+
+int spmm_dense_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THFloatTensor *dense,
+    THFloatTensor *output,
+    const long rows, const long cols, const int nthreads);
+
+int spmm_sampled_omp(
+    THIntTensor *A_csr_row, THIntTensor *A_csr_col, THFloatTensor *A_val,
+    THIntTensor *B_csr_row, THIntTensor *B_csr_col, THFloatTensor *B_val,
+    THIntTensor *C_coo_row, THIntTensor *C_col, THFloatTensor *C_val,
+    const int nthreads);
+
+int ic0_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THIntTensor *level_rows, THIntTensor *level_ptr, const int nthreads);
+
+int sptrsv_omp(
+    THIntTensor *csr_row, THIntTensor *csr_col, THFloatTensor *val,
+    THIntTensor *level_rows, THIntTensor *level_ptr,
+    THFloatTensor *rhs,
+    THFloatTensor *output,
+    const int diag_last, const int nthreads);
+
+int omp_max_threads();
@@ -0,0 +1,77 @@
+import collections
+import json
+import logging
+import math
+
+log = logging.getLogger(__name__)
+
+# reasons that flag a solve as failed
+FAILURES = ["stalled", "diverged", "nonfinite"]
+
+
+def reason(residuals, residual, init_residual, thresh, window=10, tol=1e-2):
+  """Why a solve stopped, from its residual history.
+
+  "nonfinite" if a residual is NaN or infinite, "converged" under
+  `thresh`, "diverged" if it ends above its initial residual, "stalled"
+  if the best residual of the last `window` iterations improved on the
+  best one before by less than a fraction `tol`, "max_steps" otherwise.
+  """
+  if not all(_finite(e) for e in list(residuals) + [residual]):
+    return "nonfinite"
+  if residual < thresh:
+    return "converged"
+  if residual > init_residual:
+    return "diverged"
+  if (len(residuals) > window and
+      min(residuals[-window:]) > (1 - tol)*min(residuals[:-window])):
+    return "stalled"
+  return "max_steps"
+
+
+def _finite(x):
+  return not (math.isnan(x) or math.isinf(x))
+
+
+class RingBuffer(object):
+  """Keeps the last `capacity` records in memory."""
+  def __init__(self, capacity=1024):
+    self.records = collections.deque(maxlen=capacity)
+
+  def __len__(self):
+    return len(self.records)
+
+  def __iter__(self):
+    return iter(self.records)
+
+  def write(self, record):
+    self.records.append(record)
+
+
+class JSONLSink(object):
+  """Appends records to the file `path`, one JSON object per line.
+
+  The file is opened for each record, the sink holds no handle.
+  """
+  def __init__(self, path):
+    self.path = path
+
+  def write(self, record):
+    with open(self.path, "a") as f:
+      f.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+def read_jsonl(path):
+  """Records written by a JSONLSink, a list."""
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def sink(spec):
+  """Sink of records: None, an object with a `write(record)` method,
+  "ring" for a RingBuffer or the path of a JSONL file."""
+  if spec is None or hasattr(spec, "write"):
+    return spec
+  if spec == "ring":
+    return RingBuffer()
+  return JSONLSink(spec)
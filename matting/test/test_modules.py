@@ -1,7 +1,12 @@
+import json
+
+import numpy as np
 import torch as th
 from torch.autograd import Variable
 
 import matting.modules as modules
+import matting.sparse as sp
+import matting.telemetry as telemetry
 import matplotlib.pyplot as plt
 
 def test_alpha_gradient():
@@ -13,3 +18,86 @@ def test_alpha_gradient():
 
   # plt.imshow(g.data[0, 0, ...].numpy())
   # plt.show()
+
+
+def test_solution_cache():
+  cache = modules.SolutionCache(capacity=4*25)
+  cache.put(("a", 2, 5), th.ones(10))
+  cache.put(("b", 2, 5), th.ones(10).double())
+  assert cache.get(("a", 2, 5)) is not None
+  # b is the least recently used
+  cache.put(("c", 1, 10), th.ones(10))
+  assert len(cache) == 2
+  assert cache.get(("b", 2, 5)) is None
+  assert cache.get(("a", 2, 5)).type() == "torch.FloatTensor"
+  assert cache.nbytes == 80
+  assert cache.hits == 2 and cache.misses == 1
+
+
+def test_initial_guess():
+  h, w = 3, 4
+  sample = {
+    "name": "im",
+    "kToU": Variable(th.rand(h*w)),
+    "vanilla": Variable(th.rand(1, h, w)),
+  }
+  assert modules.MattingSolver(init="zeros").initial_guess(sample, h, w) is None
+  x = modules.MattingSolver(init="vanilla").initial_guess(sample, h, w)
+  assert (x.data == sample["vanilla"].data.view(-1)).all()
+
+  solver = modules.MattingSolver(init="cache")
+  x = solver.initial_guess(sample, h, w)
+  assert (x.data == sample["kToU"].data).all()
+  solver.remember(sample, h, w, 2*x)
+  x = solver.initial_guess(sample, h, w)
+  assert (x.data == 2*sample["kToU"].data).all()
+  # another crop of the sample misses
+  x = solver.initial_guess(sample, w, h)
+  assert (x.data == sample["kToU"].data).all()
+
+
+def test_telemetry(tmpdir):
+  assert telemetry.reason([3, 2, 1], 1e-5, 4, 1e-4) == "converged"
+  assert telemetry.reason([3, 2, 1], 1, 4, 1e-4) == "max_steps"
+  assert telemetry.reason([3, 5, 6], 6, 4, 1e-4) == "diverged"
+  assert telemetry.reason([1, float("nan")], 1, 4, 1e-4) == "nonfinite"
+  flat = [3, 2] + [1.999]*10
+  assert telemetry.reason(flat, 1.999, 4, 1e-4) == "stalled"
+
+  ring = telemetry.sink("ring")
+  for i in range(ring.records.maxlen + 2):
+    ring.write({"i": i})
+  assert len(ring) == ring.records.maxlen
+  assert list(ring)[0]["i"] == 2
+
+  path = str(tmpdir.join("solves.jsonl"))
+  jsonl = telemetry.sink(path)
+  jsonl.write({"residual": 0.5, "residuals": [1.0, 0.5]})
+  jsonl.write({"residual": 0.25})
+  assert telemetry.read_jsonl(path)[1] == {"residual": 0.25}
+  assert telemetry.sink(ring) is ring
+
+
+def test_solver_records():
+  n = 16
+  # 1D Laplacian, the unknowns are pinned by a diagonal term
+  i = np.arange(n)
+  rows = np.concatenate([i, i[1:], i[:-1]])
+  cols = np.concatenate([i, i[:-1], i[1:]])
+  vals = np.concatenate([2.5*np.ones(n), -np.ones(2*n - 2)]).astype(np.float32)
+  A = sp.from_coo(Variable(th.from_numpy(rows)), Variable(th.from_numpy(cols)),
+                  Variable(th.from_numpy(vals)), th.Size((n, n)))
+  b = Variable(th.ones(n))
+  solver = modules.MattingSolver(steps=50, thresh=1e-4)
+  solver(A, b)
+  record, = solver.records
+  assert record["reason"] == "converged"
+  assert record["size"] == n and record["nnz"] == 3*n - 2
+  assert len(record["residuals"]) == record["steps"]
+  assert record["residuals"][-1] == record["residual"]
+  json.dumps(record)
+
+  solver = modules.MattingSolver(steps=2, thresh=1e-4)
+  solver.solve_many([(A, b), (A, 2*b)], [(1, n), (1, n)])
+  assert [r["reason"] for r in solver.records] == ["max_steps"]*2
+  assert [r["batch"] for r in solver.records] == [2, 2]
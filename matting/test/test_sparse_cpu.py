@@ -0,0 +1,1396 @@
+import gc
+
+import numpy as np
+import torch as th
+from torch.autograd import Variable
+from torch.autograd import gradcheck
+
+import matting.sparse as sp
+import matting.optim as optim
+import matting.functions.sparse as spfuncs
+import matting.functions.sparse_cpu as spcpu
+
+import scipy.sparse as scp
+
+
+def _get_random_sparse_matrix(nrows, ncols, nnz):
+  row = np.random.randint(0, nrows, size=(nnz,), dtype=np.int32)
+  col = np.random.randint(0, ncols, size=(nnz,), dtype=np.int32)
+
+  tuples = [(a, b) for a, b in zip(row, col)]
+  unique_tuples = set(tuples)
+  row, col = zip(*unique_tuples)
+  row = np.array(row, dtype=np.int32)
+  col = np.array(col, dtype=np.int32)
+  nnz = row.size
+
+  row = th.from_numpy(row)
+  col = th.from_numpy(col)
+  val = th.from_numpy(np.random.uniform(size=(nnz,)).astype(np.float32))
+  A = sp.from_coo(row, col, val, th.Size((nrows, ncols)))
+  return A
+
+
+def test_coo2csr():
+  row = th.from_numpy(np.array([2, 0, 3, 0, 1], dtype=np.int32))
+  col = th.from_numpy(np.array([2, 3, 3, 0, 1], dtype=np.int32))
+  val = th.from_numpy(np.arange(5, dtype=np.float32))
+  A = sp.from_coo(row, col, val, th.Size((4, 4)))
+
+  assert (A.csr_row_idx.data.numpy() == np.array([0, 2, 3, 4, 5])).all()
+  assert (A.col_idx.data.numpy() == np.array([0, 3, 1, 2, 3])).all()
+  assert (A.val.data.numpy() == np.array([3, 1, 4, 0, 2])).all()
+
+
+def test_permutation():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = 10
+    ncols = 11
+    nnz = 9
+    row = np.random.randint(0, nrows, size=(nnz,), dtype=np.int32)
+    col = np.random.randint(0, ncols, size=(nnz,), dtype=np.int32)
+    val = np.random.uniform(size=(nnz,)).astype(np.float32)
+
+    gradcheck(spfuncs.Coo2Csr.apply,
+        (th.from_numpy(row), th.from_numpy(col),
+         Variable(th.from_numpy(val), requires_grad=True),
+         th.Size((nrows, ncols))),
+        eps=1e-4, atol=1e-5, rtol=1e-3,
+        raise_exception=True)
+
+
+def test_transpose():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 8)
+    ncols = np.random.randint(3, 8)
+    nnz = np.random.randint(1, nrows*ncols/2)
+    A = _get_random_sparse_matrix(nrows, ncols, nnz)
+    At = sp.transpose(A)
+    assert np.amax(np.abs(A.to_dense().T - At.to_dense())) < 1e-5
+
+    gradcheck(spfuncs.Transpose.apply,
+        (A.csr_row_idx.data, A.col_idx.data,
+         Variable(A.val.data, requires_grad=True), A.size),
+        eps=1e-4, atol=1e-5, rtol=1e-3,
+        raise_exception=True)
+
+
+def test_spadd():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(50, 100)
+    ncols = np.random.randint(50, 100)
+    A = _get_random_sparse_matrix(nrows, ncols, np.random.randint(1, nrows*ncols/2))
+    B = _get_random_sparse_matrix(nrows, ncols, np.random.randint(1, nrows*ncols/2))
+
+    C = sp.spadd(A, B)
+    assert np.amax(np.abs(A.to_dense() + B.to_dense() - C.to_dense())) < 1e-6
+
+
+def test_spadd_keeps_cancelled_entries():
+  row = th.from_numpy(np.array([0, 1], dtype=np.int32))
+  col = th.from_numpy(np.array([0, 1], dtype=np.int32))
+  A = sp.from_coo(row, col, th.FloatTensor([1, 2]), th.Size((2, 2)))
+  B = sp.from_coo(row, col, th.FloatTensor([-1, 1]), th.Size((2, 2)))
+
+  C = sp.spadd(A, B)
+  assert C.nnz == 2
+  assert (C.val.data.numpy() == np.array([0, 3])).all()
+
+
+def test_spadd_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 8)
+    ncols = np.random.randint(3, 8)
+    nnz = np.random.randint(1, nrows*ncols/2)
+    A = _get_random_sparse_matrix(nrows, ncols, nnz)
+    B = _get_random_sparse_matrix(nrows, ncols, nnz)
+
+    gradcheck(spfuncs.SpAdd.apply,
+        (A.csr_row_idx, A.col_idx, Variable(A.val.data, requires_grad=True),
+         B.csr_row_idx, B.col_idx, Variable(B.val.data, requires_grad=True),
+         A.size, 1.0, 1.0), eps=1e-4, atol=1e-5, rtol=1e-3,
+         raise_exception=True)
+
+
+def test_spmv():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 50)
+    ncols = np.random.randint(3, 50)
+    A = _get_random_sparse_matrix(nrows, ncols, np.random.randint(1, nrows*ncols/2))
+    v = np.random.uniform(size=(ncols,)).astype(np.float32)
+
+    out = sp.spmv(A, Variable(th.from_numpy(v)))
+    ref = np.ravel(A.to_dense().dot(v))
+    assert np.amax(np.abs(out.data.numpy() - ref)) < 1e-5
+
+
+def test_spmv_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 10)
+    ncols = np.random.randint(3, 10)
+    nnz = np.random.randint(1, nrows*ncols/2)
+    A = _get_random_sparse_matrix(nrows, ncols, nnz)
+    vector = th.from_numpy(
+        np.random.uniform(size=(ncols,)).astype(np.float32))
+    vector = Variable(vector, requires_grad=True)
+
+    gradcheck(spfuncs.SpMV.apply,
+        (A.csr_row_idx, A.col_idx, Variable(A.val.data, requires_grad=True),
+         vector, A.size), eps=1e-3, atol=1e-4, rtol=1e-3,
+         raise_exception=True)
+
+
+def test_spmm():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 30)
+    ncols = np.random.randint(3, 30)
+    ncols2 = np.random.randint(3, 30)
+    A = _get_random_sparse_matrix(nrows, ncols, np.random.randint(1, nrows*ncols/2))
+    B = _get_random_sparse_matrix(ncols, ncols2, np.random.randint(1, ncols*ncols2/2))
+
+    C = sp.spmm(A, B)
+    assert np.amax(np.abs(A.to_dense().dot(B.to_dense()) - C.to_dense())) < 1e-5
+
+
+def test_spmm_keeps_cancelled_entries():
+  n = 4
+  row = th.from_numpy(np.array([0, 1, 2, 3], dtype=np.int32))
+  col = th.from_numpy(np.array([0, 1, 2, 3], dtype=np.int32))
+  A = sp.from_coo(row, col, th.from_numpy(np.arange(n, dtype=np.float32)), th.Size((n, n)))
+  B = sp.from_coo(row, col, th.FloatTensor([3, 6, 1, 8]), th.Size((n, n)))
+
+  C = sp.spmm(A, B)
+  assert (C.col_idx.data.numpy() == np.array([0, 1, 2, 3])).all()
+  assert (C.val.data.numpy() == np.array([0, 6, 2, 24])).all()
+
+
+def test_spmm_gradients():
+  np.random.seed(0)
+  i = 0
+  while i < 10:
+    nrows = np.random.randint(3, 8)
+    ncols = np.random.randint(3, 8)
+    ncols2 = np.random.randint(3, 8)
+    nnz = np.random.randint(1, nrows*ncols/2)
+    nnz2 = np.random.randint(1, ncols*ncols2/2)
+    A = _get_random_sparse_matrix(nrows, ncols, nnz)
+    B = _get_random_sparse_matrix(ncols, ncols2, nnz2)
+
+    C = sp.spmm(A, B)
+    if C.nnz == 0:
+      continue
+    i += 1
+
+    gradcheck(spfuncs.SpMM.apply,
+        (A.csr_row_idx, A.col_idx, Variable(A.val.data, requires_grad=True), A.size,
+         B.csr_row_idx, B.col_idx, Variable(B.val.data, requires_grad=True), B.size),
+         eps=1e-4, atol=2e-4, rtol=1e-3,
+         raise_exception=True)
+
+
+def test_sparse_cg():
+  np.random.seed(0)
+  n = 50
+  M = scp.random(n, n, density=0.1, format="csr", dtype=np.float32)
+  M = (M + M.T + n*scp.identity(n, dtype=np.float32)).tocsr()
+  M.sort_indices()
+  A = sp.Sparse(
+      Variable(th.from_numpy(M.indptr.astype(np.int32))),
+      Variable(th.from_numpy(M.indices.astype(np.int32))),
+      Variable(th.from_numpy(M.data)), th.Size((n, n)))
+  b = np.random.uniform(size=(n,)).astype(np.float32)
+
+  x0 = Variable(th.zeros(n))
+  x, err, steps = optim.sparse_cg(A, Variable(th.from_numpy(b)), x0, steps=50)
+
+  assert np.amax(np.abs(M.dot(x.data.numpy()) - b)) < 1e-4
+
+
+def test_spadd_reuses_pattern():
+  np.random.seed(0)
+  sp.pattern_cache.clear()
+  A = _get_random_sparse_matrix(20, 30, 100)
+  B = _get_random_sparse_matrix(20, 30, 100)
+  C = sp.spadd(A, B)
+  misses = sp.pattern_cache.misses
+
+  # same patterns, new values
+  A2 = sp.Sparse(A.csr_row_idx, A.col_idx, A.val*2, A.size)
+  B2 = sp.Sparse(B.csr_row_idx, B.col_idx, B.val*3, B.size)
+  C2 = sp.spadd(A2, B2)
+
+  assert sp.pattern_cache.misses == misses
+  assert C2.pattern_key == C.pattern_key
+  assert np.amax(np.abs(2*A.to_dense() + 3*B.to_dense() - C2.to_dense())) < 1e-5
+
+
+def test_from_coo_pattern_key():
+  np.random.seed(0)
+  sp.pattern_cache.clear()
+  n = 20
+  row = np.random.randint(0, n, size=(60,)).astype(np.int32)
+  col = np.random.randint(0, n, size=(60,)).astype(np.int32)
+  val = Variable(th.from_numpy(np.random.uniform(size=(60,))),
+                 requires_grad=True)
+  row, col = Variable(th.from_numpy(row)), Variable(th.from_numpy(col))
+  ref = sp.from_coo(row, col, val, th.Size((n, n)))
+  A = sp.from_coo(row, col, val, th.Size((n, n)), pattern_key="sample")
+  misses = sp.pattern_cache.misses
+  # the indices are not read again, the key stands for them
+  A2 = sp.from_coo(0*row, 0*col, 2*val, th.Size((n, n)),
+                   pattern_key="sample")
+  assert sp.pattern_cache.misses == misses
+  assert A2.pattern_key == A.pattern_key
+  assert (A.col_idx.data == ref.col_idx.data).all()
+  assert (A.csr_row_idx.data == ref.csr_row_idx.data).all()
+  assert (2*A.val.data == A2.val.data).all()
+  gradcheck(lambda v: sp.from_coo(row, col, v, th.Size((n, n)),
+                                  pattern_key="sample").val,
+            (val,), eps=1e-6, atol=1e-5, rtol=1e-3, raise_exception=True)
+
+
+def test_pattern_cache_capacity():
+  cache = sp.PatternCache(capacity=100)
+  cache.get("a", lambda: sp.CooPlan(th.zeros(10).int(), th.zeros(5).int(), None))
+  assert cache.nbytes == 60
+  cache.get("b", lambda: [np.zeros(4, dtype=np.int64), th.zeros(2).long()])
+  # a is the least recently used
+  assert len(cache) == 1 and cache.nbytes == 48
+  cache.get("c", lambda: th.zeros(100))
+  assert len(cache) == 1 and cache.nbytes == 400
+  cache.clear()
+  assert cache.nbytes == 0
+
+
+def test_spadd_cached_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 8)
+    ncols = np.random.randint(3, 8)
+    nnz = np.random.randint(1, nrows*ncols/2)
+    A = _get_random_sparse_matrix(nrows, ncols, nnz)
+    B = _get_random_sparse_matrix(nrows, ncols, nnz)
+
+    def add(valA, valB):
+      return sp.spadd(sp.Sparse(A.csr_row_idx, A.col_idx, valA, A.size),
+                      sp.Sparse(B.csr_row_idx, B.col_idx, valB, B.size)).val
+
+    gradcheck(add,
+        (Variable(A.val.data, requires_grad=True),
+         Variable(B.val.data, requires_grad=True)),
+        eps=1e-4, atol=1e-5, rtol=1e-3, raise_exception=True)
+
+
+def test_spmm_reuses_pattern():
+  np.random.seed(0)
+  sp.pattern_cache.clear()
+  A = _get_random_sparse_matrix(20, 30, 100)
+  B = _get_random_sparse_matrix(30, 25, 100)
+  C = sp.spmm(A, B)
+  misses = sp.pattern_cache.misses
+
+  A2 = sp.Sparse(A.csr_row_idx, A.col_idx, A.val*2, A.size)
+  B2 = sp.Sparse(B.csr_row_idx, B.col_idx, B.val*3, B.size)
+  C2 = sp.spmm(A2, B2)
+
+  assert sp.pattern_cache.misses == misses
+  assert C2.nnz == C.nnz
+  assert np.amax(np.abs(6*A.to_dense().dot(B.to_dense()) - C2.to_dense())) < 1e-5
+
+
+def test_spmm_cached_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 8)
+    ncols = np.random.randint(3, 8)
+    ncols2 = np.random.randint(3, 8)
+    A = _get_random_sparse_matrix(nrows, ncols, np.random.randint(1, nrows*ncols/2))
+    B = _get_random_sparse_matrix(ncols, ncols2, np.random.randint(1, ncols*ncols2/2))
+
+    def mul(valA, valB):
+      return sp.spmm(sp.Sparse(A.csr_row_idx, A.col_idx, valA, A.size),
+                     sp.Sparse(B.csr_row_idx, B.col_idx, valB, B.size)).val
+
+    gradcheck(mul,
+        (Variable(A.val.data, requires_grad=True),
+         Variable(B.val.data, requires_grad=True)),
+        eps=1e-4, atol=2e-4, rtol=1e-3, raise_exception=True)
+
+
+def test_spadd_many():
+  np.random.seed(0)
+  mats = [_get_random_sparse_matrix(20, 30, 100) for i in range(4)]
+  scales = [1.0, -2.0, 0.5, 3.0]
+
+  C = sp.spadd_many(mats, scales)
+  ref = sum(s*A.to_dense() for s, A in zip(scales, mats))
+  assert np.amax(np.abs(ref - C.to_dense())) < 1e-5
+
+
+def test_spadd_many_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 8)
+    ncols = np.random.randint(3, 8)
+    nnz = np.random.randint(1, nrows*ncols/2)
+    mats = [_get_random_sparse_matrix(nrows, ncols, nnz) for j in range(3)]
+
+    def add(*vals):
+      return sp.spadd_many(
+          [sp.Sparse(A.csr_row_idx, A.col_idx, v, A.size) for A, v in zip(mats, vals)],
+          [1.0, -2.0, 0.5]).val
+
+    gradcheck(add,
+        tuple(Variable(A.val.data.double(), requires_grad=True) for A in mats),
+        eps=1e-4, atol=1e-5, rtol=1e-3, raise_exception=True)
+
+
+def test_sp_gram():
+  np.random.seed(0)
+  for i in range(5):
+    A = _get_random_sparse_matrix(20, 15, 60)
+    C = sp.sp_gram(A)
+    Ad = A.to_dense()
+    assert np.amax(np.abs(Ad.T.dot(Ad) - C.to_dense())) < 1e-5
+
+
+def test_sp_gram_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 8)
+    ncols = np.random.randint(3, 8)
+    A = _get_random_sparse_matrix(nrows, ncols, np.random.randint(1, nrows*ncols/2))
+
+    def gram(val):
+      return sp.sp_gram(sp.Sparse(A.csr_row_idx, A.col_idx, val, A.size)).val
+
+    gradcheck(gram, (Variable(A.val.data, requires_grad=True),),
+        eps=1e-4, atol=2e-4, rtol=1e-3, raise_exception=True)
+
+
+def test_sp_laplacian():
+  np.random.seed(0)
+  for symmetrize in [False, True]:
+    A = _get_random_sparse_matrix(20, 20, 60)
+    W = A.to_dense()
+    if symmetrize:
+      W = 0.5*(W + W.T)
+    ref = np.diag(np.ravel(W.sum(1))) - W
+
+    L = sp.sp_laplacian(A, symmetrize=symmetrize)
+    assert np.amax(np.abs(ref - L.to_dense())) < 1e-5
+
+
+def test_sp_laplacian_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    n = np.random.randint(3, 8)
+    A = _get_random_sparse_matrix(n, n, np.random.randint(1, n*n/2))
+
+    for symmetrize in [False, True]:
+      def laplacian(val):
+        return sp.sp_laplacian(sp.Sparse(A.csr_row_idx, A.col_idx, val, A.size),
+                               symmetrize=symmetrize).val
+
+      val = Variable(A.val.data.double(), requires_grad=True)
+      gradcheck(laplacian, (val,),
+          eps=1e-4, atol=1e-5, rtol=1e-3, raise_exception=True)
+
+
+def test_diagonal():
+  np.random.seed(0)
+  n = 20
+  A = _get_random_sparse_matrix(n, n, 60)
+  d = np.random.uniform(size=(n,)).astype(np.float32)
+  v = np.random.uniform(size=(n,)).astype(np.float32)
+  D = sp.Diagonal(Variable(th.from_numpy(d)))
+  Ad = A.to_dense()
+
+  assert np.amax(np.abs(np.diag(d) + 2*Ad - sp.spadd(D, A, 1.0, 2.0).to_dense())) < 1e-5
+  assert np.amax(np.abs(np.diag(d).dot(Ad) - sp.spmm(D, A).to_dense())) < 1e-5
+  assert np.amax(np.abs(Ad.dot(np.diag(d)) - sp.spmm(A, D).to_dense())) < 1e-5
+  out = sp.spmv(D, Variable(th.from_numpy(v)))
+  assert np.amax(np.abs(d*v - out.data.numpy())) < 1e-6
+  assert isinstance(sp.spadd(D, D), sp.Diagonal)
+
+
+def test_diagonal_gradients():
+  np.random.seed(0)
+  n = 6
+  A = _get_random_sparse_matrix(n, n, 12)
+  d = Variable(th.from_numpy(np.random.uniform(size=(n,)).astype(np.float32)),
+               requires_grad=True)
+  valA = Variable(A.val.data, requires_grad=True)
+
+  def scale_and_add(d, valA):
+    B = sp.Sparse(A.csr_row_idx, A.col_idx, valA, A.size)
+    D = sp.Diagonal(d)
+    return sp.spadd(D, sp.spmm(D, B)).val
+
+  gradcheck(scale_and_add, (d, valA),
+      eps=1e-4, atol=1e-4, rtol=1e-3, raise_exception=True)
+
+
+def _get_spd_matrix(n, seed):
+  M = scp.random(n, n, density=0.1, format="csr", dtype=np.float32,
+                 random_state=seed)
+  M = (M + M.T + n*scp.identity(n, dtype=np.float32)).tocsr()
+  M.sort_indices()
+  A = sp.Sparse(
+      Variable(th.from_numpy(M.indptr.astype(np.int32))),
+      Variable(th.from_numpy(M.indices.astype(np.int32))),
+      Variable(th.from_numpy(M.data)), th.Size((n, n)))
+  return M, A
+
+
+def test_block_diag():
+  np.random.seed(0)
+  M1, A1 = _get_spd_matrix(20, 0)
+  M2, A2 = _get_spd_matrix(35, 1)
+  d = np.random.uniform(size=(5,)).astype(np.float32)
+  D = sp.Diagonal(Variable(th.from_numpy(d)))
+  B = sp.block_diag([A1, D, A2])
+
+  ref = scp.block_diag([M1, scp.diags(d), M2]).toarray()
+  assert B.size == th.Size((60, 60))
+  assert B.sizes == [20, 5, 35]
+  assert B.offsets == [0, 20, 25]
+  assert (B.segments.numpy() == np.repeat([0, 1, 2], [20, 5, 35])).all()
+  assert np.amax(np.abs(B.to_dense() - ref)) < 1e-6
+
+  parts = B.split(Variable(th.arange(0, 60)))
+  assert [p.data.numpy()[0] for p in parts] == [0, 20, 25]
+
+
+def test_batched_sparse_cg():
+  np.random.seed(0)
+  mats = [_get_spd_matrix(n, seed) for seed, n in enumerate([50, 20, 80])]
+  A = sp.block_diag([a for _, a in mats])
+  bs = [np.random.uniform(size=(M.shape[0],)).astype(np.float32)
+        for M, _ in mats]
+  b = Variable(th.from_numpy(np.concatenate(bs)))
+
+  x0 = Variable(th.zeros(A.size[0]))
+  x, errs, steps = optim.batched_sparse_cg(A, b, x0, steps=100)
+
+  assert len(errs) == 3
+  assert max(errs) < 1e-4
+  for (M, _), bi, xi in zip(mats, bs, A.split(x)):
+    assert np.amax(np.abs(M.dot(xi.data.numpy()) - bi)) < 1e-4
+
+  # blocks stop independently, and match a solve of the block alone
+  for (M, a), bi, xi, k in zip(mats, bs, A.split(x), steps):
+    x_single, _, k_single = optim.sparse_cg(
+        a, Variable(th.from_numpy(bi)), Variable(th.zeros(M.shape[0])),
+        steps=100)
+    assert k == k_single
+    assert np.amax(np.abs(x_single.data.numpy() - xi.data.numpy())) < 1e-5
+
+
+def test_transpose_reuses_structure():
+  np.random.seed(0)
+  sp.pattern_cache.clear()
+  A = _get_random_sparse_matrix(20, 30, 100)
+  At = sp.transpose(A)
+  misses = sp.pattern_cache.misses
+
+  A2 = sp.Sparse(A.csr_row_idx, A.col_idx, A.val*2, A.size)
+  At2 = sp.transpose(A2)
+  assert sp.pattern_cache.misses == misses
+  assert A2.structure is A.structure
+  assert np.amax(np.abs(2*A.to_dense().T - At2.to_dense())) < 1e-5
+
+  # the transpose's own values are gathered once per val
+  assert A2.csc()[2] is A2.csc()[2]
+
+  val = Variable(A.val.data, requires_grad=True)
+  gradcheck(lambda v: sp.transpose(sp.Sparse(
+              A.csr_row_idx, A.col_idx, v, A.size)).val,
+            (val,), eps=1e-4, atol=1e-5, rtol=1e-3, raise_exception=True)
+
+
+def test_spmv_cached_transpose_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 10)
+    ncols = np.random.randint(3, 10)
+    nnz = np.random.randint(1, nrows*ncols/2)
+    A = _get_random_sparse_matrix(nrows, ncols, nnz)
+    vector = th.from_numpy(
+        np.random.uniform(size=(ncols,)).astype(np.float32))
+    vector = Variable(vector, requires_grad=True)
+
+    gradcheck(spfuncs.SpMV.apply,
+        (A.csr_row_idx, A.col_idx, Variable(A.val.data, requires_grad=True),
+         vector, A.size, A.csc), eps=1e-3, atol=1e-4, rtol=1e-3,
+         raise_exception=True)
+
+
+def test_spmm_dense():
+  np.random.seed(0)
+  A = _get_random_sparse_matrix(20, 30, 100)
+  X = np.random.uniform(size=(30, 4)).astype(np.float32)
+  out = sp.spmm_dense(A, Variable(th.from_numpy(X)))
+  assert out.shape == th.Size((20, 4))
+  assert np.amax(np.abs(A.to_dense().dot(X) - out.data.numpy())) < 1e-5
+
+  D = sp.Diagonal(Variable(th.from_numpy(X[:, 0].copy())))
+  out = sp.spmm_dense(D, Variable(th.from_numpy(X)))
+  assert np.amax(np.abs(X[:, 0:1]*X - out.data.numpy())) < 1e-6
+
+
+def test_spmm_dense_gradients():
+  np.random.seed(0)
+  for i in range(10):
+    nrows = np.random.randint(3, 10)
+    ncols = np.random.randint(3, 10)
+    nnz = np.random.randint(1, nrows*ncols/2)
+    A = _get_random_sparse_matrix(nrows, ncols, nnz)
+    X = th.from_numpy(np.random.uniform(size=(ncols, 3)).astype(np.float32))
+    val = Variable(A.val.data, requires_grad=True)
+
+    gradcheck(lambda v, x: sp.spmm_dense(
+                sp.Sparse(A.csr_row_idx, A.col_idx, v, A.size), x),
+              (val, Variable(X, requires_grad=True)),
+              eps=1e-3, atol=1e-4, rtol=1e-3, raise_exception=True)
+
+
+def test_block_sparse_cg():
+  np.random.seed(0)
+  M, A = _get_spd_matrix(50, 0)
+  B = np.random.uniform(size=(50, 3)).astype(np.float32)
+  B[:, 2] = 0  # converges immediately, must stay at zero
+
+  X0 = Variable(th.zeros(50, 3))
+  X, errs, steps = optim.block_sparse_cg(
+      A, Variable(th.from_numpy(B)), X0, steps=50)
+
+  assert np.amax(np.abs(M.dot(X.data.numpy()) - B)) < 1e-4
+  assert steps[2] == 0
+  for j in range(2):
+    x, _, k = optim.sparse_cg(A, Variable(th.from_numpy(B[:, j].copy())),
+                              Variable(th.zeros(50)), steps=50)
+    assert k == steps[j]
+    assert np.amax(np.abs(x.data.numpy() - X.data.numpy()[:, j])) < 1e-5
+
+
+def test_spmv_dot():
+  np.random.seed(0)
+  M, A = _get_spd_matrix(30, 0)
+  v = np.random.uniform(size=(30,)).astype(np.float32)
+  Av, vAv = sp.spmv_dot(A, Variable(th.from_numpy(v)))
+  assert np.amax(np.abs(M.dot(v) - Av.data.numpy())) < 1e-4
+  assert np.abs(v.dot(M.dot(v)) - vAv.data.numpy()[0]) < 1e-2
+
+  val = Variable(A.val.data.double(), requires_grad=True)
+  gradcheck(lambda w, x: sp.spmv_dot(
+              sp.Sparse(A.csr_row_idx, A.col_idx, w, A.size), x),
+            (val, Variable(th.from_numpy(v).double(), requires_grad=True)),
+            eps=1e-3, atol=1e-3, rtol=1e-3, raise_exception=True)
+
+
+def test_cg_steps_gradients():
+  np.random.seed(0)
+  n = 8
+  def var(*shape):
+    return Variable(th.from_numpy(
+      np.random.uniform(0.5, 1.5, size=shape).astype(np.float32)),
+      requires_grad=True)
+  gradcheck(spfuncs.CGUpdate.apply,
+            (var(n), var(n), var(n), var(n), var(1), var(1)),
+            eps=1e-3, atol=1e-3, rtol=1e-3, raise_exception=True)
+  gradcheck(spfuncs.CGDirection.apply, (var(n), var(n), var(1), var(1)),
+            eps=1e-3, atol=1e-3, rtol=1e-3, raise_exception=True)
+
+
+def test_sparse_cg_fused_matches_reference():
+  np.random.seed(0)
+  M, A = _get_spd_matrix(40, 0)
+  b = np.random.uniform(size=(40,)).astype(np.float32)
+
+  def reference(A, b, steps):
+    x = Variable(th.zeros(40))
+    r = b - sp.spmv(A, x)
+    p = r.clone()
+    res_old = r.dot(r)
+    for k in range(steps):
+      Ap = sp.spmv(A, p)
+      alpha = res_old / p.dot(Ap)
+      x = x + alpha*p
+      r = r - alpha*Ap
+      res_new = r.dot(r)
+      p = r + res_new/res_old*p
+      res_old = res_new
+    return x
+
+  # in place, no autograd
+  x, _, _ = optim.sparse_cg(A, Variable(th.from_numpy(b)),
+                            Variable(th.zeros(40)), steps=10, thresh=0)
+  x_ref = reference(A, Variable(th.from_numpy(b)), 10)
+  assert np.amax(np.abs(x.data.numpy() - x_ref.data.numpy())) < 1e-5
+
+  # autograd
+  grads = []
+  for solve in [lambda A, b: optim.sparse_cg(
+                  A, b, Variable(th.zeros(40)), steps=10, thresh=0)[0],
+                lambda A, b: reference(A, b, 10)]:
+    val = Variable(A.val.data.clone(), requires_grad=True)
+    bv = Variable(th.from_numpy(b), requires_grad=True)
+    x = solve(sp.Sparse(A.csr_row_idx, A.col_idx, val, A.size), bv)
+    x.sum().backward()
+    grads.append((x.data.numpy(), val.grad.data.numpy(), bv.grad.data.numpy()))
+  for fused, ref in zip(*grads):
+    assert np.amax(np.abs(fused - ref)) < 1e-4*max(1, np.amax(np.abs(ref)))
+
+
+def test_cpu_engine():
+  np.random.seed(0)
+  A = _get_random_sparse_matrix(200, 150, 3000)
+  v = Variable(th.from_numpy(np.random.uniform(size=(150,)).astype(np.float32)))
+  X = Variable(th.from_numpy(np.random.uniform(size=(150, 3)).astype(np.float32)))
+
+  engine = spcpu.get_engine()
+  try:
+    sp.set_cpu_engine("bogus")
+    assert False, "expected a ValueError"
+  except ValueError:
+    pass
+  assert spcpu.get_engine() == engine
+
+  if spcpu.sparse_omp is None:
+    try:
+      sp.set_cpu_engine("omp")
+      assert False, "expected a RuntimeError"
+    except RuntimeError:
+      pass
+    return
+
+  B = _get_random_sparse_matrix(150, 120, 2000)
+  g = th.from_numpy(np.random.uniform(size=(200*120,)).astype(np.float32))
+
+  def product():
+    # sampled products of spmm, forward and backward
+    valA = Variable(A.val.data, requires_grad=True)
+    valB = Variable(B.val.data, requires_grad=True)
+    C = sp.spmm(sp.Sparse(A.csr_row_idx, A.col_idx, valA, A.size),
+                sp.Sparse(B.csr_row_idx, B.col_idx, valB, B.size))
+    C.val.backward(g[:C.nnz])
+    return [C.val.data.numpy(), valA.grad.data.numpy(), valB.grad.data.numpy()]
+
+  ref = sp.spmv(A, v, engine="scipy").data.numpy()
+  ref_dense = sp.spmm_dense(A, X, engine="scipy").data.numpy()
+  with spcpu.engine("scipy"):
+    ref_product = product()
+  for threads in [1, 3, 0]:
+    with spcpu.engine("omp", threads):
+      assert np.amax(np.abs(sp.spmv(A, v).data.numpy() - ref)) < 1e-5
+      assert np.amax(np.abs(sp.spmm_dense(A, X).data.numpy() - ref_dense)) < 1e-5
+      for out, expected in zip(product(), ref_product):
+        assert np.amax(np.abs(out - expected)) < 1e-4*np.abs(expected).max()
+  assert spcpu.get_engine() == engine
+
+
+def test_permute():
+  sp.pattern_cache.clear()
+  M, A = _get_spd_matrix(60, 0)
+  ordering = sp.rcm_ordering(A)
+  perm = ordering.perm.numpy()
+  assert sorted(perm) == list(range(60))
+
+  P = sp.permute(A, ordering)
+  ref = M.toarray()[perm][:, perm]
+  assert np.amax(np.abs(P.to_dense() - ref)) < 1e-6
+
+  # symbolic analysis is cached on the pattern
+  misses = sp.pattern_cache.misses
+  A2 = sp.Sparse(A.csr_row_idx, A.col_idx, A.val*2, A.size)
+  assert sp.rcm_ordering(A2) is ordering
+  P2 = sp.permute(A2, ordering)
+  assert sp.pattern_cache.misses == misses
+  assert np.amax(np.abs(P2.to_dense() - 2*ref)) < 1e-5
+
+  # solving the permuted system and restoring gives the original solution
+  b = Variable(th.from_numpy(np.random.uniform(size=(60,)).astype(np.float32)))
+  x = ordering.restore(sp.spmv(P, ordering.vector(b)))
+  assert np.amax(np.abs(x.data.numpy() - M.dot(b.data.numpy()))) < 1e-4
+
+  val = Variable(A.val.data.double(), requires_grad=True)
+  gradcheck(lambda v: sp.permute(sp.Sparse(
+              A.csr_row_idx, A.col_idx, v, A.size), ordering).val,
+            (val,), eps=1e-4, atol=1e-5, rtol=1e-3, raise_exception=True)
+
+
+def test_tile_ordering():
+  h, w, tile = 5, 7, 3
+  ordering = sp.tile_ordering(h, w, tile, th.FloatTensor(1))
+  perm = ordering.perm.numpy()
+  assert sorted(perm) == list(range(h*w))
+  # first tile, row-major, then the next tile to the right
+  assert list(perm[:9]) == [0, 1, 2, 7, 8, 9, 14, 15, 16]
+  assert list(perm[9:12]) == [3, 4, 5]
+  assert sp.tile_ordering(h, w, tile, th.FloatTensor(1)) is ordering
+
+  img = Variable(th.arange(0, h*w))
+  assert (ordering.restore(ordering.vector(img)).data == img.data).all()
+
+
+def _get_local_windows(h, w, seed):
+  """Random 3x3 windows over the interior pixels of an h x w image."""
+  rng = np.random.RandomState(seed)
+  y, x = np.mgrid[1:h-1, 1:w-1]
+  inInd = (y*w + x).reshape(-1, 1).astype(np.int32)
+  offsets = np.array([-1-w, -1, -1+w, -w, 0, w, 1-w, 1, 1+w], dtype=np.int32)
+  neighbors = inInd + offsets.reshape(1, 9)
+  K = neighbors.shape[0]
+  flows = rng.uniform(size=(9, 9, K))
+  weights = rng.uniform(size=(K,))
+  return neighbors, flows, weights
+
+
+def test_local_laplacian():
+  h, w = 6, 7
+  N = h*w
+  neighbors, flows, weights = _get_local_windows(h, w, 0)
+  K = neighbors.shape[0]
+
+  # assembled as in MattingSystem._matting_laplacian
+  rows = np.repeat(neighbors, 9, 1).ravel()
+  cols = np.tile(neighbors, (1, 9)).ravel()
+  vals = (flows*weights.reshape(1, 1, -1)).transpose(2, 1, 0).ravel()
+  W = sp.from_coo(th.from_numpy(rows.astype(np.int32)),
+                  th.from_numpy(cols.astype(np.int32)),
+                  th.from_numpy(vals.astype(np.float32)), th.Size((N, N)))
+  L = sp.sp_laplacian(W, symmetrize=True)
+
+  op = sp.LocalLaplacian(
+      Variable(th.from_numpy(neighbors)),
+      Variable(th.from_numpy(flows.astype(np.float32))),
+      Variable(th.from_numpy(weights.astype(np.float32))), th.Size((N, N)))
+  v = Variable(th.from_numpy(np.random.uniform(size=(N,)).astype(np.float32)))
+  ref = sp.spmv(L, v).data.numpy()
+  assert np.amax(np.abs(sp.spmv(op, v).data.numpy() - ref)) < 1e-4
+  Av, vAv = sp.spmv_dot(op, v)
+  assert np.abs(float(vAv) - ref.dot(v.data.numpy())) < 1e-2
+
+  # the sum with assembled terms is accepted by the solvers
+  M, D = _get_spd_matrix(N, 1)
+  A = sp.OperatorSum([D, op])
+  b = Variable(th.from_numpy(np.random.uniform(size=(N,)).astype(np.float32)))
+  x0 = Variable(th.zeros(N))
+  x, err, k = optim.sparse_cg(A, b, x0, steps=100)
+  Adense = M.toarray() + L.to_dense()
+  assert np.amax(np.abs(Adense.dot(x.data.numpy()) - b.data.numpy())) < 1e-3
+
+  neigh = Variable(th.from_numpy(neighbors))
+  fl = Variable(th.from_numpy(flows), requires_grad=True)
+  wt = Variable(th.from_numpy(weights), requires_grad=True)
+  vv = Variable(v.data.double(), requires_grad=True)
+  gradcheck(lambda f, c, u: sp.LocalLaplacian(neigh, f, c, th.Size((N, N))).matmul(u),
+            (fl, wt, vv), eps=1e-6, atol=1e-6, rtol=1e-4, raise_exception=True)
+
+
+def test_diagonal_extraction():
+  M, A = _get_spd_matrix(30, 0)
+  d = sp.diagonal(A).data.numpy()
+  assert np.amax(np.abs(d - M.diagonal())) < 1e-6
+
+  blocks = sp.diagonal_blocks(A, 4).data.numpy()
+  dense = M.toarray()
+  assert blocks.shape == (8, 4, 4)
+  for i in range(7):
+    assert np.amax(np.abs(blocks[i] - dense[4*i:4*i+4, 4*i:4*i+4])) < 1e-6
+  assert np.amax(np.abs(blocks[7, :2, :2] - dense[28:, 28:])) < 1e-6
+  assert np.amax(np.abs(blocks[7, 2:, 2:] - np.eye(2))) < 1e-6
+
+  # the plans are shared with the other precision of the pattern
+  A64 = sp.Sparse(A.csr_row_idx, A.col_idx, Variable(A.val.data.double()),
+                  A.size)
+  assert sp.diagonal(A64).data.type() == "torch.DoubleTensor"
+  assert sp.diagonal_blocks(A64, 4).data.type() == "torch.DoubleTensor"
+  assert sp.diagonal(A).data.type() == A.val.data.type()
+
+  # matrix-free terms
+  h, w = 5, 6
+  neighbors, flows, weights = _get_local_windows(h, w, 0)
+  op = sp.LocalLaplacian(
+      Variable(th.from_numpy(neighbors)), Variable(th.from_numpy(flows)),
+      Variable(th.from_numpy(weights)), th.Size((h*w, h*w)))
+  eye = th.eye(h*w).double()
+  ref = np.array([op.matmul(Variable(eye[:, i])).data.numpy()[i]
+                  for i in range(h*w)])
+  assert np.amax(np.abs(sp.diagonal(op).data.numpy() - ref)) < 1e-10
+
+
+def _get_badly_scaled_system(n, seed):
+  M, A = _get_spd_matrix(n, seed)
+  scale = np.exp(np.random.RandomState(seed).uniform(-3, 3, size=n))
+  M = scp.diags(scale).dot(M).dot(scp.diags(scale)).tocsr()
+  M.sort_indices()
+  A = sp.Sparse(
+      Variable(th.from_numpy(M.indptr.astype(np.int32))),
+      Variable(th.from_numpy(M.indices.astype(np.int32))),
+      Variable(th.from_numpy(M.data.astype(np.float64))), th.Size((n, n)))
+  return M, A
+
+
+def test_preconditioned_cg():
+  n = 80
+  M, A = _get_badly_scaled_system(n, 0)
+  b = Variable(th.from_numpy(np.random.uniform(size=(n,))))
+  x0 = Variable(th.zeros(n).double())
+
+  x, err, steps = optim.sparse_cg(A, b, x0, steps=500, thresh=1e-8)
+  for name in ["jacobi", "block_jacobi"]:
+    precond = optim.preconditioner(name, A)
+    xp, errp, stepsp = optim.sparse_cg(A, b, x0, steps=500, thresh=1e-8,
+                                       precond=precond)
+    assert errp < 1e-8
+    assert stepsp < steps
+    assert np.amax(np.abs(M.dot(xp.data.numpy()) - b.data.numpy())) < 1e-7
+
+  # several systems / right-hand sides
+  B = Variable(th.from_numpy(np.random.uniform(size=(n, 3))))
+  precond = optim.preconditioner("block_jacobi", A, block_size=3)
+  X, errs, stop_steps = optim.block_sparse_cg(
+      A, B, Variable(th.zeros(n, 3).double()), steps=500, thresh=1e-8,
+      precond=precond)
+  assert max(errs) < 1e-8
+  assert np.amax(np.abs(M.dot(X.data.numpy()) - B.data.numpy())) < 1e-7
+
+  AA = sp.block_diag([A, A])
+  bb = th.cat([b, 2*b], 0)
+  xx, errs, stop_steps = optim.batched_sparse_cg(
+      AA, bb, Variable(th.zeros(2*n).double()), steps=500, thresh=1e-8,
+      precond=optim.preconditioner("jacobi", AA))
+  assert max(errs) < 1e-8
+  assert np.amax(np.abs(xx.data.numpy()[n:] - 2*xx.data.numpy()[:n])) < 1e-6
+
+
+def test_preconditioned_cg_gradients():
+  M, A = _get_spd_matrix(12, 0)
+  val = Variable(A.val.data.double(), requires_grad=True)
+  b = Variable(th.from_numpy(np.random.uniform(size=(12,))), requires_grad=True)
+  x0 = Variable(th.zeros(12).double())
+  for name in ["jacobi", "block_jacobi"]:
+    def solve(v, rhs):
+      Av = sp.Sparse(A.csr_row_idx, A.col_idx, v, A.size)
+      precond = optim.preconditioner(name, Av)
+      return optim.sparse_cg(Av, rhs, x0, steps=5, thresh=0,
+                             precond=precond)[0]
+    gradcheck(solve, (val, b), eps=1e-6, atol=1e-6, rtol=1e-4,
+              raise_exception=True)
+
+
+def test_incomplete_cholesky():
+  sp.pattern_cache.clear()
+  n = 60
+  M, A = _get_spd_matrix(n, 0)
+  M = M.astype(np.float64)
+  A = sp.Sparse(A.csr_row_idx, A.col_idx, Variable(A.val.data.double()), A.size)
+  precond = optim.IncompleteCholeskyPreconditioner(A)
+  assert precond.shift == 0
+
+  # L.Lt matches A on A's pattern
+  plan = precond.plan
+  L = scp.csr_matrix((precond.val.numpy(), plan.col_idx.numpy(),
+                      plan.csr_row_idx.numpy()), shape=(n, n))
+  assert (np.diff(L.indptr) > 0).all()
+  LLt = L.dot(L.T).toarray()
+  mask = M.toarray() != 0
+  assert np.amax(np.abs(LLt - M.toarray())[mask]) < 1e-10
+
+  r = Variable(th.from_numpy(np.random.uniform(size=(n,))))
+  z = precond.apply(r).data.numpy()
+  assert np.amax(np.abs(LLt.dot(z) - r.data.numpy())) < 1e-10
+
+  # the structure is cached on the pattern
+  misses = sp.pattern_cache.misses
+  A2 = sp.Sparse(A.csr_row_idx, A.col_idx, A.val*2, A.size)
+  optim.IncompleteCholeskyPreconditioner(A2)
+  assert sp.pattern_cache.misses == misses
+
+  # pivots that break down are shifted
+  Ai = sp.from_coo(th.IntTensor([0, 0, 1, 1, 2]), th.IntTensor([0, 1, 0, 1, 2]),
+                   th.DoubleTensor([1, 2, 2, 1, 1]), th.Size((3, 3)))
+  assert optim.IncompleteCholeskyPreconditioner(Ai, shift=1e-2).shift >= 1
+
+  Mb, Ab = _get_badly_scaled_system(n, 0)
+  b = Variable(th.from_numpy(np.random.uniform(size=(n,))), requires_grad=True)
+  x0 = Variable(th.zeros(n).double())
+  steps = {}
+  for name in ["jacobi", "ic0"]:
+    x, err, steps[name] = optim.sparse_cg(
+        Ab, b, x0, steps=500, thresh=1e-8,
+        precond=optim.preconditioner(name, Ab))
+    assert err < 1e-8
+  assert steps["ic0"] < steps["jacobi"]
+
+  precond = optim.preconditioner("ic0", Ab)
+  gradcheck(lambda rhs: optim.sparse_cg(Ab, rhs, x0, steps=4, thresh=0,
+                                        precond=precond)[0],
+            (b,), eps=1e-6, atol=1e-6, rtol=1e-4, raise_exception=True)
+
+  # a chain has one level per row, too deep for the numpy fallback
+  m = 1200
+  idx = np.arange(m)
+  row = np.concatenate([idx, idx[1:], idx[:-1]])
+  col = np.concatenate([idx, idx[:-1], idx[1:]])
+  val = np.concatenate([4*np.ones(m), -np.ones(2*m - 2)])
+  chain = sp.from_coo(th.from_numpy(row).int(), th.from_numpy(col).int(),
+                      th.from_numpy(val), th.Size((m, m)))
+  try:
+    optim.IncompleteCholeskyPreconditioner(chain)
+    assert False, "expected a RuntimeError"
+  except RuntimeError:
+    pass
+  assert optim.IncompleteCholeskyPreconditioner(chain, max_levels=m).shift == 0
+
+
+def _get_grid_laplacian(h, w, seed):
+  """Weighted 4-neighbour Laplacian of an h x w grid, a few pixels pinned."""
+  rng = np.random.RandomState(seed)
+  idx = np.arange(h*w).reshape(h, w)
+  pairs = [(idx[:, :-1].ravel(), idx[:, 1:].ravel()),
+           (idx[:-1, :].ravel(), idx[1:, :].ravel())]
+  row, col, val = [], [], []
+  for i, j in pairs:
+    wgt = rng.uniform(0.1, 1, size=i.size)
+    row += [i, j, i, j]
+    col += [j, i, i, j]
+    val += [-wgt, -wgt, wgt, wgt]
+  pinned = 10.0*(rng.uniform(size=h*w) < 0.1)
+  pinned[0] = 10.0
+  row.append(idx.ravel())
+  col.append(idx.ravel())
+  val.append(pinned)
+  M = scp.coo_matrix((np.concatenate(val),
+                      (np.concatenate(row), np.concatenate(col))),
+                     shape=(h*w, h*w)).tocsr()
+  M.sort_indices()
+  A = sp.Sparse(
+      Variable(th.from_numpy(M.indptr.astype(np.int32))),
+      Variable(th.from_numpy(M.indices.astype(np.int32))),
+      Variable(th.from_numpy(M.data.astype(np.float64))), th.Size((h*w, h*w)))
+  b = Variable(th.from_numpy(rng.uniform(size=(h*w,))))
+  return M, A, b
+
+
+def test_pixel_aggregation():
+  P, coarse = sp.pixel_aggregation([(3, 5), (2, 2)], th.DoubleTensor(1))
+  assert coarse == [(2, 3), (1, 1)]
+  assert tuple(P.size) == (19, 7)
+  col = P.col_idx.data.numpy()
+  assert list(col[:5]) == [0, 0, 1, 1, 2]
+  assert col[14] == 5
+  assert list(col[15:]) == [6, 6, 6, 6]
+
+  ordering = sp.tile_ordering(3, 5, 2, th.DoubleTensor(1))
+  Pr, _ = sp.pixel_aggregation([(3, 5)], th.DoubleTensor(1), [ordering])
+  assert (Pr.col_idx.data.numpy() == col[:15][ordering.perm.numpy()]).all()
+
+
+def test_multigrid():
+  steps = {}
+  for s in [16, 32]:
+    M, A, b = _get_grid_laplacian(s, s, 0)
+    x0 = Variable(th.zeros(s*s).double())
+    x, err, steps["cg", s] = optim.sparse_cg(A, b, x0, steps=1000, thresh=1e-8)
+    for smoother in optim.MultigridPreconditioner.SMOOTHERS:
+      precond = optim.preconditioner("multigrid", A, shapes=[(s, s)],
+                                     smoother=smoother, coarse_size=16)
+      assert len(precond.levels) == {16: 2, 32: 3}[s]
+      x, err, steps[smoother, s] = optim.sparse_cg(
+          A, b, x0, steps=1000, thresh=1e-8, precond=precond)
+      assert err < 1e-8
+      assert np.amax(np.abs(M.dot(x.data.numpy()) - b.data.numpy())) < 1e-7
+      assert 2*steps[smoother, s] < steps["cg", s]
+  # the preconditioned iterations grow slower than plain CG's
+  for smoother in optim.MultigridPreconditioner.SMOOTHERS:
+    assert (steps[smoother, 32] - steps[smoother, 16] <
+            steps["cg", 32] - steps["cg", 16])
+
+  # reordered and batched systems
+  h, w = 9, 7
+  M, A, b = _get_grid_laplacian(h, w, 1)
+  M2, A2, b2 = _get_grid_laplacian(5, 6, 2)
+  ordering = sp.tile_ordering(h, w, 4, b.data)
+  Ar, br = sp.permute(A, ordering), ordering.vector(b)
+  AA = sp.block_diag([Ar, A2])
+  bb = th.cat([br, b2], 0)
+  precond = optim.preconditioner("multigrid", AA, shapes=[(h, w), (5, 6)],
+                                 orderings=[ordering, None], coarse_size=4)
+  xx, errs, stop_steps = optim.batched_sparse_cg(
+      AA, bb, Variable(th.zeros(h*w + 30).double()), steps=500, thresh=1e-8,
+      precond=precond)
+  assert max(errs) < 1e-8
+  x = ordering.restore(xx[:h*w]).data.numpy()
+  assert np.amax(np.abs(M.dot(x) - b.data.numpy())) < 1e-7
+
+  try:
+    optim.preconditioner("multigrid", A, shapes=[(h, w+1)])
+    assert False, "expected a ValueError"
+  except ValueError:
+    pass
+
+
+def test_multigrid_gradients():
+  h, w = 5, 6
+  M, A, b = _get_grid_laplacian(h, w, 0)
+  b.requires_grad = True
+  x0 = Variable(th.zeros(h*w).double())
+  for smoother in optim.MultigridPreconditioner.SMOOTHERS:
+    precond = optim.preconditioner("multigrid", A, shapes=[(h, w)],
+                                   smoother=smoother, coarse_size=4)
+    assert len(precond.levels) == 2
+    gradcheck(lambda rhs: optim.sparse_cg(A, rhs, x0, steps=3, thresh=0,
+                                          precond=precond)[0],
+              (b,), eps=1e-6, atol=1e-6, rtol=1e-4, raise_exception=True)
+
+  # through the inverse of the coarsest operator
+  val = Variable(A.val.data, requires_grad=True)
+  def solve(v, rhs):
+    Av = sp.Sparse(A.csr_row_idx, A.col_idx, v, A.size)
+    precond = optim.preconditioner("multigrid", Av, shapes=[(h, w)],
+                                   coarse_size=h*w)
+    return optim.sparse_cg(Av, rhs, x0, steps=3, thresh=0, precond=precond)[0]
+  gradcheck(solve, (val, b), eps=1e-6, atol=1e-6, rtol=1e-4,
+            raise_exception=True)
+
+
+def test_implicit_cg():
+  n = 30
+  M, A = _get_spd_matrix(n, 0)
+  M = M.astype(np.float64)
+  val = Variable(A.val.data.double(), requires_grad=True)
+  A = sp.Sparse(A.csr_row_idx, A.col_idx, val, A.size)
+  b = Variable(th.from_numpy(np.random.uniform(size=(n,))), requires_grad=True)
+  solver = optim.ImplicitCG(steps=500, thresh=1e-12)
+  x, errs, stop_steps = solver(A, b)
+  assert max(errs) < 1e-12
+  assert np.amax(np.abs(M.dot(x.data.numpy()) - b.data.numpy())) < 1e-10
+  assert len(solver.history) == stop_steps[0]
+  assert solver.history[-1] == errs[0]
+
+  # matches the unrolled iterations once converged
+  g = np.random.uniform(size=(n,))
+  x.backward(th.from_numpy(g))
+  x_ref, err, steps = optim.sparse_cg(
+      A, b, Variable(th.zeros(n).double()), steps=500, thresh=1e-12)
+  grad_val, grad_b = val.grad.data.clone(), b.grad.data.clone()
+  val.grad.data.zero_()
+  b.grad.data.zero_()
+  x_ref.backward(th.from_numpy(g))
+  assert max(solver.adjoint_errs) < 1e-12
+  assert np.amax(np.abs(grad_b.numpy() - b.grad.data.numpy())) < 1e-8
+  assert np.amax(np.abs(grad_val.numpy() - val.grad.data.numpy())) < 1e-8
+
+  # a warm started adjoint solve needs fewer steps
+  x, errs, stop_steps = solver(A, b, adjoint_x0=solver.last_adjoint*0.99)
+  steps = solver.adjoint_stop_steps[0]
+  x.backward(th.from_numpy(g))
+  assert solver.adjoint_stop_steps[0] < steps
+
+  # several right-hand sides and independent systems
+  solver = optim.ImplicitCG(steps=200, thresh=1e-10)
+  B = Variable(th.from_numpy(np.random.uniform(size=(n, 2))), requires_grad=True)
+  gradcheck(lambda v, rhs: solver(sp.Sparse(A.csr_row_idx, A.col_idx, v,
+                                            A.size), rhs)[0],
+            (val, B), eps=1e-6, atol=1e-5, rtol=1e-3, raise_exception=True)
+  AA = sp.block_diag([A, A])
+  bb = th.cat([b, 2*b], 0)
+  xx, errs, stop_steps = solver(AA, bb)
+  assert len(errs) == 2
+  assert np.amax(np.abs(xx.data.numpy()[n:] - 2*xx.data.numpy()[:n])) < 1e-8
+  gradcheck(lambda rhs: solver(AA, rhs)[0], (bb,), eps=1e-6, atol=1e-5,
+            rtol=1e-3, raise_exception=True)
+
+
+def test_sparse_cg_many():
+  systems, mats = [], []
+  for i, n in enumerate([20, 35, 50]):
+    M, A = _get_badly_scaled_system(n, i)
+    b = Variable(th.from_numpy(np.random.RandomState(i).uniform(size=(n,))),
+                 requires_grad=True)
+    systems.append((A, b))
+    mats.append(M)
+  # already solved by its initial guess
+  x0s = [None, None, None]
+  x0s[1] = Variable(th.from_numpy(
+      scp.linalg.spsolve(mats[1].tocsc(), systems[1][1].data.numpy())))
+
+  xs, errs, stop_steps = optim.sparse_cg_many(
+      systems, x0s, steps=2000, thresh=1e-10)
+  assert stop_steps[1] == 0
+  assert len(set(stop_steps)) == 3
+  for M, (A, b), x, err in zip(mats, systems, xs, errs):
+    assert err < 1e-10
+    assert np.amax(np.abs(M.dot(x.data.numpy()) - b.data.numpy())) < 1e-7
+  # same iterations as the masked solve of the stacked systems
+  AA = sp.block_diag([A for A, _ in systems])
+  x0 = th.cat([Variable(th.zeros(b.shape[0]).double()) if x0 is None else x0
+               for x0, (_, b) in zip(x0s, systems)], 0)
+  xx, errs_ref, stop_steps_ref = optim.batched_sparse_cg(
+      AA, th.cat([b for _, b in systems], 0), x0, steps=2000, thresh=1e-10)
+  assert stop_steps == stop_steps_ref
+
+  # gradients through the restacked iterations
+  sum(x.sum() for x in xs).backward()
+  for M, (A, b), k in zip(mats, systems, stop_steps):
+    if k == 0:
+      continue
+    g = scp.linalg.spsolve(M.tocsc(), np.ones(b.shape[0]))
+    assert np.amax(np.abs(b.grad.data.numpy() - g)) < 1e-5
+
+  # preconditioned, with a system that is not assembled
+  d = Variable(th.from_numpy(np.random.RandomState(3).uniform(1, 2, size=(10,))))
+  systems.append((sp.Diagonal(d), d*2))
+  preconds = [optim.JacobiPreconditioner(A) for A, _ in systems]
+  xs, errs, stop_steps = optim.sparse_cg_many(
+      systems, steps=2000, thresh=1e-8, preconds=preconds)
+  assert max(errs) < 1e-8
+  assert stop_steps[3] == 1
+  assert np.amax(np.abs(xs[3].data.numpy() - 2)) < 1e-10
+
+
+def test_cg_check_every():
+  n = 60
+  M, A = _get_badly_scaled_system(n, 0)
+  b = Variable(th.from_numpy(np.random.uniform(size=(n,))))
+  x0 = Variable(th.zeros(n).double())
+  precond = optim.preconditioner("jacobi", A)
+  AA = sp.block_diag([A, A])
+  bb = th.cat([b, 2*b], 0)
+  B = th.stack([b, 3*b], 1)
+  solves = [
+    ("inplace", lambda **kw: optim.sparse_cg(A, b, x0, 500, 1e-8, **kw)),
+    ("precond", lambda **kw: optim.sparse_cg(A, b, x0, 500, 1e-8,
+                                             precond=precond, **kw)),
+    ("batched", lambda **kw: optim.batched_sparse_cg(
+      AA, bb, th.cat([x0, x0], 0), 500, 1e-8, **kw)),
+    ("block", lambda **kw: optim.block_sparse_cg(
+      A, B, th.stack([x0, x0], 1), 500, 1e-8, **kw)),
+    ("many", lambda **kw: optim.sparse_cg_many(
+      [(A, b), (A, 2*b)], None, 500, 1e-8, **kw)),
+  ]
+  for name, solve in solves:
+    history = []
+    x, err, steps = solve(history=history)
+    for check_every in [7, 0]:
+      history_k = []
+      xk, errk, stepsk = solve(check_every=check_every, history=history_k)
+      # the solves are frozen on the device once under the threshold
+      assert stepsk == steps, name
+      assert history_k == history, name
+      if name == "many":
+        assert all((u.data == v.data).all() for u, v in zip(x, xk)), name
+      else:
+        assert (xk.data == x.data).all(), name
+  assert len(history) == max(steps)
+  assert max(history[-1]) == max(err)
+
+
+def test_refined_cg():
+  M, A, b = _get_grid_laplacian(24, 24, 0)
+  n = A.size[0]
+  x_ref = np.linalg.solve(M.toarray(), b.data.numpy())
+
+  # the true residual of float32 CG stalls far above float64 accuracy
+  A32 = sp.single(A)
+  b32 = b.data.float()
+  x32, err, steps = optim.sparse_cg(
+      A32, Variable(b32), Variable(th.zeros(n)), steps=1000, thresh=1e-12)
+  assert np.abs(M.dot(x32.data.numpy()) - b.data.numpy()).max() > 1e-6
+
+  history = []
+  x, errs, steps = optim.refined_cg(
+      A, b.data, refinements=20, thresh=1e-11, steps=500, inner_thresh=1e-4,
+      history=history)
+  assert x.type() == "torch.DoubleTensor"
+  assert errs[0] < 1e-11
+  assert np.abs(M.dot(x.numpy()) - b.data.numpy()).max() < 1e-11
+  assert np.abs(x.numpy() - x_ref).max() < 1e-9
+  assert len(history) > 1
+  assert all(h[0] < g[0] for g, h in zip(history[:-1], history[1:]))
+
+  # independent systems and several right-hand sides
+  AA = sp.block_diag([A, A])
+  bb = th.cat([b.data, 2*b.data], 0)
+  precond = optim.JacobiPreconditioner(sp.single(AA))
+  xx, errs, steps = optim.refined_cg(AA, bb, thresh=1e-10, steps=500,
+                                     precond=precond)
+  assert len(errs) == 2 and max(errs) < 1e-10
+  assert np.abs(xx.numpy()[n:] - 2*x_ref).max() < 1e-9
+  B = th.stack([b.data, 2*b.data], 1)
+  X, errs, steps = optim.refined_cg(A, B, thresh=1e-10, steps=500)
+  assert len(errs) == 2 and max(errs) < 1e-10
+  assert np.abs(X.numpy()[:, 1] - 2*x_ref).max() < 1e-9
+
+  # differentiated implicitly, like a float64 solve
+  val = Variable(A.val.data.float(), requires_grad=True)
+  A32 = sp.Sparse(A.csr_row_idx, A.col_idx, val, A.size)
+  rhs = Variable(b32, requires_grad=True)
+  solver = optim.ImplicitCG(steps=500, thresh=1e-10, refinements=10)
+  x, errs, steps = solver(A32, rhs)
+  assert x.data.type() == "torch.FloatTensor"
+  M32 = scp.csr_matrix((val.data.numpy().astype(np.float64), M.indices,
+                        M.indptr), shape=M.shape)
+  # the residual reported is that of the float32 x returned
+  r = b32.numpy().astype(np.float64) - M32.dot(x.data.numpy().astype(np.float64))
+  assert abs(errs[0] - np.linalg.norm(r)) < 1e-12
+  assert 1e-10 < errs[0] < 1e-4
+  assert solver.history[-1] == errs
+  g = np.random.RandomState(0).uniform(size=(n,))
+  x.backward(th.from_numpy(g).float())
+  lmbda = np.linalg.solve(M32.toarray(), g)
+  assert max(solver.adjoint_errs) < 1e-5
+  assert np.abs(rhs.grad.data.numpy() - lmbda).max() < 1e-5
+  assert len(solver.history) > 1
+
+
+def test_krylov_solvers():
+  M, A, b = _get_grid_laplacian(16, 16, 0)
+  n = A.size[0]
+  x_ref = np.linalg.solve(M.toarray(), b.data.numpy())
+  x0 = Variable(th.zeros(n).double())
+  AA = sp.block_diag([A, A])
+  bb = th.cat([b, 2*b], 0)
+  B = th.stack([b, 2*b], 1)
+  dense = sp.aslinearoperator(Variable(th.from_numpy(M.toarray())))
+  assert sp.aslinearoperator(A) is A
+  for name in sorted(optim.SOLVERS.keys()):
+    for precond in [None, optim.JacobiPreconditioner(A)]:
+      history = []
+      x, errs, steps = optim.solve(name, A, b, x0, steps=1000, thresh=1e-8,
+                                   precond=precond, history=history)
+      assert errs[0] < 1e-8 and steps[0] < 1000, name
+      assert np.abs(M.dot(x.data.numpy()) - b.data.numpy()).max() < 1e-7, name
+      assert history[-1] == errs[0], name
+
+    # independent systems, several right-hand sides, a dense operator
+    x, errs, steps = optim.solve(name, AA, bb, th.cat([x0, x0], 0),
+                                 steps=1000, thresh=1e-8)
+    assert len(errs) == 2 and max(errs) < 1e-8, name
+    assert np.abs(x.data.numpy()[n:] - 2*x_ref).max() < 1e-6, name
+    X, errs, steps = optim.solve(name, A, B, th.stack([x0, x0], 1),
+                                 steps=1000, thresh=1e-8)
+    assert len(errs) == 2 and max(errs) < 1e-8, name
+    assert np.abs(X.data.numpy()[:, 1] - 2*x_ref).max() < 1e-6, name
+    x, errs, steps = optim.solve(name, dense, b, x0, steps=1000, thresh=1e-8)
+    assert np.abs(x.data.numpy() - x_ref).max() < 1e-6, name
+
+  # cg is solve("cg") on a dense matrix
+  x, err = optim.cg(dense.M, b, x0, steps=1000, thresh=1e-8)
+  assert err < 1e-8
+  assert np.abs(x.data.numpy() - x_ref).max() < 1e-6
+
+  # frozen systems: reading the residuals less often changes nothing
+  for name in ["pipelined_cg", "minres"]:
+    x, errs, steps = optim.solve(name, AA, bb, th.cat([x0, x0], 0),
+                                 steps=1000, thresh=1e-8)
+    xk, errs_k, steps_k = optim.solve(name, AA, bb, th.cat([x0, x0], 0),
+                                      steps=1000, thresh=1e-8, check_every=7)
+    assert steps_k == steps and errs_k == errs, name
+    assert (xk.data == x.data).all(), name
+
+  # float32 recomputes the drifting residual, what is reported is b - A.x
+  A32 = sp.single(A)
+  for replace_every in [None, 3]:
+    x, errs, steps = optim.pipelined_cg(
+        A32, Variable(b.data.float()), Variable(th.zeros(n)), steps=1000,
+        thresh=1e-3, precond=optim.JacobiPreconditioner(A32),
+        replace_every=replace_every)
+    r = b.data.numpy() - M.dot(x.data.numpy().astype(np.float64))
+    assert errs[0] < 1e-3
+    assert abs(np.linalg.norm(r) - errs[0]) < 1e-4
+
+  # MINRES also solves symmetric indefinite systems
+  shift = 0.5*np.abs(np.linalg.eigvalsh(M.toarray())).mean()
+  S = Variable(th.from_numpy(M.toarray() - shift*np.eye(n)))
+  x, errs, steps = optim.minres(S, b, x0, steps=2000, thresh=1e-8)
+  assert errs[0] < 1e-8
+  assert np.abs(S.data.numpy().dot(x.data.numpy()) -
+                b.data.numpy()).max() < 1e-7
+
+  # the unrolled iterations are differentiable
+  M, A = _get_spd_matrix(12, 0)
+  val = Variable(A.val.data.double(), requires_grad=True)
+  rhs = Variable(th.from_numpy(np.random.uniform(size=(12,))),
+                 requires_grad=True)
+  x0 = Variable(th.zeros(12).double())
+  eig = np.linalg.eigvalsh(M.toarray().astype(np.float64))
+  for name, kwargs in [("chebyshev", {"bounds": (eig[0], eig[-1])}),
+                       ("pipelined_cg", {}), ("minres", {})]:
+    gradcheck(lambda v, r: optim.solve(
+        name, sp.Sparse(A.csr_row_idx, A.col_idx, v, A.size), r, x0,
+        steps=4, thresh=0, **kwargs)[0], (val, rhs), eps=1e-6, atol=1e-5,
+        rtol=1e-3, raise_exception=True)
+
+  try:
+    optim.solve("gmres", A, b, x0)
+    assert False, "unknown solvers are rejected"
+  except ValueError:
+    pass
+
+
+def test_cg_checkpoint():
+  M, A, b = _get_grid_laplacian(12, 12, 0)
+  n = A.size[0]
+  g = Variable(th.from_numpy(np.random.uniform(size=(n,))))
+
+  def run(steps, thresh, **kwargs):
+    val = Variable(A.val.data.clone(), requires_grad=True)
+    rhs = Variable(b.data.clone(), requires_grad=True)
+    x0 = Variable(th.from_numpy(np.random.RandomState(1).uniform(size=(n,))),
+                  requires_grad=True)
+    history = []
+    x, err, step = optim.sparse_cg(
+        sp.Sparse(A.csr_row_idx, A.col_idx, val, A.size), rhs, x0, steps,
+        thresh, history=history, **kwargs)
+    (x*g).sum().backward()
+    return [x.data, val.grad.data, rhs.grad.data, x0.grad.data], (
+        err, step, history)
+
+  # converged early, or stopped at the last step
+  for steps, thresh in [(200, 1e-6), (23, 0)]:
+    for check_every in [1, 3]:
+      ref, stats = run(steps, thresh, check_every=check_every)
+      for checkpoint in [1, 4, 50]:
+        out, stats_k = run(steps, thresh, check_every=check_every,
+                           checkpoint=checkpoint)
+        # same values and gradients, to the bit
+        assert stats_k == stats
+        assert all((u == v).all() for u, v in zip(out, ref))
+  assert stats[1] == 23
+
+  # one gradient of the values is live at a time, not one per step
+  def live_grads():
+    return sum(1 for o in gc.get_objects()
+               if isinstance(o, Variable) and o.grad_fn is None and
+               o.grad is not None and o.grad.numel() == A.nnz)
+  live = []
+  accumulate = optim._CheckpointedCG._accumulate
+  def counting(self, grad):
+    live.append(live_grads())
+    accumulate(self, grad)
+  optim._CheckpointedCG._accumulate = counting
+  try:
+    out, stats_k = run(23, 0, check_every=3, checkpoint=8)
+  finally:
+    optim._CheckpointedCG._accumulate = accumulate
+  assert len(live) == 23 and max(live) == 0
+  assert all((u == v).all() for u, v in zip(out, ref))
+
+  precond = optim.preconditioner("jacobi", A)
+  try:
+    optim.sparse_cg(A, b, Variable(th.zeros(n).double()), precond=precond,
+                    checkpoint=4)
+    assert False, "checkpointing needs no preconditioner"
+  except ValueError:
+    pass